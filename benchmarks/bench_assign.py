@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+
+# Throughput of the bulk output area assignment (address.assign_output_areas) on
+# synthetic OA centroids and transaction coordinates, against the latitude/longitude
+# BallTree from address.get_coordinates_and_ball_tree that predict queries.
+#   python benchmarks/bench_assign.py --areas 190000 --points 1000000 10000000
+
+import argparse
+import os
+import time
+
+import numpy as np
+
+import synthetic
+
+from fynesse import address
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--areas", type=int, default=synthetic.scales["large"])
+    parser.add_argument("--points", type=int, nargs="+", default=[1000000])
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, os.cpu_count()])
+    args = parser.parse_args()
+
+    areas = synthetic.output_area_coordinates(args.areas)
+    start = time.perf_counter()
+    tree, codes = address.build_output_area_index(areas)
+    print(f"index over {args.areas} centroids built in {time.perf_counter() - start:.2f} s\n")
+    lat_long_tree = address.get_coordinates_and_ball_tree(areas)
+
+    print(f"{'points':>10} {'method':>22} {'s':>8} {'points/s':>12}")
+    rng = np.random.default_rng(0)
+    for num_points in args.points:
+        # transactions sit near the output areas, like real postcodes do
+        centre = rng.integers(0, len(areas), num_points)
+        lat = areas["LAT"].to_numpy()[centre] + rng.normal(0, 0.01, num_points)
+        lon = areas["LONG"].to_numpy()[centre] + rng.normal(0, 0.015, num_points)
+
+        for workers in args.workers:
+            start = time.perf_counter()
+            assigned = address.assign_output_areas(lat, lon, tree, codes, max_workers=workers)
+            elapsed = time.perf_counter() - start
+            print(f"{num_points:>10} {f'unit vectors x{workers}':>22} {elapsed:>8.2f} {num_points / elapsed:>12.0f}")
+
+        # the lat/long tree on a sample, it is too slow for the full set. It measures
+        # distance in degrees, so it disagrees with the great circle assignment where
+        # a longitude degree is much shorter than a latitude degree
+        sample = min(num_points, 200000)
+        start = time.perf_counter()
+        _, ind = lat_long_tree.query(np.radians(np.column_stack([lat[:sample], lon[:sample]])), k=1)
+        elapsed = time.perf_counter() - start
+        print(f"{sample:>10} {'lat/long ball tree x1':>22} {elapsed:>8.2f} {sample / elapsed:>12.0f}")
+        agreement = np.mean(codes[ind[:, 0]] == assigned[:sample])
+        print(f"{'':>10} {'agreement':>22} {agreement:>8.4f}\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+
+# Compares the MariaDB and embedded DuckDB backends on the analytical reads, using
+# synthetic pp_data/postcode_data tables and the prices_coordinates_data they join into.
+#   python benchmarks/bench_backends.py --rows 2000000
+#   python benchmarks/bench_backends.py --rows 2000000 --mysql user:password@host:3306/database
+# Without --mysql only DuckDB is run.
+
+import argparse
+import os
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+import synthetic
+
+from fynesse import access
+
+aggregate_query = """
+    SELECT county, property_type, YEAR(date_of_transfer), COUNT(*), AVG(price), MAX(price)
+    FROM prices_coordinates_data
+    GROUP BY county, property_type, YEAR(date_of_transfer);
+"""
+
+
+def postcode_frame(pp_df, seed=0):
+    rng = np.random.default_rng(seed)
+    postcodes = pp_df["postcode"].unique()
+    return pd.DataFrame(
+        {
+            "postcode": postcodes,
+            "country": "England",
+            "latitude": rng.uniform(50.5, 53.5, len(postcodes)).round(6),
+            "longitude": rng.uniform(-2.5, 0.5, len(postcodes)).round(6),
+        }
+    )
+
+
+def create_tables(conn, workdir, pp_df, postcode_df, years):
+    curr = conn.cursor()
+    curr.execute("DROP VIEW IF EXISTS `housing_data`;")
+    access.initialize_pp_data_db(conn, years[0], years[-1])
+    access.initialize_postcode_data_db(conn)
+    access.initialize_prices_coordinates_data_db(conn, years[0], years[-1])
+    # bounding_extract_region_data reads housing_data
+    curr.execute("CREATE VIEW `housing_data` AS SELECT * FROM `prices_coordinates_data`;")
+    conn.commit()
+
+    pp_df.to_csv(os.path.join(workdir, "pp_bench.csv"), index=False)
+    postcode_df.to_csv(os.path.join(workdir, "postcode_bench.csv"), index=False)
+    access.load_csv_data_into_db(conn, "pp_bench.csv", "pp_data")
+    access.load_csv_data_into_db(conn, "postcode_bench.csv", "postcode_data")
+
+
+def timed(label, fn, *args):
+    start = time.perf_counter()
+    fn(*args)
+    elapsed = time.perf_counter() - start
+    return label, elapsed
+
+
+def run_backend(conn, years):
+    def aggregate():
+        curr = conn.cursor()
+        curr.execute(aggregate_query)
+        curr.fetchall()
+
+    results = [
+        timed(f"price/postcode join {years[0]}-{years[-1]}", lambda: [access.housing_upload_join_data(conn, year) for year in years]),
+        timed("read_all_data", access.read_all_data, conn, "prices_coordinates_data"),
+        timed("get_null_counts", access.get_null_counts, conn, "prices_coordinates_data"),
+        timed("bounding_extract_region_data", access.bounding_extract_region_data, conn, "Cambridge", 52.2, 0.12, 0.2),
+        timed("aggregate by county/type/year", aggregate),
+    ]
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=500000)
+    parser.add_argument("--mysql", help="user:password@host:port/database of a scratch MariaDB")
+    args = parser.parse_args()
+
+    years = list(range(2015, 2025))
+    pp_df = synthetic.price_paid_rows(args.rows, years=(years[0], years[-1]))
+    postcode_df = postcode_frame(pp_df)
+
+    backends = {}
+    with tempfile.TemporaryDirectory() as workdir:
+        cwd = os.getcwd()
+        os.chdir(workdir)
+        try:
+            backends["duckdb"] = access.create_duckdb_connection(os.path.join(workdir, "bench.duckdb"))
+            if args.mysql:
+                credentials, location = args.mysql.rsplit("@", 1)
+                user, password = credentials.split(":", 1)
+                host_port, database = location.split("/", 1)
+                host, port = (host_port.split(":") + ["3306"])[:2]
+                backends["mariadb"] = access.create_connection(user, password, host, database, int(port))
+
+            timings = {}
+            for name, conn in backends.items():
+                create_tables(conn, workdir, pp_df, postcode_df, years)
+                timings[name] = dict(run_backend(conn, years))
+        finally:
+            os.chdir(cwd)
+
+    names = list(timings)
+    print(f"\n{args.rows} pp_data rows")
+    print(f"{'query':<36}" + "".join(f"{name + ' s':>12}" for name in names))
+    for label in timings[names[0]]:
+        print(f"{label:<36}" + "".join(f"{timings[name][label]:>12.3f}" for name in names))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+
+# Import time regression check. Runs each entry point in a fresh interpreter with
+# -X importtime and fails if it takes longer than its threshold or drags in a heavy
+# dependency it doesn't need.
+#   python benchmarks/bench_import.py [--repeat 5]
+
+import argparse
+import os
+import subprocess
+import sys
+
+heavy_modules = [
+    "pandas",
+    "numpy",
+    "osmnx",
+    "pymysql",
+    "requests",
+    "sklearn",
+    "scipy",
+    "statsmodels",
+    "seaborn",
+    "matplotlib",
+    "yaml",
+]
+
+# (statement, threshold in ms, heavy modules it is allowed to load)
+entry_points = [
+    ("import fynesse", 50, []),
+    ("import fynesse.access", 100, []),
+    ("import fynesse.assess", 150, []),
+    ("import fynesse.address", 150, []),
+    ("from fynesse import access; access.pymysql.connect", 300, ["pymysql"]),
+    ("from fynesse import access; access.config['data_url']", 150, ["yaml"]),
+    ("from fynesse import address; address.np.zeros", 400, ["numpy"]),
+]
+
+
+def import_time_ms(statement):
+    # importtime writes "import time: self | cumulative | name" lines to stderr,
+    # summing the top level entries gives the total import cost of the statement
+    check_loaded = (
+        f"import sys; {statement}; "
+        f"print(','.join(m for m in {heavy_modules!r} if m in sys.modules))"
+    )
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", check_loaded],
+        capture_output=True,
+        text=True,
+        cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    )
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr)
+
+    total_us = 0
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        if not name.startswith("  "):
+            total_us += int(cumulative)
+    loaded = [m for m in result.stdout.strip().split(",") if m]
+    return total_us / 1000, loaded
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    failures = []
+    print(f"{'statement':<60} {'best ms':>8} {'limit':>6}  heavy modules loaded")
+    for statement, threshold_ms, allowed in entry_points:
+        runs = [import_time_ms(statement) for _ in range(args.repeat)]
+        best_ms = min(ms for ms, _ in runs)
+        loaded = runs[0][1]
+        print(f"{statement:<60} {best_ms:>8.1f} {threshold_ms:>6}  {', '.join(loaded)}")
+
+        if best_ms > threshold_ms:
+            failures.append(f"{statement}: {best_ms:.1f}ms > {threshold_ms}ms")
+        unexpected = [m for m in loaded if m not in allowed]
+        if unexpected:
+            failures.append(f"{statement}: imported {', '.join(unexpected)}")
+
+    if failures:
+        print("\n".join(["", "FAILED:"] + failures))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
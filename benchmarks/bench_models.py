@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+
+# Compares fit and predict throughput of the random forest and the histogram based
+# boosted model on a synthetic OA-sized feature matrix.
+#   python benchmarks/bench_models.py --rows 50000 190000
+
+import argparse
+import time
+
+import numpy as np
+
+import synthetic
+
+from fynesse import address
+
+
+def time_call(fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, nargs="+", default=[20000, 190000])
+    parser.add_argument("--n-estimators", type=int, default=100)
+    args = parser.parse_args()
+
+    print(f"{'rows':>8} {'model':>24} {'fit s':>8} {'fit rows/s':>12} {'predict rows/s':>15}")
+    for num_rows in args.rows:
+        df = synthetic.feature_frame(synthetic.output_area_coordinates(num_rows))
+        feature_matrix, build_s = time_call(address.build_feature_matrix, df)
+        y = df["STUDENT_POP"].to_numpy(dtype=np.float32)
+        print(f"{num_rows:>8} {'build_feature_matrix':>24} {build_s:>8.3f}")
+
+        for model_type, params in [
+            ("random_forest", {"n_estimators": args.n_estimators}),
+            ("hist_gradient_boosting", {"max_iter": args.n_estimators}),
+        ]:
+            model = address.make_model(model_type, **params)
+            _, fit_s = time_call(model.fit, feature_matrix, y)
+            _, predict_s = time_call(model.predict, feature_matrix)
+            print(
+                f"{num_rows:>8} {model_type:>24} {fit_s:>8.3f} "
+                f"{num_rows / fit_s:>12.0f} {num_rows / predict_s:>15.0f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+
+# Shows partition pruning for the per-year join in housing_upload_join_data on a
+# scratch MariaDB: loads synthetic pp_data into the year partitioned table from
+# access.initialize_pp_data_db and into an unpartitioned copy, then prints the
+# EXPLAIN plan and timing of the same join against both.
+#   python benchmarks/bench_partitions.py --mysql user:password@host:3306/database --rows 2000000
+
+import argparse
+import os
+import tempfile
+import time
+
+import synthetic
+from bench_backends import postcode_frame
+
+from fynesse import access
+
+
+def explain(conn, query):
+    curr = conn.cursor()
+    try:
+        curr.execute("EXPLAIN PARTITIONS " + query)
+    except Exception:
+        # MySQL 8 dropped the PARTITIONS keyword and always shows the column
+        curr.execute("EXPLAIN " + query)
+    names = [col[0] for col in curr.description]
+    return [dict(zip(names, row)) for row in curr.fetchall()]
+
+
+def time_query(conn, query, repeat):
+    times = []
+    for _ in range(repeat):
+        curr = conn.cursor()
+        start = time.perf_counter()
+        curr.execute(query)
+        rows = curr.fetchall()
+        times.append(time.perf_counter() - start)
+    return len(rows), min(times)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--mysql", required=True, help="user:password@host:port/database of a scratch MariaDB")
+    parser.add_argument("--rows", type=int, default=1000000)
+    parser.add_argument("--year", type=int, default=2020)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    credentials, location = args.mysql.rsplit("@", 1)
+    user, password = credentials.split(":", 1)
+    host_port, database = location.split("/", 1)
+    host, port = (host_port.split(":") + ["3306"])[:2]
+    conn = access.create_connection(user, password, host, database, int(port))
+
+    years = list(range(2015, 2025))
+    pp_df = synthetic.price_paid_rows(args.rows, years=(years[0], years[-1]))
+
+    with tempfile.TemporaryDirectory() as workdir:
+        cwd = os.getcwd()
+        os.chdir(workdir)
+        try:
+            access.initialize_pp_data_db(conn, years[0], years[-1])
+            access.initialize_postcode_data_db(conn)
+            pp_df.to_csv("pp_bench.csv", index=False)
+            postcode_frame(pp_df).to_csv("postcode_bench.csv", index=False)
+            access.load_csv_data_into_db(conn, "pp_bench.csv", "pp_data")
+            access.load_csv_data_into_db(conn, "postcode_bench.csv", "postcode_data")
+        finally:
+            os.chdir(cwd)
+
+    curr = conn.cursor()
+    curr.execute("DROP TABLE IF EXISTS `pp_data_unpartitioned`;")
+    curr.execute("CREATE TABLE `pp_data_unpartitioned` LIKE `pp_data`;")
+    curr.execute("ALTER TABLE `pp_data_unpartitioned` REMOVE PARTITIONING;")
+    curr.execute("INSERT INTO `pp_data_unpartitioned` SELECT * FROM `pp_data`;")
+    curr.execute("ANALYZE TABLE `pp_data`, `pp_data_unpartitioned`, `postcode_data`;")
+    curr.fetchall()
+    conn.commit()
+
+    print(f"{args.rows} pp_data rows, join for {args.year}\n")
+    for table in ["pp_data", "pp_data_unpartitioned"]:
+        query = access.housing_join_query(args.year, pp_table=table)
+        print(table)
+        for step in explain(conn, query):
+            print(
+                f"  {str(step.get('table')):<14} partitions={step.get('partitions')} "
+                f"type={step.get('type')} key={step.get('key')} rows={step.get('rows')}"
+            )
+        num_rows, elapsed = time_query(conn, query, args.repeat)
+        print(f"  {num_rows} rows in {elapsed:.3f} s\n")
+
+    curr.execute("DROP TABLE `pp_data_unpartitioned`;")
+    conn.commit()
+
+
+if __name__ == "__main__":
+    main()
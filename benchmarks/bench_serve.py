@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+
+# Load generator for the prediction service (fynesse.service): serves a model
+# trained on synthetic OA features in process and fires single point requests from
+# many concurrent keep-alive clients, once per batching setting, reporting
+# throughput and client side latency percentiles.
+#   python benchmarks/bench_serve.py --areas 190000 --clients 64 --requests 20000
+#   python benchmarks/bench_serve.py --url http://127.0.0.1:8080   # an already running fynesse-serve
+
+import argparse
+import asyncio
+import json
+import time
+from urllib.parse import urlparse
+
+import numpy as np
+
+import synthetic
+
+from fynesse import address, service
+
+
+async def client(host, port, points, latencies):
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        for lat, lon in points:
+            body = json.dumps({"lat": lat, "lon": lon}).encode()
+            start = time.perf_counter()
+            writer.write(
+                f"POST /predict HTTP/1.1\r\nHost: {host}\r\nContent-Type: application/json\r\n"
+                f"Content-Length: {len(body)}\r\n\r\n".encode()
+                + body
+            )
+            await writer.drain()
+            await reader.readline()
+            length = 0
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b""):
+                    break
+                if line.lower().startswith(b"content-length:"):
+                    length = int(line.split(b":")[1])
+            await reader.readexactly(length)
+            latencies.append(time.perf_counter() - start)
+    finally:
+        writer.close()
+
+
+async def generate_load(host, port, points, num_clients):
+    latencies = []
+    start = time.perf_counter()
+    await asyncio.gather(
+        *(client(host, port, points[i::num_clients], latencies) for i in range(num_clients))
+    )
+    return time.perf_counter() - start, np.array(latencies) * 1000
+
+
+def report(label, elapsed, latencies_ms):
+    p50, p90, p99 = np.percentile(latencies_ms, [50, 90, 99])
+    print(
+        f"{label:>28} {len(latencies_ms) / elapsed:>10.0f} {p50:>8.2f} {p90:>8.2f} {p99:>8.2f}"
+    )
+
+
+async def bench_local(args, points):
+    areas = synthetic.output_area_coordinates(args.areas)
+    df = synthetic.feature_frame(areas)
+    model = address.make_model("random_forest", n_estimators=args.n_estimators, max_depth=12)
+    model.fit(address.build_feature_matrix(df), df["STUDENT_POP"].to_numpy(dtype=np.float32))
+    predictor = service.Predictor.from_frame(model, df)
+
+    for max_batch_size, max_wait_ms in [(1, 0.0)] + [(args.max_batch_size, wait) for wait in args.max_wait_ms]:
+        svc = service.PredictionService(predictor, max_batch_size, max_wait_ms)
+        port = await svc.start("127.0.0.1", 0)
+        try:
+            elapsed, latencies_ms = await generate_load("127.0.0.1", port, points, args.clients)
+        finally:
+            await svc.stop()
+        label = "unbatched" if max_batch_size == 1 else f"batch<={max_batch_size} wait {max_wait_ms:g}ms"
+        report(label, elapsed, latencies_ms)
+        print(f"{'':>28} mean batch {svc.batcher.batch_sizes.to_dict()['mean']:.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--areas", type=int, default=synthetic.scales["medium"])
+    parser.add_argument("--requests", type=int, default=5000)
+    parser.add_argument("--clients", type=int, default=64)
+    parser.add_argument("--n-estimators", type=int, default=50)
+    parser.add_argument("--max-batch-size", type=int, default=256)
+    parser.add_argument("--max-wait-ms", type=float, nargs="+", default=[1.0, 5.0])
+    parser.add_argument("--url", help="load an already running service instead")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    south, north, west, east = synthetic.uk_bounds
+    points = list(zip(rng.uniform(south, north, args.requests), rng.uniform(west, east, args.requests)))
+
+    print(f"{args.requests} requests from {args.clients} clients")
+    print(f"{'':>28} {'req/s':>10} {'p50 ms':>8} {'p90 ms':>8} {'p99 ms':>8}")
+    if args.url:
+        url = urlparse(args.url)
+        report(args.url, *asyncio.run(generate_load(url.hostname, url.port or 80, points, args.clients)))
+    else:
+        asyncio.run(bench_local(args, points))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+
+# Times the fynesse hot paths on synthetic data at a few scales.
+#   python benchmarks/run_benchmarks.py --scale small medium
+#   python benchmarks/run_benchmarks.py --scale medium --baseline benchmarks/results/medium-<time>.json
+#
+# OSM is answered by synthetic.StubOSM and the database by a sqlite stand-in, so only
+# the client side work is measured. Each run is written to benchmarks/results/ and,
+# with --baseline, compared to an earlier run (exit code 1 on a regression).
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+import synthetic
+from sqlite_standin import StandInConnection
+
+from fynesse import access, address
+
+results_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+
+# create_osm_data does a bbox query per output area, cap it so large runs finish
+max_osm_areas = 5000
+num_predict_queries = 1000
+
+
+def time_repeated(fn, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return {"min_s": min(times), "median_s": statistics.median(times)}
+
+
+def load_table(conn, initialize, df, csv_file_name, index=False):
+    df.to_csv(csv_file_name, index=index)
+    # the initialize_* loaders read fixed file names from the working directory
+    initialize(conn)
+
+
+def bench_k_means(areas, repeat):
+    data_np = areas[["LAT", "LONG"]].to_numpy()
+    return len(areas), time_repeated(lambda: address.k_means(data_np, k=8), repeat)
+
+
+def bench_predict(areas, repeat):
+    features = synthetic.feature_frame(areas)
+    model = address.make_model("random_forest", n_estimators=20)
+    model.fit(address.build_feature_matrix(features), features["STUDENT_POP"])
+    tree = address.get_coordinates_and_ball_tree(features)
+    feature_matrix = address.build_feature_matrix(features)
+    queries = areas[["LAT", "LONG"]].to_numpy()[:num_predict_queries]
+
+    def run():
+        for lat, lon in queries:
+            address.predict(lat, lon, model, features, tree, feature_matrix=feature_matrix)
+
+    return len(queries), time_repeated(run, repeat)
+
+
+def bench_get_null_counts(areas, repeat):
+    conn = StandInConnection()
+    joined = areas.merge(synthetic.student_data(areas).reset_index(), on="OA21CD")
+    load_table(
+        conn,
+        access.initialize_census_student_coordinates_join_db,
+        joined,
+        "census_student_coordinates_join.csv",
+    )
+    return len(joined), time_repeated(
+        lambda: access.get_null_counts(conn, "census_student_coordinates_join"), repeat
+    )
+
+
+def bench_osm_tag_counts(areas, repeat):
+    areas = areas.iloc[:max_osm_areas]
+    conn = StandInConnection(dict_rows=True)
+    joined = areas.merge(synthetic.student_data(areas).reset_index(), on="OA21CD")
+    load_table(
+        conn,
+        access.initialize_census_student_coordinates_join_db,
+        joined,
+        "census_student_coordinates_join.csv",
+    )
+    with synthetic.StubOSM(synthetic.pois(areas)):
+        return len(areas), time_repeated(lambda: access.create_osm_data(conn), repeat)
+
+
+def bench_create_proficiency(areas, repeat):
+    synthetic.proficiency_in_english(areas).to_csv("proficiency_in_english.csv", index=False)
+    return len(areas), time_repeated(lambda: access.create_proficiency(None), repeat)
+
+
+def bench_csv_load(areas, repeat):
+    conn = StandInConnection()
+    synthetic.student_data(areas).to_csv("student_data.csv")
+    return len(areas), time_repeated(
+        lambda: access.initialize_census_student_pop_db(conn), repeat
+    )
+
+
+benchmarks = {
+    "k_means": bench_k_means,
+    "predict": bench_predict,
+    "get_null_counts": bench_get_null_counts,
+    "osm_tag_counts": bench_osm_tag_counts,
+    "create_proficiency": bench_create_proficiency,
+    "csv_load": bench_csv_load,
+}
+
+
+def compare(run, baseline, tolerance):
+    regressions = []
+    print(f"\n{'scale':<8} {'benchmark':<20} {'baseline s':>11} {'now s':>9} {'ratio':>7}")
+    for scale, scale_results in run["results"].items():
+        for name, result in scale_results.items():
+            before = baseline["results"].get(scale, {}).get(name)
+            if before is None:
+                continue
+            ratio = result["min_s"] / before["min_s"]
+            flag = "  REGRESSION" if ratio > 1 + tolerance else ""
+            print(f"{scale:<8} {name:<20} {before['min_s']:>11.4f} {result['min_s']:>9.4f} {ratio:>7.2f}{flag}")
+            if flag:
+                regressions.append(f"{scale}/{name}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--scale", nargs="+", default=["small"], choices=list(synthetic.scales))
+    parser.add_argument("--only", nargs="+", choices=list(benchmarks))
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--baseline", help="earlier results json to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed slowdown vs the baseline")
+    parser.add_argument("--output", help="where to write the results json")
+    args = parser.parse_args()
+
+    run = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "numpy": np.__version__,
+        "results": {},
+    }
+    cwd = os.getcwd()
+    print(f"{'scale':<8} {'benchmark':<20} {'rows':>8} {'min s':>9} {'median s':>9}")
+    for scale in args.scale:
+        areas = synthetic.output_area_coordinates(synthetic.scales[scale])
+        run["results"][scale] = {}
+        for name in args.only or benchmarks:
+            with tempfile.TemporaryDirectory() as workdir:
+                os.chdir(workdir)
+                try:
+                    rows, timing = benchmarks[name](areas, args.repeat)
+                finally:
+                    os.chdir(cwd)
+            run["results"][scale][name] = {"rows": rows, **timing}
+            print(f"{scale:<8} {name:<20} {rows:>8} {timing['min_s']:>9.4f} {timing['median_s']:>9.4f}")
+
+    output = args.output
+    if output is None:
+        os.makedirs(results_dir, exist_ok=True)
+        output = os.path.join(results_dir, f"{'-'.join(args.scale)}-{run['timestamp'].replace(':', '')}.json")
+    with open(output, "w") as file:
+        json.dump(run, file, indent=2)
+    print(f"\nResults written to {output}")
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            regressions = compare(run, json.load(file), args.tolerance)
+        if regressions:
+            print("Regressions: " + ", ".join(regressions))
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+# A sqlite3 connection that accepts the MariaDB dialect access.py sends
+# (backticks, %s parameters, table options, SHOW COLUMNS, LOAD DATA LOCAL INFILE),
+# so the access functions can be benchmarked without a database server.
+# Timings are only comparable run to run, not to MariaDB.
+
+import csv
+import re
+import sqlite3
+
+_load_data = re.compile(
+    r"LOAD DATA LOCAL INFILE\s+['\"](?P<path>[^'\"]+)['\"]\s+INTO TABLE\s+`?(?P<table>\w+)`?"
+    r".*?(IGNORE\s+(?P<ignore>\d+)\s+LINES)?\s*;?\s*$",
+    re.IGNORECASE | re.DOTALL,
+)
+_show_columns = re.compile(r"SHOW COLUMNS FROM\s+`?(?P<table>\w+)`?", re.IGNORECASE)
+_skipped = re.compile(r"^\s*(SET|USE|ALTER TABLE)\b", re.IGNORECASE)
+
+
+def translate(query):
+    query = re.sub(r"COLLATE\s+\w+", "", query, flags=re.IGNORECASE)
+    query = re.sub(r"\)\s*DEFAULT CHARSET=\w+.*$", ");", query, flags=re.IGNORECASE | re.DOTALL)
+    query = re.sub(r"\bunsigned\b", "", query, flags=re.IGNORECASE)
+    query = re.sub(r"\bbigint\(\d+\)", "INTEGER", query, flags=re.IGNORECASE)
+    return query.replace("%s", "?")
+
+
+class StandInCursor:
+    def __init__(self, conn, dict_rows):
+        self.conn = conn
+        self.cursor = conn.cursor()
+        self.dict_rows = dict_rows
+        self.rowcount = -1
+        self.description = None
+
+    def execute(self, query, args=None):
+        if _skipped.match(query):
+            return 0
+
+        match = _show_columns.search(query)
+        if match:
+            self.cursor.execute(f"SELECT name, type FROM pragma_table_info('{match['table']}')")
+            self.description = self.cursor.description
+            return 0
+
+        match = _load_data.search(query)
+        if match:
+            return self._load_data(match["path"], match["table"], int(match["ignore"] or 0))
+
+        self.cursor.execute(translate(query), args or ())
+        self.description = self.cursor.description
+        self.rowcount = self.cursor.rowcount
+        return self.rowcount
+
+    def _load_data(self, path, table, ignore_lines):
+        with open(path, newline="") as file:
+            reader = csv.reader(file)
+            for _ in range(ignore_lines):
+                next(reader, None)
+            rows = [[value if value != "" else None for value in row] for row in reader]
+        if rows:
+            placeholders = ", ".join("?" * len(rows[0]))
+            self.cursor.executemany(f"INSERT INTO `{table}` VALUES ({placeholders})", rows)
+        self.rowcount = len(rows)
+        return self.rowcount
+
+    def _convert(self, rows):
+        if not self.dict_rows or self.description is None:
+            return rows
+        names = [col[0] for col in self.description]
+        return [dict(zip(names, row)) for row in rows]
+
+    def fetchone(self):
+        row = self.cursor.fetchone()
+        return self._convert([row])[0] if row is not None else None
+
+    def fetchmany(self, size):
+        return self._convert(self.cursor.fetchmany(size))
+
+    def fetchall(self):
+        return self._convert(self.cursor.fetchall())
+
+    def close(self):
+        self.cursor.close()
+
+
+class StandInConnection:
+    """:param dict_rows: return rows as dicts, like a pymysql DictCursor connection"""
+
+    def __init__(self, path=":memory:", dict_rows=False):
+        self.conn = sqlite3.connect(path)
+        self.dict_rows = dict_rows
+
+    def cursor(self, cursorclass=None):
+        return StandInCursor(self.conn, self.dict_rows)
+
+    def commit(self):
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
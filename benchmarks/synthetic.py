@@ -0,0 +1,185 @@
+# Deterministic synthetic stand-ins for the datasets the pipeline works on, so the
+# hot paths can be benchmarked without nomis, overpass or a MariaDB server.
+# Every generator takes a size and a seed and returns the same frame for the same pair.
+
+import numpy as np
+import pandas as pd
+
+from fynesse import access
+
+# roughly the number of 2021 output areas in England and Wales
+scales = {"small": 2000, "medium": 20000, "large": 190000}
+
+# (south, north, west, east), roughly England and Wales
+uk_bounds = (50.0, 55.8, -5.7, 1.8)
+
+
+def output_area_coordinates(num_areas, seed=0):
+    """census_coordinates shaped rows: FID, OA21CD, LSOA21NM, LSOA21NMW, LAT, LONG.
+    Areas are clustered around a few hundred towns like the real centroids are."""
+    rng = np.random.default_rng(seed)
+    south, north, west, east = uk_bounds
+    num_towns = max(num_areas // 500, 1)
+    towns = np.column_stack(
+        [rng.uniform(south, north, num_towns), rng.uniform(west, east, num_towns)]
+    )
+    town = rng.integers(0, num_towns, num_areas)
+    lat = towns[town, 0] + rng.normal(0, 0.05, num_areas)
+    long = towns[town, 1] + rng.normal(0, 0.08, num_areas)
+    return pd.DataFrame(
+        {
+            "FID": np.arange(1, num_areas + 1),
+            "OA21CD": [f"E{i:08d}" for i in range(num_areas)],
+            "LSOA21NM": [f"Town {t} {i // 5:04d}" for i, t in enumerate(town)],
+            "LSOA21NMW": "",
+            "LAT": lat.round(5),
+            "LONG": long.round(5),
+        }
+    )
+
+
+def pois(areas, per_area=20, seed=0):
+    """Points of interest scattered around the output areas, with the tag columns
+    ox.geometries_from_bbox would return (NaN where a POI doesn't have the tag)."""
+    rng = np.random.default_rng(seed)
+    num_pois = len(areas) * per_area
+    centre = rng.integers(0, len(areas), num_pois)
+    df = pd.DataFrame(
+        {
+            "LAT": areas["LAT"].values[centre] + rng.normal(0, 0.004, num_pois),
+            "LONG": areas["LONG"].values[centre] + rng.normal(0, 0.006, num_pois),
+        }
+    )
+    for tag, fraction in zip(access.tags_to_keep, [0.6, 0.02, 0.1, 0.05, 0.2, 0.05, 0.4, 0.15]):
+        df[tag] = np.where(rng.random(num_pois) < fraction, "yes", None)
+    return df
+
+
+def census_wide_table(areas, seed=0):
+    """A TS062 (NS-SeC) shaped nomis table at OA level: date, geography,
+    geography code, a total column and nine category counts."""
+    rng = np.random.default_rng(seed)
+    counts = rng.poisson([30, 40, 25, 20, 15, 20, 25, 5, 30], size=(len(areas), 9))
+    df = pd.DataFrame(
+        {
+            "date": 2021,
+            "geography": areas["OA21CD"].values,
+            "geography code": areas["OA21CD"].values,
+            "total": counts.sum(axis=1),
+        }
+    )
+    for i, col in enumerate(["L1-L3", "L4-L6", "L7", "L8-L9", "L10-11", "L12", "L13", "L14.1-L14.2", "L15"]):
+        df[col] = counts[:, i]
+    return df
+
+
+def proficiency_in_english(areas, seed=0):
+    """Long format proficiency table as read by access.create_proficiency."""
+    rng = np.random.default_rng(seed)
+    codes = [-8, 1, 2, 3, 4, 5]
+    num_rows = len(areas) * len(codes)
+    observation = rng.poisson(20, num_rows)
+    # a few areas with nobody in category 1, as in the real data
+    observation[1::len(codes)][rng.random(len(areas)) < 0.01] = 0
+    return pd.DataFrame(
+        {
+            "Output Areas Code": np.repeat(areas["OA21CD"].values, len(codes)),
+            "Output Areas": np.repeat(areas["OA21CD"].values, len(codes)),
+            "Proficiency in English language (6 categories) Code": np.tile(codes, len(areas)),
+            "Proficiency in English language (6 categories)": "category",
+            "Observation": observation,
+        }
+    )
+
+
+def student_data(areas, seed=0):
+    """census_student_pop rows as written by access.create_census_student_pop."""
+    rng = np.random.default_rng(seed)
+    total = rng.integers(100, 600, len(areas))
+    students = rng.beta(1, 8, len(areas))
+    return pd.DataFrame(
+        {
+            "TOTAL_POP": (1 - students).round(2),
+            "STUDENT_POP": students.round(2),
+            "TOTAL_RAW_POP": total,
+        },
+        index=pd.Index(areas["OA21CD"].values, name="OA21CD"),
+    )
+
+
+def feature_frame(areas, seed=0):
+    """The OA level modelling frame: coordinates, OSM tag counts, population and target."""
+    rng = np.random.default_rng(seed)
+    df = areas[["FID", "OA21CD", "LAT", "LONG"]].copy()
+    for col in access.feature_cols[2:-1]:
+        df[col] = rng.poisson(5, len(areas))
+    df["TOTAL_RAW_POP"] = rng.integers(100, 600, len(areas))
+    df["STUDENT_POP"] = (
+        0.02 * df["amenity_count"] + 0.01 * df["building_count"] + rng.normal(0, 0.05, len(areas))
+    ).clip(0, 1)
+    return df
+
+
+def price_paid_rows(num_rows, seed=0, years=(2015, 2024)):
+    """Rows in the column order of the pp_data table."""
+    rng = np.random.default_rng(seed)
+    days = (pd.Timestamp(f"{years[1]}-12-31") - pd.Timestamp(f"{years[0]}-01-01")).days
+    dates = pd.Timestamp(f"{years[0]}-01-01") + pd.to_timedelta(rng.integers(0, days, num_rows), unit="D")
+    areas = np.array(["CB", "OX", "NG", "CR", "KT", "TR", "SW", "WC", "EC", "M"])
+    postcodes = [
+        f"{a}{d} {s}{u}"
+        for a, d, s, u in zip(
+            areas[rng.integers(0, len(areas), num_rows)],
+            rng.integers(1, 30, num_rows),
+            rng.integers(1, 9, num_rows),
+            np.array(["AA", "AB", "BD", "ZZ"])[rng.integers(0, 4, num_rows)],
+        )
+    ]
+    return pd.DataFrame(
+        {
+            "transaction_unique_identifier": [f"{{{i:032X}}}" for i in range(num_rows)],
+            "price": rng.lognormal(12.5, 0.6, num_rows).astype(int),
+            "date_of_transfer": dates.strftime("%Y-%m-%d %H:%M"),
+            "postcode": postcodes,
+            "property_type": np.array(list("DSTFO"))[rng.integers(0, 5, num_rows)],
+            "new_build_flag": np.array(list("YN"))[rng.integers(0, 2, num_rows)],
+            "tenure_type": np.array(list("FL"))[rng.integers(0, 2, num_rows)],
+            "primary_addressable_object_name": rng.integers(1, 200, num_rows).astype(str),
+            "secondary_addressable_object_name": "",
+            "street": "HIGH STREET",
+            "locality": "",
+            "town_city": "TOWN",
+            "district": "DISTRICT",
+            "county": np.array(["CAMBRIDGESHIRE", "OXFORDSHIRE", "NOTTINGHAMSHIRE", "SURREY"])[
+                rng.integers(0, 4, num_rows)
+            ],
+            "ppd_category_type": "A",
+            "record_status": "A",
+        }
+    )
+
+
+class StubOSM:
+    """Replaces the osmnx calls made by access, answering bbox queries from a POI frame
+    instead of overpass. Use as `with StubOSM(pois_df): ...`."""
+
+    def __init__(self, pois_df):
+        self.pois = pois_df.sort_values("LAT").reset_index(drop=True)
+        self.lat = self.pois["LAT"].values
+        self.calls = 0
+
+    def geometries_from_bbox(self, north, south, east, west, tags):
+        self.calls += 1
+        lo, hi = np.searchsorted(self.lat, [south, north])
+        window = self.pois.iloc[lo:hi]
+        window = window[(window["LONG"] >= west) & (window["LONG"] <= east)]
+        return window.drop(columns=["LAT", "LONG"]).dropna(axis=1, how="all")
+
+    def __enter__(self):
+        self.original = access.ox
+        access.ox = self
+        return self
+
+    def __exit__(self, *exc):
+        access.ox = self.original
+        return False
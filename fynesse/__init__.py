@@ -1,2 +1,15 @@
-from . import access
-from . import assess
+import importlib
+
+# submodules are imported on first use (fynesse.access, ...) so that importing
+# fynesse doesn't pull in every heavy dependency up front
+_submodules = ["access", "assess", "address", "feature_store", "pipeline", "poi_grid", "price_paid", "query_cache", "rollups", "service"]
+
+
+def __getattr__(name):
+    if name in _submodules:
+        return importlib.import_module(f".{name}", __name__)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_submodules))
@@ -1,15 +1,29 @@
 from .config import *
+from .lazy import lazy_import
+from . import columnar, instrument, query_cache, schema
 
-import pandas as pd
-import osmnx as ox
-import pymysql
-import requests
+import contextlib
 import csv
+import shutil
+import tempfile
+import threading
 import warnings
+import weakref
 import zipfile
 import io
-
-from tqdm import tqdm
+import json
+import math
+import pickle
+import time
+import uuid
+
+# heavy dependencies only load when a function first uses them
+pd = lazy_import("pandas")
+np = lazy_import("numpy")
+ox = lazy_import("osmnx")
+pymysql = lazy_import("pymysql")
+pa = lazy_import("pyarrow")
+requests = lazy_import("requests")
 
 feature_cols = [
     "LAT",
@@ -88,22 +102,363 @@ def initialize_db(conn, name_of_database):
     # return conn?
 
 
-def load_csv_data_into_db(conn, csv_file_name, table_name):
-    curr = conn.cursor()
+# Each load through the functions below bumps the loaded table's counter in
+# table_versions, so anything derived from a table (e.g. the feature store) can
+# tell whether it is stale without rescanning it.
+def _create_table_versions(curr):
+    curr.execute(
+        """
+        CREATE TABLE IF NOT EXISTS `table_versions` (
+        `table_name` VARCHAR(64) NOT NULL,
+        `version` BIGINT NOT NULL,
+        PRIMARY KEY (`table_name`)
+        ) DEFAULT CHARSET=utf8 COLLATE=utf8_bin;
+    """.replace(
+            "\n", " "
+        )
+    )
 
+
+def bump_table_version(conn, table_name):
+    curr = conn.cursor()
+    _create_table_versions(curr)
     curr.execute(
-        f"""
-        LOAD DATA LOCAL INFILE "./{csv_file_name}"
-        INTO TABLE `{table_name}`
-        FIELDS TERMINATED BY ','
-        OPTIONALLY ENCLOSED BY '"'
-        LINES TERMINATED BY '\n'
-        IGNORE 1 LINES;
+        "SELECT `version` FROM `table_versions` WHERE `table_name` = %s;", (table_name,)
+    )
+    row = curr.fetchone()
+    if row is None:
+        version = 1
+        curr.execute(
+            "INSERT INTO `table_versions` (`table_name`, `version`) VALUES (%s, %s);",
+            (table_name, version),
+        )
+    else:
+        version = (row["version"] if isinstance(row, dict) else row[0]) + 1
+        curr.execute(
+            "UPDATE `table_versions` SET `version` = %s WHERE `table_name` = %s;",
+            (version, table_name),
+        )
+    conn.commit()
+    return version
+
+
+def get_table_versions(conn, table_names, create=True):
+    """{table: {"version": load counter, "rows": row count}} for each table.
+    The row count catches tables loaded without going through the loaders.
+    :param create: create table_versions if it is missing, otherwise only read (every
+        version is 0 without it), e.g. on a read-only connection
     """
-    )  # need to ignore first line(s) because it seems to include column names for some reason??
+    curr = conn.cursor()
+    if create:
+        _create_table_versions(curr)
+        conn.commit()
+        has_versions = True
+    else:
+        try:
+            curr.execute("SELECT 1 FROM `table_versions` LIMIT 1;")
+            curr.fetchall()
+            has_versions = True
+        except Exception:
+            has_versions = False
+    versions = {}
+    for table_name in table_names:
+        row = None
+        if has_versions:
+            curr.execute(
+                "SELECT `version` FROM `table_versions` WHERE `table_name` = %s;", (table_name,)
+            )
+            row = curr.fetchone()
+        curr.execute(f"SELECT COUNT(*) FROM `{table_name}`;")
+        count = curr.fetchone()
+        versions[table_name] = {
+            "version": 0 if row is None else int(row["version"] if isinstance(row, dict) else row[0]),
+            "rows": int(list(count.values())[0] if isinstance(count, dict) else count[0]),
+        }
+    return versions
+
+
+# write_csv checks schema.table_rules on each chunk it writes and leaves the report
+# beside the CSV, so the load reports it (with the server's warnings) without
+# reading the file again. CSVs from elsewhere are checked chunk by chunk at load.
+def _validation_path(csv_file_name):
+    return f"{csv_file_name}.validation.json"
+
+
+def _save_validation(csv_file_name, report):
+    stat = os.stat(csv_file_name)
+    with open(_validation_path(csv_file_name), "w") as file:
+        json.dump({"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "report": report.to_dict()}, file)
+
+
+def _saved_validation(csv_file_name, table_name):
+    path = _validation_path(csv_file_name)
+    if not os.path.exists(path):
+        return None
+    with open(path) as file:
+        saved = json.load(file)
+    stat = os.stat(csv_file_name)
+    if (saved["size"], saved["mtime_ns"]) != (stat.st_size, stat.st_mtime_ns) or saved["report"]["table_name"] != table_name:
+        # the CSV changed since write_csv checked it
+        return None
+    return schema.ValidationReport.from_dict(saved["report"])
+
+
+@instrument.instrumented()
+def validate_csv(csv_file_name, table_name, header=True, chunksize=100000):
+    """Check a CSV against table_name's rules in chunks, matching columns by position."""
+    report = schema.ValidationReport(table_name)
+    for chunk in pd.read_csv(
+        csv_file_name, header=None, skiprows=1 if header else 0, dtype=str, keep_default_na=False, chunksize=chunksize
+    ):
+        instrument.rows_in(len(chunk))
+        report.check(chunk)
+    return report
+
+
+@instrument.instrumented()
+def write_csv(df, csv_file_name, table_name, index=False, header=True, chunksize=100000):
+    """df.to_csv for a file that is loaded into table_name, checking the table's rules
+    on each chunk as it is written.
+    :return: schema.ValidationReport, also printed if any rule failed
+    """
+    report = schema.ValidationReport(table_name)
+    for start in range(0, max(len(df), 1), chunksize):
+        chunk = df.iloc[start:start + chunksize]
+        # the index is written as the first column, which LOAD DATA fills in first
+        report.check(chunk.reset_index() if index else chunk)
+        chunk.to_csv(csv_file_name, index=index, header=header and start == 0, mode="w" if start == 0 else "a")
+    instrument.rows_out(report.rows)
+    _save_validation(csv_file_name, report)
+    if not report.ok:
+        print(report.summary())
+    return report
+
+
+def _is_mariadb(conn):
+    # a pymysql connection, not DuckDB or another stand-in speaking the same interface
+    return type(conn).__module__.startswith("pymysql")
+
+
+def _collect_load_warnings(curr, report, max_warnings=10):
+    # MariaDB truncates or zeroes values it can't store and only says so in the
+    # warnings of the LOAD DATA statement itself, read them before anything else runs
+    curr.execute("SHOW COUNT(*) WARNINGS;")
+    report.load_warning_count = int(curr.fetchone()[0])
+    if report.load_warning_count:
+        curr.execute(f"SHOW WARNINGS LIMIT {int(max_warnings)};")
+        report.load_warnings = [tuple(row) for row in curr.fetchall()]
+
+
+def _infile_path(path):
+    # LOAD DATA LOCAL reads the file client side, any path works; forward slashes
+    # keep Windows paths from being read as escapes
+    return os.path.abspath(path).replace(os.sep, "/")
+
+
+@instrument.instrumented()
+def load_csv_data_into_db(conn, csv_file_name, table_name, validate=True):
+    """LOAD DATA a CSV with a header line into table_name.
+    :param csv_file_name: path of the CSV, relative to the working directory or absolute
+    :param validate: check schema.table_rules (from write_csv's report if the file came
+        from there) and collect the load warnings
+    :return: schema.ValidationReport, printed if anything was found
+    """
+    report = None
+    if validate:
+        report = _saved_validation(csv_file_name, table_name)
+        if report is None:
+            report = validate_csv(csv_file_name, table_name)
+    curr = conn.cursor()
+
+    try:
+        curr.execute(
+            f"""
+            LOAD DATA LOCAL INFILE "{_infile_path(csv_file_name)}"
+            INTO TABLE `{table_name}`
+            FIELDS TERMINATED BY ','
+            OPTIONALLY ENCLOSED BY '"'
+            LINES TERMINATED BY '\n'
+            IGNORE 1 LINES;
+        """
+        )  # need to ignore first line(s) because it seems to include column names for some reason??
+        instrument.rows_out(curr.rowcount)
+        if validate and _is_mariadb(conn):
+            _collect_load_warnings(curr, report)
+    finally:
+        # also when the load fails, the report usually says why
+        if report is not None and not report.ok:
+            print(report.summary())
     conn.commit()
+    bump_table_version(conn, table_name)
+    return report
+
+
+# load_frames_into_db streams DataFrames into a table without a CSV on disk. On
+# MariaDB the chunks are written as CSV into a named pipe that LOAD DATA LOCAL
+# INFILE reads while they are produced (pymysql only reads local files by name, so
+# a pipe is the in-memory stream). Where there are no named pipes, or the server
+# refuses LOCAL INFILE, the rows go in as batched multi-row INSERTs instead. DuckDB
+# scans each chunk in place. Anything a run does need on disk lives in its own
+# run_workspace, so concurrent runs don't overwrite each other's files.
+@contextlib.contextmanager
+def run_workspace(prefix="fynesse-"):
+    """A private temporary directory for one run's intermediate files, removed afterwards.
+    It is created under config workspace_dir, the system temp directory if unset."""
+    path = tempfile.mkdtemp(prefix=prefix, dir=config.get("workspace_dir"))
+    try:
+        yield path
+    finally:
+        shutil.rmtree(path, ignore_errors=True)
+
+
+def _frame_chunks(frames, chunksize, index):
+    # a DataFrame or an iterable of them (e.g. pd.read_csv(..., chunksize=...) or a
+    # generator), cut into chunks of at most chunksize rows with the table's columns
+    if isinstance(frames, pd.DataFrame):
+        frames = [frames]
+    for frame in frames:
+        if index:
+            frame = frame.reset_index()
+        for start in range(0, len(frame), chunksize):
+            yield frame.iloc[start:start + chunksize]
 
 
+def _checked(chunks, report):
+    for chunk in chunks:
+        if report is not None:
+            report.check(chunk)
+        yield chunk
+
+
+def _load_through_pipe(conn, chunks, table_name, workspace):
+    """LOAD DATA the chunks from a named pipe fed by a writer thread.
+    :return: rows loaded, or None if LOCAL INFILE was refused before any chunk was taken
+    """
+    pipe_path = os.path.join(workspace, f"{table_name}.pipe")
+    os.mkfifo(pipe_path)
+    lock = threading.Lock()
+    # started once the writer takes a chunk, cancelled if it must not
+    state = {"started": False, "cancelled": False}
+    failure = []
+
+    def feed():
+        try:
+            # blocks until the client opens the pipe to send it
+            with open(pipe_path, "w", encoding="utf-8", newline="") as pipe:
+                with lock:
+                    if state["cancelled"]:
+                        return
+                    state["started"] = True
+                for chunk in chunks:
+                    chunk.to_csv(pipe, header=False, index=False, na_rep="NULL", lineterminator="\n")
+        except BaseException as e:
+            failure.append(e)
+
+    def cancel():
+        with lock:
+            state["cancelled"] = not state["started"]
+            return state["cancelled"]
+
+    writer = threading.Thread(target=feed, name=f"load {table_name}", daemon=True)
+    writer.start()
+    curr = conn.cursor()
+    try:
+        # no escape character, so unquoted NULL is the missing value
+        curr.execute(
+            f"""
+            LOAD DATA LOCAL INFILE '{_infile_path(pipe_path)}'
+            INTO TABLE `{table_name}`
+            FIELDS TERMINATED BY ',' OPTIONALLY ENCLOSED BY '"' ESCAPED BY ''
+            LINES TERMINATED BY '\n';
+        """
+        )
+    except BaseException as e:
+        if not cancel():
+            conn.rollback()
+            raise
+        # the client never opened the pipe: open it here so the writer's open returns,
+        # it sees the cancellation and leaves the chunks alone
+        fd = os.open(pipe_path, os.O_RDONLY | os.O_NONBLOCK)
+        try:
+            writer.join()
+        finally:
+            os.close(fd)
+        # refused by the server, or by pymysql itself (RuntimeError when the
+        # connection's local_infile option is off)
+        if isinstance(e, (pymysql.err.MySQLError, RuntimeError)):
+            return None
+        raise
+    finally:
+        writer.join()
+    if failure:
+        # the pipe closed early, so the server loaded a prefix of the rows
+        conn.rollback()
+        raise failure[0]
+    return curr.rowcount
+
+
+def _insert_chunks(conn, chunks, table_name):
+    curr = conn.cursor()
+    rows = 0
+    for chunk in chunks:
+        placeholders = ", ".join(["%s"] * chunk.shape[1])
+        # python values with None for missing ones, which pymysql escapes; executemany
+        # sends them as multi-row INSERTs of up to max_stmt_length bytes each
+        values = chunk.astype(object).where(chunk.notna(), None)
+        curr.executemany(
+            f"INSERT INTO `{table_name}` VALUES ({placeholders});",
+            list(values.itertuples(index=False, name=None)),
+        )
+        rows += len(chunk)
+    return rows
+
+
+@instrument.instrumented()
+def load_frames_into_db(conn, frames, table_name, index=False, validate=True, method="auto", chunksize=100000):
+    """Load DataFrames into table_name without writing a CSV first.
+    :param frames: a DataFrame or an iterable of DataFrames (a generator is consumed once),
+        with the table's columns in order
+    :param index: load the index as the first column, as write_csv(index=True) would
+    :param validate: check schema.table_rules on each chunk on its way in
+    :param method: "auto", "pipe" (LOAD DATA LOCAL INFILE from a named pipe) or "insert"
+        (batched multi-row INSERTs); "auto" tries the pipe on MariaDB and falls back to INSERTs
+        if LOCAL INFILE is refused
+    :return: schema.ValidationReport if validate, printed if any rule failed
+    """
+    if method not in ("auto", "pipe", "insert"):
+        raise ValueError(f"Unknown load method {method}, expected auto, pipe or insert.")
+    report = schema.ValidationReport(table_name) if validate else None
+    chunks = _checked(_frame_chunks(frames, chunksize, index), report)
+
+    try:
+        if columnar.is_duckdb(conn):
+            curr = conn.cursor()
+            rows = sum(curr.insert_frame(table_name, chunk) for chunk in chunks)
+        else:
+            rows = None
+            # other stand-ins for pymysql (e.g. the benchmarks' sqlite one) take INSERTs
+            pipe = method == "pipe" or (method == "auto" and _is_mariadb(conn))
+            if pipe and hasattr(os, "mkfifo"):
+                with run_workspace() as workspace:
+                    rows = _load_through_pipe(conn, chunks, table_name, workspace)
+                if rows is not None and validate and _is_mariadb(conn):
+                    _collect_load_warnings(conn.cursor(), report)
+            elif method == "pipe":
+                raise ValueError("Named pipes aren't available here, use method='insert'.")
+            if rows is None:
+                if method == "pipe":
+                    raise ValueError("The server refused LOAD DATA LOCAL INFILE, use method='insert'.")
+                rows = _insert_chunks(conn, chunks, table_name)
+    finally:
+        if report is not None and not report.ok:
+            print(report.summary())
+    instrument.rows_out(rows)
+    conn.commit()
+    bump_table_version(conn, table_name)
+    return report
+
+
+@instrument.instrumented()
 def initialize_census_coordinates_db(conn):
     curr = conn.cursor()
 
@@ -125,10 +480,12 @@ def initialize_census_coordinates_db(conn):
     )
     curr.execute("""CREATE INDEX geography_code ON `census_coordinates` (`OA21CD`);""")
     conn.commit()
+    bump_table_version(conn, "census_coordinates")
 
     load_csv_data_into_db(conn, "census_data.csv", "census_coordinates")
 
 
+@instrument.instrumented()
 def initialize_census_student_pop_db(conn):
     curr = conn.cursor()
 
@@ -149,10 +506,12 @@ def initialize_census_student_pop_db(conn):
 
     curr.execute("""CREATE INDEX geography_code ON `census_student_pop` (`OA21CD`);""")
     conn.commit()
+    bump_table_version(conn, "census_student_pop")
 
     load_csv_data_into_db(conn, "student_data.csv", "census_student_pop")
 
 
+@instrument.instrumented()
 def initialize_census_student_coordinates_join_db(conn):
     curr = conn.cursor()
 
@@ -181,12 +540,14 @@ def initialize_census_student_coordinates_join_db(conn):
     )
 
     conn.commit()
+    bump_table_version(conn, "census_student_coordinates_join")
 
     load_csv_data_into_db(
         conn, "census_student_coordinates_join.csv", "census_student_coordinates_join"
     )
 
 
+@instrument.instrumented()
 def initialize_proficiency_db(conn):
     curr = conn.cursor()
 
@@ -213,10 +574,12 @@ def initialize_proficiency_db(conn):
         """CREATE INDEX local_authorities_code ON `proficiency` (`local_authorities_code`);"""
     )
     conn.commit()
+    bump_table_version(conn, "proficiency")
 
     load_csv_data_into_db(conn, "proficiency.csv", "proficiency")
 
 
+@instrument.instrumented()
 def initialize_osm_data_db(conn):
     curr = conn.cursor()
 
@@ -245,6 +608,7 @@ def initialize_osm_data_db(conn):
     curr.execute("""CREATE INDEX lat_long ON `osm_data` (`LAT`, `LONG`);""")
 
     conn.commit()
+    bump_table_version(conn, "osm_data")
 
     load_csv_data_into_db(conn, "osm_data.csv", "osm_data")
 
@@ -254,25 +618,171 @@ def initialize_osm_data_db(conn):
 """
 
 
-def read_all_data(conn, table_name):
+# connections known to have table_versions, so cached reads create it only once
+_table_versions_created = weakref.WeakSet()
+
+
+# table_versions also holds a random id for the database, as a row named
+# "#database:<id>", so databases whose counters happen to match (two :memory: ones,
+# or a database dropped and recreated) never share cache entries
+_database_id_prefix = "#database:"
+
+
+def _table_version_counters(conn, table_names):
+    """(database id, {table: load counter}) in one query, without get_table_versions' row counts."""
     curr = conn.cursor()
-    curr.execute(f"SELECT * FROM {table_name};")
-    return curr.fetchall()
+    if conn not in _table_versions_created:
+        _create_table_versions(curr)
+        conn.commit()
+        _table_versions_created.add(conn)
+    tables = f" OR `table_name` IN ({', '.join(['%s'] * len(table_names))})" if table_names else ""
+    curr.execute(
+        f"SELECT `table_name`, `version` FROM `table_versions` WHERE `table_name` LIKE %s{tables};",
+        [_database_id_prefix + "%"] + list(table_names),
+    )
+    versions = {table_name: 0 for table_name in table_names}
+    database_ids = []
+    for row in curr.fetchall():
+        table_name, version = row.values() if isinstance(row, dict) else row
+        if table_name.startswith(_database_id_prefix):
+            database_ids.append(table_name[len(_database_id_prefix):])
+        else:
+            versions[table_name] = int(version)
+    if not database_ids:
+        database_ids.append(uuid.uuid4().hex)
+        curr.execute(
+            "INSERT INTO `table_versions` (`table_name`, `version`) VALUES (%s, %s);",
+            (_database_id_prefix + database_ids[0], 0),
+        )
+        conn.commit()
+    # if two processes raced to create one, all of them settle on the same
+    return min(database_ids), versions
+
+
+def table_version(conn, table_name):
+    """The load counter of one table, without get_table_versions' row count."""
+    return _table_version_counters(conn, [table_name])[1][table_name]
+
+
+def _connection_id(conn):
+    """Where the connection's data lives, None for a database that doesn't outlive it."""
+    if columnar.is_duckdb(conn):
+        if conn.database == "" or conn.database.startswith(":memory:"):
+            return None
+        return f"duckdb:{os.path.abspath(conn.database)}"
+    db = conn.db.decode() if isinstance(conn.db, bytes) else conn.db
+    return f"mysql:{conn.host}:{conn.port}/{db}"
+
+
+def _cached_read(conn, query, compute, to_frame, from_frame):
+    # straight through unless query_cache.enable() was called
+    cache = query_cache.active()
+    if cache is None:
+        return compute()
+    database_id, versions = _table_version_counters(conn, query_cache.referenced_tables(query))
+    location = _connection_id(conn)
+    key = cache.key(f"{location}#{database_id}", query, None, versions)
+    # in-memory databases only get memory entries, their files would never be read again
+    return cache.get_or_compute(
+        key, lambda: _with_frame(compute(), to_frame), from_frame, persist=location is not None
+    )
 
 
-def calculate_number_of_rows(conn, table_name):
+def _with_frame(value, to_frame):
+    return value, to_frame(value)
+
+
+def _fetch_rows(conn, query):
     curr = conn.cursor()
-    curr.execute(f"SELECT COUNT(*) FROM {table_name};")
-    return curr.fetchall()
+    curr.execute(query)
+    return [col[0] for col in curr.description], curr.fetchall()
 
 
-def get_first_row(conn, table_name):
+def _arrow_column(values):
+    # an arrow column keeps the python types through parquet (nullable integers stay
+    # integers, Decimals stay Decimals), where numpy would turn them into floats
+    try:
+        return pd.arrays.ArrowExtensionArray(pa.array(values))
+    except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError):
+        # mixed values only ever live in memory, QueryCache can't write them
+        return pd.array(list(values), dtype=object)
+
+
+def _rows_frame(result):
+    columns, rows = result
+    dict_rows = len(rows) > 0 and isinstance(rows[0], dict)
+    if dict_rows:
+        values = [[row[column] for row in rows] for column in columns]
+    else:
+        values = list(zip(*rows)) or [[] for _ in columns]
+    frame = pd.DataFrame({i: _arrow_column(list(column)) for i, column in enumerate(values)})
+    frame.columns = columns
+    # parquet keeps the attrs, so a disk hit rebuilds what the cursor returned
+    frame.attrs["rows"] = "dict" if dict_rows else "tuple"
+    frame.attrs["container"] = "tuple" if isinstance(rows, tuple) else "list"
+    return frame
+
+
+def _frame_rows(frame):
+    # parquet may hand strings back as pandas' own string dtype, arrow reads both
+    values = [pa.array(frame.iloc[:, i].array, from_pandas=True).to_pylist() for i in range(frame.shape[1])]
+    columns = list(frame.columns)
+    rows = list(zip(*values))
+    if frame.attrs.get("rows") == "dict":
+        rows = [dict(zip(columns, row)) for row in rows]
+    return columns, tuple(rows) if frame.attrs.get("container") == "tuple" else rows
+
+
+@instrument.instrumented()
+def read_all_data(conn, table_name, limit=None):
+    query = f"SELECT * FROM {table_name}" + (f" LIMIT {int(limit)};" if limit is not None else ";")
+    _, rows = _cached_read(conn, query, lambda: _fetch_rows(conn, query), _rows_frame, _frame_rows)
+    instrument.rows_out(len(rows))
+    return rows
+
+
+def read_frame(conn, table_name=None, query=None, args=None, compact=True):
+    """Read a table (or query) into a DataFrame with named, compact columns (see schema.column_dtypes).
+    :param compact: False keeps the columns as the database returns them, e.g. for exports
+    """
+    if query is None:
+        query = f"SELECT * FROM {table_name};"
     curr = conn.cursor()
-    curr.execute(f"SELECT * FROM {table_name} LIMIT 1;")
-    return curr.fetchall()
+    curr.execute(query, args)
+    if columnar.is_duckdb(conn):
+        # straight from duckdb's columns, no python tuples in between
+        df = curr.fetch_df()
+    else:
+        columns = [col[0] for col in curr.description]
+        # works for tuple and dict cursors alike
+        df = pd.DataFrame.from_records(curr.fetchall(), columns=columns)
+    instrument.rows_out(len(df))
+    return schema.compact_frame(df) if compact else df
 
 
+def calculate_number_of_rows(conn, table_name):
+    query = f"SELECT COUNT(*) FROM {table_name};"
+    return _cached_read(conn, query, lambda: _fetch_rows(conn, query), _rows_frame, _frame_rows)[1]
+
+
+def get_first_row(conn, table_name):
+    query = f"SELECT * FROM {table_name} LIMIT 1;"
+    return _cached_read(conn, query, lambda: _fetch_rows(conn, query), _rows_frame, _frame_rows)[1]
+
+
+@instrument.instrumented()
 def get_null_counts(conn, table_name):
+    null_counts_df = _cached_read(
+        conn,
+        f"null counts FROM {table_name}",
+        lambda: _null_counts(conn, table_name),
+        lambda frame: frame,
+        lambda frame: frame,
+    )
+    return null_counts_df.transpose()
+
+
+def _null_counts(conn, table_name):
     # https://stackoverflow.com/questions/7831371/is-there-a-way-to-get-a-list-of-column-names-in-sqlite
     # using PRAGMA TO GET COLUMN NAMES
     curr = conn.cursor()
@@ -292,15 +802,141 @@ def get_null_counts(conn, table_name):
     curr.execute(f"SELECT COUNT(*) FROM {table_name};")
     total_row_count = curr.fetchone()[0]
 
-    null_counts_df = pd.DataFrame(
-        null_counts.items(), columns=["column_name", "null_counts"]
+    # the total goes in as one more (name, count) pair, a separate summary row
+    # doesn't line up with the transposed columns
+    return pd.DataFrame(
+        list(null_counts.items()) + [("total_element_count", total_row_count)],
+        columns=["column_name", "null_counts"],
     )
-    null_counts_df = null_counts_df.transpose()
 
-    summary_row = pd.DataFrame(
-        [["total_element_count", total_row_count]], columns=null_counts_df.columns
+
+def read_data_in_chunks(conn, table_name=None, query=None, args=None, chunksize=50000):
+    """Stream a table (or the result of a query) as DataFrames of at most chunksize rows.
+    Uses an unbuffered cursor so the client never holds the full result set.
+    """
+    if query is None:
+        query = f"SELECT * FROM {table_name};"
+    if columnar.is_duckdb(conn):
+        curr = conn.cursor()
+    else:
+        curr = conn.cursor(instrument.instrumented_cursor_class(pymysql.cursors.SSCursor))
+    try:
+        curr.execute(query, args)
+        columns = [col[0] for col in curr.description]
+        # the same types for every chunk, whatever values each one holds
+        dtypes = schema.fixed_dtypes()
+        while True:
+            rows = curr.fetchmany(chunksize)
+            if not rows:
+                break
+            instrument.rows_out(len(rows))
+            yield schema.compact_frame(pd.DataFrame.from_records(rows, columns=columns), dtypes)
+    finally:
+        curr.close()
+
+
+# strata that aren't plain columns: name -> (SQL expression, the same computed on a chunk)
+sample_strata = {
+    "year": ("YEAR(`date_of_transfer`)", lambda df: pd.to_datetime(df["date_of_transfer"]).dt.year),
+}
+
+sample_methods = ["server", "reservoir"]
+
+
+def _strata_sql(strata):
+    return ", ".join(sample_strata[name][0] if name in sample_strata else f"q.`{name}`" for name in strata)
+
+
+def _strata_keys(chunk, strata):
+    return pd.DataFrame(
+        {
+            name: sample_strata[name][1](chunk) if name in sample_strata else chunk[name].to_numpy()
+            for name in strata
+        },
+        index=chunk.index,
     )
-    return pd.concat([null_counts_df, summary_row])
+
+
+def _server_sample(conn, query, args, n, strata, seed):
+    query = query.strip().rstrip(";")
+    if strata:
+        # n rows per stratum, ranked by a seeded random order within each
+        order = "hash(q, %d)" % seed if columnar.is_duckdb(conn) else "RAND(%d)" % seed
+        return read_frame(
+            conn,
+            query=f"""
+            SELECT * FROM (
+              SELECT q.*, ROW_NUMBER() OVER (PARTITION BY {_strata_sql(strata)} ORDER BY {order}) AS `sample_rank`
+              FROM ({query}) AS q
+            ) AS ranked WHERE `sample_rank` <= {int(n)};
+            """,
+            args=args,
+        ).drop(columns="sample_rank")
+
+    if columnar.is_duckdb(conn):
+        return read_frame(
+            conn,
+            query=f"SELECT * FROM ({query}) AS q USING SAMPLE reservoir({int(n)} ROWS) REPEATABLE ({int(seed)});",
+            args=args,
+        )
+
+    # MariaDB: one scan keeping each row with a seeded probability a little over n / rows,
+    # then trimmed to n here. A LIMIT in SQL would favour rows early in the scan.
+    curr = conn.cursor()
+    curr.execute(f"SELECT COUNT(*) FROM ({query}) AS q;", args)
+    total = curr.fetchone()[0]
+    fraction = min(1.0, 1.1 * n / max(total, 1))
+    sample_df = read_frame(conn, query=f"SELECT * FROM ({query}) AS q WHERE RAND({int(seed)}) < {fraction};", args=args)
+    if len(sample_df) > n:
+        rng = np.random.default_rng(seed)
+        sample_df = sample_df.iloc[np.sort(rng.choice(len(sample_df), n, replace=False))].reset_index(drop=True)
+    return sample_df
+
+
+def _reservoir_sample(conn, query, args, n, strata, seed, chunksize):
+    # bottom-k sampling: every row gets a seeded uniform key and the n smallest keys
+    # (per stratum) are kept, which is a uniform sample without replacement. Memory
+    # stays at one chunk plus the reservoir.
+    rng = np.random.default_rng(seed)
+    kept = None
+    for chunk in read_data_in_chunks(conn, query=query, args=args, chunksize=chunksize):
+        chunk = chunk.assign(sample_key=rng.random(len(chunk)))
+        if strata:
+            chunk = pd.concat([chunk, _strata_keys(chunk, strata).add_prefix("stratum_")], axis=1)
+        combined = chunk if kept is None else pd.concat([kept, chunk], ignore_index=True)
+        if strata:
+            combined = combined.sort_values("sample_key", kind="stable")
+            kept = combined.groupby([f"stratum_{name}" for name in strata], dropna=False).head(n)
+        elif len(combined) > n:
+            kept = combined.iloc[np.argpartition(combined["sample_key"].to_numpy(), n)[:n]]
+        else:
+            kept = combined
+        kept = kept.reset_index(drop=True)
+    if kept is None:
+        return pd.DataFrame()
+    kept = kept.sort_values("sample_key", kind="stable").reset_index(drop=True)
+    return kept.drop(columns=["sample_key"] + [f"stratum_{name}" for name in strata or []])
+
+
+@instrument.instrumented()
+def read_sample(conn, table_name=None, query=None, args=None, n=100000, strata=None, method="server", seed=0, chunksize=50000):
+    """A reproducible random sample of a table (or query) of at most n rows, or n rows
+    per stratum, for exploring tables too big to read whole.
+    :param strata: columns to sample within, or names from sample_strata (e.g. "year")
+    :param method: "server" samples in SQL so only the sample crosses the wire,
+        "reservoir" streams every row through read_data_in_chunks and samples client side
+    :param seed: the same seed gives the same sample of an unchanged table
+    """
+    if method not in sample_methods:
+        raise ValueError(f"Unknown sample method {method}, expected one of {sample_methods}.")
+    if query is None:
+        query = f"SELECT * FROM {table_name};"
+    if method == "server":
+        sample_df = _server_sample(conn, query, args, n, strata, seed)
+    else:
+        sample_df = _reservoir_sample(conn, query, args, n, strata, seed, chunksize)
+    instrument.rows_out(len(sample_df))
+    return sample_df
 
 
 """
@@ -308,23 +944,30 @@ def get_null_counts(conn, table_name):
 """
 
 
+@instrument.instrumented()
 def create_census_student_pop():
-    download_census_data("TS062")
+    download_census_data("TS062", levels=[])
     student_df = get_student_data(
         [0, 2, 4, 5, 6, 7, 8, 9, 10, 11], ["TOTAL_POP", "STUDENT_POP"]
     )
-    student_df.to_csv("./student_data.csv")
+    instrument.rows_out(len(student_df))
+    write_csv(student_df, "student_data.csv", "census_student_pop", index=True)
 
 
+@instrument.instrumented()
 def create_student_coordinates_join(conn):
-    census_df = pd.DataFrame(read_all_data(conn, "census_coordinates"))
-    student_df = pd.DataFrame(read_all_data(conn, "census_student_pop"))
-    merged = census_df.merge(student_df, on="OA21CD")
-    merged.to_csv("./census_student_coordinates_join.csv", index=False)
+    census_df = read_frame(conn, "census_coordinates")
+    student_df = read_frame(conn, "census_student_pop")
+    merged = schema.merge_compact(census_df, student_df, on="OA21CD")
+    instrument.rows_in(len(census_df) + len(student_df))
+    instrument.rows_out(len(merged))
+    write_csv(merged, "census_student_coordinates_join.csv", "census_student_coordinates_join")
 
 
+@instrument.instrumented()
 def create_proficiency(conn):
     proficiency = pd.read_csv("./proficiency_in_english.csv")
+    instrument.rows_in(len(proficiency))
     filtered_proficiency_df = proficiency[
         ~proficiency["Proficiency in English language (6 categories) Code"].isin(
             [-8, 5]
@@ -350,13 +993,16 @@ def create_proficiency(conn):
     proficiency = proficiency[["Output Areas Code", "Output Areas", "proportion"]]
     proficiency = proficiency.drop_duplicates().reset_index(drop=True)
 
-    proficiency.to_csv("./proficiency.csv")
+    instrument.rows_out(len(proficiency))
+    write_csv(proficiency, "proficiency.csv", "proficiency", index=True)
 
 
+@instrument.instrumented()
 def create_osm_data(conn):
-    merged_census_df = pd.DataFrame(
-        read_all_data(conn, "census_student_coordinates_join")
-    )
+    from tqdm import tqdm
+
+    merged_census_df = read_frame(conn, "census_student_coordinates_join")
+    instrument.rows_in(len(merged_census_df))
 
     osm_tag_counts = []
     # merged_census_df = merged_census_df.sort_values(by=['LAT', 'LONG'])
@@ -391,8 +1037,12 @@ def create_osm_data(conn):
             )
         )
 
-    osm_counts_df = pd.concat(osm_tag_counts, ignore_index=True)
-    osm_counts_df.to_csv("./osm_data.csv", index=False)
+    osm_counts_df = schema.compact_frame(pd.concat(osm_tag_counts, ignore_index=True))
+    # the rows are built as {tag: count, FID, LAT, LONG}, LOAD DATA wants the table's order
+    osm_counts_df = osm_counts_df[["FID", "LAT", "LONG"] + tags_to_keep]
+    osm_counts_df.columns = schema.table_columns["osm_data"]
+    instrument.rows_out(len(osm_counts_df))
+    write_csv(osm_counts_df, "osm_data.csv", "osm_data")
 
 
 """
@@ -400,28 +1050,99 @@ def create_osm_data(conn):
 """
 
 
-def download_census_data(code, base_dir=""):
+# The nomis archives are kept on disk and members are read straight out of them, so
+# only the geography level that is asked for gets decompressed. OA level files are
+# by far the largest and are often not needed at all.
+
+
+def _census_zip_path(code, base_dir=""):
+    return os.path.join(base_dir, f"census2021-{code.lower()}.zip")
+
+
+def _download_census_zip(code, base_dir=""):
+    zip_path = _census_zip_path(code, base_dir)
+    if os.path.exists(zip_path):
+        return zip_path
+    if base_dir:
+        os.makedirs(base_dir, exist_ok=True)
+    # stream to disk rather than holding the archive in memory
+    url = f"https://www.nomisweb.co.uk/output/census/2021/census2021-{code.lower()}.zip"
+    with requests.get(url, stream=True) as response:
+        response.raise_for_status()
+        with open(zip_path + ".tmp", "wb") as file:
+            for block in response.iter_content(chunk_size=1 << 20):
+                file.write(block)
+    os.replace(zip_path + ".tmp", zip_path)
+    return zip_path
+
+
+def _census_member(archive, code, level):
+    suffix = f"census2021-{code.lower()}-{level}.csv"
+    for name in archive.namelist():
+        if name.lower().endswith(suffix):
+            return name
+    raise KeyError(f"No {level} level file for {code} in {archive.filename}.")
+
+
+@instrument.instrumented()
+def download_census_data(code, base_dir="", levels=None):
+    """Download a nomis census table archive and extract its CSVs.
+    :param levels: geography levels to extract, e.g. ["oa"]; every file when None,
+        none when empty (load_census_data reads them from the archive)
+    An already extracted directory is used as it is.
+    """
     url = f"https://www.nomisweb.co.uk/output/census/2021/census2021-{code.lower()}.zip"
     extract_dir = os.path.join(base_dir, os.path.splitext(os.path.basename(url))[0])
+    if levels is not None:
+        levels = list(levels)
 
-    if os.path.exists(extract_dir) and os.listdir(extract_dir):
+    if levels:
+        extracted = all(
+            os.path.exists(os.path.join(extract_dir, f"census2021-{code.lower()}-{level}.csv"))
+            for level in levels
+        )
+    else:
+        extracted = os.path.exists(extract_dir) and os.listdir(extract_dir)
+    if extracted:
         print(f"Files already exist at: {extract_dir}.")
         return
 
-    os.makedirs(extract_dir, exist_ok=True)
-    response = requests.get(url)
-    response.raise_for_status()
+    zip_path = _download_census_zip(code, base_dir)
+    if levels is not None and not levels:
+        return
 
-    with zipfile.ZipFile(io.BytesIO(response.content)) as zip_ref:
-        zip_ref.extractall(extract_dir)
+    with zipfile.ZipFile(zip_path) as archive:
+        if levels is None:
+            members = archive.namelist()
+        else:
+            members = [_census_member(archive, code, level) for level in levels]
+        members = [
+            member for member in members if not os.path.exists(os.path.join(extract_dir, member))
+        ]
+        if not members:
+            print(f"Files already exist at: {extract_dir}.")
+            return
+        os.makedirs(extract_dir, exist_ok=True)
+        for member in members:
+            archive.extract(member, extract_dir)
 
     print(f"Files extracted to: {extract_dir}")
 
 
-def load_census_data(code, level="msoa"):
-    return pd.read_csv(
-        f"census2021-{code.lower()}/census2021-{code.lower()}-{level}.csv"
+def load_census_data(code, level="msoa", base_dir="", **read_csv_kwargs):
+    """One geography level of a census table, from the extracted CSV if there is one,
+    otherwise parsed straight out of the archive (downloaded if missing)."""
+    path = os.path.join(
+        base_dir, f"census2021-{code.lower()}/census2021-{code.lower()}-{level}.csv"
     )
+    if os.path.exists(path):
+        return pd.read_csv(path, **read_csv_kwargs)
+
+    # the level isn't extracted, so the archive is needed whatever else is
+    zip_path = _download_census_zip(code, base_dir)
+    with zipfile.ZipFile(zip_path) as archive:
+        with archive.open(_census_member(archive, code, level)) as file:
+            return pd.read_csv(file, **read_csv_kwargs)
 
 
 def get_student_data(columns_to_drop, column_names):
@@ -434,7 +1155,89 @@ def get_student_data(columns_to_drop, column_names):
     student_raw_total_pop = student_df["TOTAL_POP"]
     student_df = student_df.div(student_df.sum(axis=1), axis=0)
     student_df["TOTAL_RAW_POP"] = student_raw_total_pop
-    return student_df
+    return schema.compact_frame(student_df)
+
+
+# nomis tables share the layout date, geography, geography code, <total>, <categories...>
+census_key_columns = ["date", "geography", "geography code"]
+
+
+def download_census_tables(codes, base_dir="", levels=(), max_workers=8):
+    """download_census_data for several codes at once, skipping the cached ones."""
+    from concurrent.futures import ThreadPoolExecutor
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        list(executor.map(lambda code: download_census_data(code, base_dir, levels), codes))
+
+
+def _census_column_name(code, column):
+    return f"{code.upper()}: {column.replace('; measures: Value', '').strip()}"
+
+
+def _read_census_table(code, level, base_dir, normalise):
+    table = load_census_data(code, level, base_dir)
+    values = table.drop(columns=[col for col in census_key_columns if col in table.columns])
+    names = [_census_column_name(code, column) for column in values.columns]
+    matrix = values.to_numpy(dtype=np.float32)
+    if normalise:
+        # categories as proportions of the table's total column (the first one),
+        # the total itself stays a raw count
+        total = matrix[:, :1]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            matrix = np.concatenate([total, matrix[:, 1:] / total], axis=1)
+    return table["geography code"].to_numpy(), names, matrix
+
+
+@instrument.instrumented()
+def load_census_matrix(codes, level="oa", normalise=False, columns=None, base_dir="", how="outer", max_workers=8):
+    """Census tables side by side as one wide float32 frame indexed by geography code.
+    Tables are downloaded (if missing) and parsed concurrently and placed into one
+    preallocated array, rather than merged pairwise.
+    :param codes: nomis table codes, e.g. ["TS062", "TS007"]
+    :param level: geography level of the files, "oa", "msoa", "ltla", ...
+    :param normalise: categories as proportions of each table's total column
+    :param columns: names to keep, either as in the result ("TS062: L15") or the nomis
+        column name shared by several tables
+    :param how: "outer" keeps every geography (NaN where a table lacks it), "inner" only shared ones
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    if how not in ("outer", "inner"):
+        raise ValueError(f"Unknown alignment {how}, expected outer or inner.")
+    codes = list(codes)
+    if not codes:
+        raise ValueError("No census table codes given.")
+    # load_census_data fetches missing archives itself
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        tables = list(
+            executor.map(lambda code: _read_census_table(code, level, base_dir, normalise), codes)
+        )
+
+    index = pd.Index(tables[0][0], name="geography code")
+    for geography, _, _ in tables[1:]:
+        index = index.union(geography) if how == "outer" else index.intersection(geography)
+
+    names = []
+    selected = []
+    for code, (geography, table_names, matrix) in zip(codes, tables):
+        keep = [
+            i
+            for i, name in enumerate(table_names)
+            if columns is None
+            or name in columns
+            or name.split(": ", 1)[1] in columns
+        ]
+        names += [table_names[i] for i in keep]
+        selected.append((pd.Index(geography).get_indexer(index), matrix[:, keep]))
+
+    wide = np.full((len(index), len(names)), np.nan, dtype=np.float32)
+    start = 0
+    for rows, matrix in selected:
+        present = rows >= 0
+        wide[present, start:start + matrix.shape[1]] = matrix[rows[present]]
+        start += matrix.shape[1]
+    instrument.rows_out(len(index))
+    return pd.DataFrame(wide, index=index, columns=names)
 
 
 """
@@ -540,11 +1343,180 @@ def get_osm_tags_near_coordinates(latitude, longitude, tags, bbox_side=1.0):
         return pois
 
 
+"""
+---------------------------------------STREET GRAPH CACHE---------------------------------------
+"""
+
+# street graphs are cached on disk per tile-aligned bbox, so any bbox inside an
+# already fetched area is clipped out of the cached graph instead of hitting overpass again
+
+
+def _graph_cache_dir():
+    cache_dir = config.get("graph_cache_dir", "osm_graph_cache")
+    os.makedirs(cache_dir, exist_ok=True)
+    return cache_dir
+
+
+def _load_graph_cache_index(cache_dir):
+    index_path = os.path.join(cache_dir, "index.json")
+    if not os.path.exists(index_path):
+        return {}
+    with open(index_path) as file:
+        return json.load(file)
+
+
+def _save_graph_cache_index(cache_dir, index):
+    # write then rename so a crash never leaves a half written index behind
+    index_path = os.path.join(cache_dir, "index.json")
+    with open(index_path + ".tmp", "w") as file:
+        json.dump(index, file)
+    os.replace(index_path + ".tmp", index_path)
+
+
+def get_tile_bbox(north, south, east, west, tile_deg=None):
+    """Snap a bbox outwards onto the cache tile grid.
+    :return: (north, south, east, west) of the covering tiles and the cache key
+    """
+    if tile_deg is None:
+        tile_deg = config.get("graph_cache_tile_deg", 0.01)
+    tile_north = math.ceil(north / tile_deg)
+    tile_south = math.floor(south / tile_deg)
+    tile_east = math.ceil(east / tile_deg)
+    tile_west = math.floor(west / tile_deg)
+    key = f"{tile_deg}_{tile_north}_{tile_south}_{tile_east}_{tile_west}"
+    return (
+        tile_north * tile_deg,
+        tile_south * tile_deg,
+        tile_east * tile_deg,
+        tile_west * tile_deg,
+    ), key
+
+
+def _find_covering_entry(index, north, south, east, west):
+    # pick the smallest cached area that fully contains the requested bbox
+    # (small tolerance as tile edges are multiples of a float tile size)
+    eps = 1e-9
+    best_key, best_area = None, None
+    for key, entry in index.items():
+        if (
+            entry["north"] >= north - eps
+            and entry["south"] <= south + eps
+            and entry["east"] >= east - eps
+            and entry["west"] <= west + eps
+        ):
+            area = (entry["north"] - entry["south"]) * (entry["east"] - entry["west"])
+            if best_area is None or area < best_area:
+                best_key, best_area = key, area
+    return best_key
+
+
+def _evict_graph_cache(cache_dir, index, max_bytes):
+    total_bytes = sum(entry["bytes"] for entry in index.values())
+    for key in sorted(index, key=lambda k: index[k]["last_used"]):
+        if total_bytes <= max_bytes:
+            break
+        total_bytes -= index[key]["bytes"]
+        path = os.path.join(cache_dir, f"{key}.pkl")
+        if os.path.exists(path):
+            os.remove(path)
+        del index[key]
+
+
+def _fetch_street_network(north, south, east, west):
+    cache_dir = _graph_cache_dir()
+    index = _load_graph_cache_index(cache_dir)
+
+    key = _find_covering_entry(index, north, south, east, west)
+    if key is not None and os.path.exists(os.path.join(cache_dir, f"{key}.pkl")):
+        with open(os.path.join(cache_dir, f"{key}.pkl"), "rb") as file:
+            graph, edges = pickle.load(file)
+        index[key]["last_used"] = time.time()
+        _save_graph_cache_index(cache_dir, index)
+        return graph, edges, index[key]
+
+    (tile_north, tile_south, tile_east, tile_west), key = get_tile_bbox(
+        north, south, east, west
+    )
+    graph = ox.graph_from_bbox(tile_north, tile_south, tile_east, tile_west)
+    _, edges = ox.graph_to_gdfs(graph)
+
+    path = os.path.join(cache_dir, f"{key}.pkl")
+    with open(path, "wb") as file:
+        pickle.dump((graph, edges), file, protocol=pickle.HIGHEST_PROTOCOL)
+
+    # smaller entries inside the new tile are now redundant
+    for old_key in list(index):
+        entry = index[old_key]
+        if (
+            entry["north"] <= tile_north
+            and entry["south"] >= tile_south
+            and entry["east"] <= tile_east
+            and entry["west"] >= tile_west
+        ):
+            old_path = os.path.join(cache_dir, f"{old_key}.pkl")
+            if os.path.exists(old_path):
+                os.remove(old_path)
+            del index[old_key]
+
+    index[key] = {
+        "north": tile_north,
+        "south": tile_south,
+        "east": tile_east,
+        "west": tile_west,
+        "bytes": os.path.getsize(path),
+        "last_used": time.time(),
+    }
+    max_bytes = config.get("graph_cache_max_mb", 512) * 1024 * 1024
+    _evict_graph_cache(cache_dir, index, max_bytes)
+    _save_graph_cache_index(cache_dir, index)
+    return graph, edges, index[key] if key in index else None
+
+
+def _bbox_matches(entry, north, south, east, west):
+    return entry is not None and (
+        entry["north"] == north
+        and entry["south"] == south
+        and entry["east"] == east
+        and entry["west"] == west
+    )
+
+
+def get_street_edges(north, south, east, west):
+    """Street network edges for a bbox, served from the graph cache when possible.
+    :return: edges GeoDataFrame clipped to the bbox
+    """
+    _, edges, entry = _fetch_street_network(north, south, east, west)
+    if _bbox_matches(entry, north, south, east, west):
+        return edges
+    return edges.cx[west:east, south:north]
+
+
+def get_street_graph(north, south, east, west):
+    """Street network graph for a bbox, served from the graph cache when possible.
+    :return: networkx graph truncated to the bbox
+    """
+    graph, _, entry = _fetch_street_network(north, south, east, west)
+    if _bbox_matches(entry, north, south, east, west):
+        return graph
+    return ox.truncate.truncate_graph_bbox(
+        graph, north, south, east, west, truncate_by_edge=True
+    )
+
+
+@instrument.instrumented()
+def warm_street_graph_cache(locations_dict, bbox_side=1.0):
+    # fetch every location once up front, e.g. before drawing all of locations_dict
+    for latitude, longitude in locations_dict.values():
+        north, south, east, west = get_bbox(latitude, longitude, bbox_side)
+        _fetch_street_network(north, south, east, west)
+
+
 """
 ---------------------------------------DATABASE---------------------------------------
 """
 
 
+@instrument.instrumented()
 def download_price_paid_data(year_from, year_to):
     # Base URL where the dataset is stored
     base_url = (
@@ -590,6 +1562,8 @@ def create_connection(user, password, host, database, port=3306):
             port=port,
             local_infile=1,
             db=database,
+            # charges query/fetch time to the current instrument stage
+            cursorclass=instrument.instrumented_cursor_class(pymysql.cursors.Cursor),
         )
         print(f"Connection established!")
     except Exception as e:
@@ -597,35 +1571,256 @@ def create_connection(user, password, host, database, port=3306):
     return conn
 
 
-def housing_upload_join_data(conn, year):
+def create_duckdb_connection(database="fynesse.duckdb", read_only=False):
+    """Open an embedded DuckDB database that the access functions can use in place of
+        a MariaDB connection. Tables are stored by column and queried in process.
+    :param database: database file, or ":memory:"
+    :return: Connection object
+    """
+    return columnar.DuckDBConnection(database, read_only=read_only)
+
+
+# pp_data and prices_coordinates_data are partitioned by year of date_of_transfer, so
+# a date range like the per-year join in housing_upload_join_data only reads the
+# partitions it covers. MariaDB requires the partitioning column in every unique key,
+# so neither table has a primary key. Years outside the range would land in
+# p_before/p_after, so housing_upload_join_data first has add_year_partitions split
+# them out.
+price_paid_years = (1995, 2024)
+
+
+def _year_partitions(year_from, year_to):
+    partitions = "".join(
+        f"PARTITION p{year} VALUES LESS THAN ({year + 1}), "
+        for year in range(year_from, year_to + 1)
+    )
+    return (
+        "PARTITION BY RANGE (YEAR(`date_of_transfer`)) ("
+        f"PARTITION p_before VALUES LESS THAN ({year_from}), "
+        f"{partitions}"
+        "PARTITION p_after VALUES LESS THAN MAXVALUE)"
+    )
+
+
+@instrument.instrumented()
+def initialize_pp_data_db(conn, year_from=None, year_to=None):
+    year_from, year_to = year_from or price_paid_years[0], year_to or price_paid_years[1]
+    curr = conn.cursor()
+
+    curr.execute("""DROP TABLE IF EXISTS `pp_data`;""")
+    curr.execute(
+        (
+            """
+        CREATE TABLE IF NOT EXISTS `pp_data` (
+        `transaction_unique_identifier` varchar(40) COLLATE utf8_bin NOT NULL,
+        `price` int NOT NULL,
+        `date_of_transfer` date NOT NULL,
+        `postcode` varchar(8) COLLATE utf8_bin NOT NULL,
+        `property_type` varchar(1) COLLATE utf8_bin NOT NULL,
+        `new_build_flag` varchar(1) COLLATE utf8_bin NOT NULL,
+        `tenure_type` varchar(1) COLLATE utf8_bin NOT NULL,
+        `primary_addressable_object_name` varchar(100) COLLATE utf8_bin,
+        `secondary_addressable_object_name` varchar(100) COLLATE utf8_bin,
+        `street` varchar(100) COLLATE utf8_bin,
+        `locality` varchar(100) COLLATE utf8_bin,
+        `town_city` varchar(100) COLLATE utf8_bin,
+        `district` varchar(100) COLLATE utf8_bin,
+        `county` varchar(100) COLLATE utf8_bin,
+        `ppd_category_type` varchar(2) COLLATE utf8_bin,
+        `record_status` varchar(2) COLLATE utf8_bin
+        ) DEFAULT CHARSET=utf8 COLLATE=utf8_bin
+    """
+            + _year_partitions(year_from, year_to)
+            + ";"
+        ).replace("\n", " ")
+    )
+
+    # the join probes postcode within one year's partition
+    curr.execute(
+        """CREATE INDEX pp_postcode_date ON `pp_data` (`postcode`, `date_of_transfer`);"""
+    )
+    conn.commit()
+    bump_table_version(conn, "pp_data")
+
+
+@instrument.instrumented()
+def initialize_postcode_data_db(conn):
+    curr = conn.cursor()
+
+    curr.execute("""DROP TABLE IF EXISTS `postcode_data`;""")
+    curr.execute(
+        """
+        CREATE TABLE IF NOT EXISTS `postcode_data` (
+        `postcode` varchar(8) COLLATE utf8_bin NOT NULL,
+        `country` varchar(25) COLLATE utf8_bin NOT NULL,
+        `latitude` decimal(11,8) NOT NULL,
+        `longitude` decimal(10,8) NOT NULL
+        ) DEFAULT CHARSET=utf8 COLLATE=utf8_bin;
+    """.replace(
+            "\n", " "
+        )
+    )
+
+    # covers the postcode_data side of the join, it never has to read the table rows
+    curr.execute(
+        """CREATE INDEX po_postcode_location ON `postcode_data` (`postcode`, `country`, `latitude`, `longitude`);"""
+    )
+    conn.commit()
+    bump_table_version(conn, "postcode_data")
+
+
+@instrument.instrumented()
+def initialize_prices_coordinates_data_db(conn, year_from=None, year_to=None):
+    year_from, year_to = year_from or price_paid_years[0], year_to or price_paid_years[1]
+    curr = conn.cursor()
+
+    curr.execute("""DROP TABLE IF EXISTS `prices_coordinates_data`;""")
+    curr.execute(
+        (
+            """
+        CREATE TABLE IF NOT EXISTS `prices_coordinates_data` (
+        `price` int NOT NULL,
+        `date_of_transfer` date NOT NULL,
+        `postcode` varchar(8) COLLATE utf8_bin NOT NULL,
+        `property_type` varchar(1) COLLATE utf8_bin NOT NULL,
+        `new_build_flag` varchar(1) COLLATE utf8_bin NOT NULL,
+        `tenure_type` varchar(1) COLLATE utf8_bin NOT NULL,
+        `locality` varchar(100) COLLATE utf8_bin,
+        `town_city` varchar(100) COLLATE utf8_bin,
+        `district` varchar(100) COLLATE utf8_bin,
+        `county` varchar(100) COLLATE utf8_bin,
+        `country` varchar(25) COLLATE utf8_bin,
+        `latitude` decimal(11,8) NOT NULL,
+        `longitude` decimal(10,8) NOT NULL,
+        `primary_addressable_object_name` varchar(100) COLLATE utf8_bin,
+        `secondary_addressable_object_name` varchar(100) COLLATE utf8_bin
+        ) DEFAULT CHARSET=utf8 COLLATE=utf8_bin
+    """
+            + _year_partitions(year_from, year_to)
+            + ";"
+        ).replace("\n", " ")
+    )
+
+    # bounding box filters range over latitude and check longitude in the index,
+    # price and date are included so aggregates over a region stay in the index
+    curr.execute(
+        """CREATE INDEX pc_location ON `prices_coordinates_data` (`latitude`, `longitude`, `date_of_transfer`, `price`);"""
+    )
+    curr.execute(
+        """CREATE INDEX pc_postcode_date ON `prices_coordinates_data` (`postcode`, `date_of_transfer`, `price`);"""
+    )
+    conn.commit()
+    bump_table_version(conn, "prices_coordinates_data")
+
+
+# output areas are kept beside prices_coordinates_data rather than in it, so its
+# columns stay the ones the loaders fill by position. Transactions share their
+# postcode's coordinates, so one row per coordinate pair covers every year.
+def _create_coordinate_output_areas(curr):
+    curr.execute(
+        """
+        CREATE TABLE IF NOT EXISTS `coordinate_output_areas` (
+        `latitude` decimal(11,8) NOT NULL,
+        `longitude` decimal(10,8) NOT NULL,
+        `OA21CD` VARCHAR(10) COLLATE utf8_bin,
+        PRIMARY KEY (`latitude`, `longitude`)
+        ) DEFAULT CHARSET=utf8 COLLATE=utf8_bin;
+    """.replace(
+            "\n", " "
+        )
+    )
+
+
+@instrument.instrumented()
+def initialize_coordinate_output_areas_db(conn):
+    curr = conn.cursor()
+
+    curr.execute("""DROP TABLE IF EXISTS `coordinate_output_areas`;""")
+    _create_coordinate_output_areas(curr)
+    conn.commit()
+    bump_table_version(conn, "coordinate_output_areas")
+
+
+def add_year_partitions(conn, table_name, year_to, year_from=None):
+    """Split p_after (and p_before, given year_from) so every year up to year_to (and
+    from year_from) has its own partition (MariaDB only)."""
+    if columnar.is_duckdb(conn):
+        # duckdb prunes row groups by their min/max dates instead
+        return
+    curr = conn.cursor()
+    curr.execute(
+        """
+        SELECT MIN(CAST(PARTITION_DESCRIPTION AS UNSIGNED)), MAX(CAST(PARTITION_DESCRIPTION AS UNSIGNED))
+        FROM information_schema.PARTITIONS
+        WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s AND PARTITION_DESCRIPTION != 'MAXVALUE';
+    """,
+        (table_name,),
+    )
+    row = curr.fetchone()
+    first_year, next_year = row.values() if isinstance(row, dict) else row
+    if next_year is None:
+        # not partitioned
+        return
+    if next_year <= year_to:
+        partitions = "".join(
+            f"PARTITION p{year} VALUES LESS THAN ({year + 1}), "
+            for year in range(int(next_year), year_to + 1)
+        )
+        curr.execute(
+            f"ALTER TABLE `{table_name}` REORGANIZE PARTITION p_after INTO ("
+            f"{partitions}PARTITION p_after VALUES LESS THAN MAXVALUE);"
+        )
+    if year_from is not None and year_from < first_year:
+        partitions = ", ".join(
+            f"PARTITION p{year} VALUES LESS THAN ({year + 1})"
+            for year in range(year_from, int(first_year))
+        )
+        curr.execute(
+            f"ALTER TABLE `{table_name}` REORGANIZE PARTITION p_before INTO ("
+            f"PARTITION p_before VALUES LESS THAN ({year_from}), {partitions});"
+        )
+    conn.commit()
+
+
+def housing_join_query(year, pp_table="pp_data"):
     start_date = str(year) + "-01-01"
     end_date = str(year) + "-12-31"
-
-    cur = conn.cursor()
-    print("Selecting data for year: " + str(year))
-    cur.execute(
-        f'SELECT pp.price, pp.date_of_transfer, po.postcode, pp.property_type, pp.new_build_flag, pp.tenure_type, pp.locality, pp.town_city, pp.district, pp.county, po.country, po.latitude, po.longitude, pp.primary_addressable_object_name, pp.secondary_addressable_object_name FROM (SELECT price, date_of_transfer, postcode, property_type, new_build_flag, tenure_type, locality, town_city, district, county, primary_addressable_object_name, secondary_addressable_object_name FROM pp_data WHERE date_of_transfer BETWEEN "'
+    return (
+        f'SELECT pp.price, pp.date_of_transfer, po.postcode, pp.property_type, pp.new_build_flag, pp.tenure_type, pp.locality, pp.town_city, pp.district, pp.county, po.country, po.latitude, po.longitude, pp.primary_addressable_object_name, pp.secondary_addressable_object_name FROM (SELECT price, date_of_transfer, postcode, property_type, new_build_flag, tenure_type, locality, town_city, district, county, primary_addressable_object_name, secondary_addressable_object_name FROM {pp_table} WHERE date_of_transfer BETWEEN "'
         + start_date
         + '" AND "'
         + end_date
         + '") AS pp INNER JOIN postcode_data AS po ON pp.postcode = po.postcode'
     )
-    rows = cur.fetchall()
 
-    csv_file_path = "output_file.csv"
 
-    # Write the rows to the CSV file
-    with open(csv_file_path, "w", newline="") as csvfile:
-        csv_writer = csv.writer(csvfile)
-        # Write the data rows
-        csv_writer.writerows(rows)
+@instrument.instrumented()
+def housing_upload_join_data(conn, year, update_rollups=True):
+    cur = conn.cursor()
+    previous_version = table_version(conn, "prices_coordinates_data")
+    if _is_mariadb(conn):
+        # a year outside the initial range gets its own partitions rather than
+        # sharing p_before/p_after, so the join and later reads still prune to it
+        for table_name in ("pp_data", "prices_coordinates_data"):
+            add_year_partitions(conn, table_name, year, year_from=year)
+    print("Selecting data for year: " + str(year))
+    cur.execute(housing_join_query(year))
+    rows = cur.fetchall()
+
     print("Storing data for year: " + str(year))
-    cur.execute(
-        f"LOAD DATA LOCAL INFILE '"
-        + csv_file_path
-        + "' INTO TABLE `prices_coordinates_data` FIELDS TERMINATED BY ',' OPTIONALLY ENCLOSED by '\"' LINES STARTING BY '' TERMINATED BY '\n';"
+    # streamed straight into the table, no output_file.csv in between
+    load_frames_into_db(
+        conn,
+        pd.DataFrame.from_records(list(rows), columns=schema.table_columns["prices_coordinates_data"]),
+        "prices_coordinates_data",
     )
     print("Data stored for year: " + str(year))
+    if update_rollups:
+        # imported here, rollups builds on this module
+        from .rollups import update_price_rollups
+
+        # only this year changed, the rollups of the others stay current
+        update_price_rollups(conn, year, previous_version=previous_version)
 
 
 """
@@ -643,6 +1838,7 @@ def housing_upload_join_data(conn, year):
 # )
 
 
+@instrument.instrumented()
 def bounding_extract_region_data(conn, region_name, latitude, longitude, distance_km):
     cur = conn.cursor()
     print(
@@ -663,6 +1859,7 @@ def bounding_extract_region_data(conn, region_name, latitude, longitude, distanc
         ),
     )
     rows = cur.fetchall()
+    instrument.rows_out(len(rows))
 
     csv_file_path = f"{region_name}_housing_data.csv"
     with open(csv_file_path, "w") as csv_file:
@@ -670,6 +1867,79 @@ def bounding_extract_region_data(conn, region_name, latitude, longitude, distanc
         csv_writer.writerows(rows)
 
 
+@instrument.instrumented()
+def bounding_extract_regions_data(conn, regions, distance_km=None, output_dir=None):
+    """bounding_extract_region_data for many regions in one query.
+    The region boxes go into a temporary table and a single range join against
+    housing_data answers all of them, rather than one query per region. Columns
+    are read as the database returns them, like bounding_extract_region_data.
+    :param regions: (name, latitude, longitude, distance_km) tuples, or a dict of
+        name -> (latitude, longitude) like locations_dict together with distance_km
+    :param output_dir: if given, also write each region's rows to
+        <output_dir>/<name>_housing_data.csv like bounding_extract_region_data
+    :return: DataFrame of the matching rows with a region_name column
+    """
+    if isinstance(regions, dict):
+        regions = [(name, lat, lon, distance_km) for name, (lat, lon) in regions.items()]
+    if not regions:
+        raise ValueError("No regions given, expected at least one (name, latitude, longitude, distance_km).")
+    bounds = [
+        (
+            name,
+            latitude - region_distance_km / 2,
+            latitude + region_distance_km / 2,
+            longitude - region_distance_km / 2,
+            longitude + region_distance_km / 2,
+        )
+        for name, latitude, longitude, region_distance_km in regions
+    ]
+    instrument.rows_in(len(bounds))
+
+    cur = conn.cursor()
+    cur.execute("""DROP TEMPORARY TABLE IF EXISTS `region_bounds`;""")
+    cur.execute(
+        """
+        CREATE TEMPORARY TABLE `region_bounds` (
+        `region_name` VARCHAR(255) NOT NULL,
+        `south` DOUBLE NOT NULL,
+        `north` DOUBLE NOT NULL,
+        `west` DOUBLE NOT NULL,
+        `east` DOUBLE NOT NULL
+        );
+    """.replace(
+            "\n", " "
+        )
+    )
+    cur.executemany(
+        "INSERT INTO `region_bounds` VALUES (%s, %s, %s, %s, %s);", bounds
+    )
+    print(f"Selecting data for transactions in {len(bounds)} regions")
+    # uncompacted, so the CSVs hold the values as the database returns them
+    regions_df = read_frame(
+        conn,
+        compact=False,
+        query="""
+    SELECT r.region_name, h.*
+    FROM region_bounds AS r
+    INNER JOIN housing_data AS h
+      ON h.latitude BETWEEN r.south AND r.north
+      AND h.longitude BETWEEN r.west AND r.east;
+      """,
+    )
+    cur.execute("""DROP TEMPORARY TABLE IF EXISTS `region_bounds`;""")
+    regions_df["region_name"] = regions_df["region_name"].astype("category")
+
+    if output_dir is not None:
+        os.makedirs(output_dir, exist_ok=True)
+        for region_name, region_df in regions_df.groupby("region_name", observed=True):
+            region_df.drop(columns="region_name").to_csv(
+                os.path.join(output_dir, f"{region_name}_housing_data.csv"),
+                header=False,
+                index=False,
+            )
+    return regions_df
+
+
 """
 Project 2:
 ------------------------------------------------------------------------------------------------------
@@ -708,6 +1978,7 @@ income_tags = {"building": True}
 """
 
 
+@instrument.instrumented()
 def initialize_income_db(conn):
     curr = conn.cursor()
 
@@ -737,10 +2008,12 @@ def initialize_income_db(conn):
         """CREATE INDEX local_authorities_code ON `income` (`local_authorities_code`);"""
     )
     conn.commit()
+    bump_table_version(conn, "income")
 
     load_csv_data_into_db(conn, "income_statistics_removed.csv", "income")
 
 
+@instrument.instrumented()
 def initialize_general_health_db(conn):
     curr = conn.cursor()
 
@@ -769,10 +2042,12 @@ def initialize_general_health_db(conn):
         """CREATE INDEX local_authorities_code ON `general_health` (`local_authorities_code`);"""
     )
     conn.commit()
+    bump_table_version(conn, "general_health")
 
     load_csv_data_into_db(conn, "general_health.csv", "general_health")
 
 
+@instrument.instrumented()
 def initialize_health_db_2011(conn):
     curr = conn.cursor()
 
@@ -800,10 +2075,12 @@ def initialize_health_db_2011(conn):
         """CREATE INDEX local_authorities_code ON `health_2011` (`local_authorities_code`);"""
     )
     conn.commit()
+    bump_table_version(conn, "health_2011")
 
     load_csv_data_into_db(conn, "health_2011.csv", "health_2011")
 
 
+@instrument.instrumented()
 def initialize_education_db(conn):
     curr = conn.cursor()
 
@@ -831,10 +2108,12 @@ def initialize_education_db(conn):
         """CREATE INDEX local_authorities_code ON `education` (`local_authorities_code`);"""
     )
     conn.commit()
+    bump_table_version(conn, "education")
 
     load_csv_data_into_db(conn, "level_of_education.csv", "education")
 
 
+@instrument.instrumented()
 def initialize_education_2011(conn):
     curr = conn.cursor()
 
@@ -862,6 +2141,7 @@ def initialize_education_2011(conn):
         """CREATE INDEX local_authorities_code ON `education_2011` (`local_authorities_code`);"""
     )
     conn.commit()
+    bump_table_version(conn, "education_2011")
 
     load_csv_data_into_db(conn, "education_2011.csv", "education_2011")
 
@@ -870,6 +2150,7 @@ def initialize_education_2011(conn):
 ---------------------------------------CREATE CSVs---------------------------------------
 """
 
+@instrument.instrumented()
 def create_health_2011():
     # basically identical to the code below....
     health_mapping = {
@@ -904,14 +2185,10 @@ def create_health_2011():
             db_id += 1
 
     output_file = "output_health_for_sql.csv"
-    with open(output_file, mode="w", newline="") as file:
-        writer = csv.DictWriter(file, fieldnames=[
-            "db_id", "local_authorities_code", "local_authorities", "general_health_code", "general_health", "observation"
-        ])
-        writer.writeheader()
-        writer.writerows(sql_data)
+    write_csv(pd.DataFrame(sql_data, columns=schema.table_columns["health_2011"]), output_file, "health_2011")
 
 
+@instrument.instrumented()
 def create_education_2011():
     mapping = {
         "No qualifications": 0,
@@ -949,21 +2226,9 @@ def create_education_2011():
             db_id += 1
 
     output_file = "education_2011.csv"
-    with open(output_file, mode="w", newline="") as file:
-        writer = csv.DictWriter(
-            file,
-            fieldnames=[
-                "db_id",
-                "local_authorities_code",
-                "local_authorities",
-                "level_of_education_code",
-                "level_of_education",
-                "observation",
-            ],
-        )
-        writer.writeheader()
-        writer.writerows(sql_data)
+    write_csv(pd.DataFrame(sql_data, columns=schema.table_columns["education_2011"]), output_file, "education_2011")
 
+@instrument.instrumented()
 def create_osm_health_education_income():
     health_tags = {'amenity': ['doctors', 'hospital', 'pharmacy', 'veterinary', 'clinic'],
                'leisure': ['fitness_centre', 'fitness_station']}
@@ -1,14 +1,20 @@
 from .config import *
-from . import access, address
+from .lazy import lazy_import
 
+from . import access, address, columnar, instrument
+
+import hashlib
+import json
 import random
-import numpy as np
-import matplotlib.pyplot as plt
-from sklearn.cluster import KMeans
-from sklearn.ensemble import RandomForestRegressor
-from sklearn.model_selection import train_test_split
-from sklearn.neighbors import BallTree
 
+# heavy dependencies only load when a function first uses them,
+# sklearn is imported inside the functions that need it
+np = lazy_import("numpy")
+plt = lazy_import("matplotlib.pyplot")
+joblib = lazy_import("joblib")
+pd = lazy_import("pandas")
+
+@instrument.instrumented()
 def k_means(data_np, k=3, iterations=75, tolerance=1e-4):
     # used to have consistent values
     random.seed(10)
@@ -35,6 +41,9 @@ def k_means(data_np, k=3, iterations=75, tolerance=1e-4):
     return cluster_groups, centroids
 
 def plot_model_coefficients(rf_model):
+    if not hasattr(rf_model, "feature_importances_"):
+        # e.g. HistGradientBoostingRegressor, see sklearn.inspection.permutation_importance
+        raise ValueError(f"{type(rf_model).__name__} has no feature importances to plot, train a random_forest model.")
     coefficients = rf_model.feature_importances_
     plt.figure(figsize=(10,5))
     plt.bar(access.updated_feature_cols, coefficients)
@@ -45,16 +54,410 @@ def plot_model_coefficients(rf_model):
     plt.show()
 
 def get_coordinates_and_ball_tree(osm_merged_df):
+    from sklearn.neighbors import BallTree
+
     coordinates = osm_merged_df[['LAT', 'LONG']].values
     tree = BallTree(np.radians(coordinates), leaf_size=2)
     return tree
 
-def predict(lat, lon, rf_model, osm_merged_df, tree):
+def predict(lat, lon, rf_model, osm_merged_df, tree, feature_matrix=None):
     # find nearest point
     query_point = np.array([[lat, lon]])
     _, ind = tree.query(np.radians(query_point), k=1)
     nearest_idx = ind[0][0]
 
-    nearest_features = osm_merged_df.iloc[nearest_idx][access.updated_feature_cols].values.reshape(1, -1)
+    if feature_matrix is not None:
+        # rows of build_feature_matrix(osm_merged_df), avoids a pandas row lookup per call
+        nearest_features = feature_matrix[nearest_idx:nearest_idx + 1]
+    else:
+        nearest_features = osm_merged_df.iloc[nearest_idx][access.updated_feature_cols].values.reshape(1, -1)
     pred_student_pop = rf_model.predict(nearest_features)[0]
-    return pred_student_pop
\ No newline at end of file
+    return pred_student_pop
+
+def predict_batch(latitudes, longitudes, rf_model, tree, feature_matrix):
+    """predict for many points at once: one tree query and one model call for the lot."""
+    query_points = np.column_stack([np.asarray(latitudes, dtype=np.float64), np.asarray(longitudes, dtype=np.float64)])
+    _, ind = tree.query(np.radians(query_points), k=1)
+    return rf_model.predict(feature_matrix[ind[:, 0]])
+
+
+"""
+---------------------------------------OUTPUT AREA ASSIGNMENT---------------------------------------
+"""
+
+# Points are assigned to the output area with the nearest census_coordinates centroid.
+# The tree holds the centroids as 3D unit vectors: the straight line distance between
+# unit vectors orders points exactly like the great circle distance, and a euclidean
+# KDTree answers nearest neighbour queries several times faster than a BallTree.
+
+earth_radius_km = 6371.0
+
+
+def _unit_vectors(latitudes, longitudes):
+    lat = np.radians(np.asarray(latitudes, dtype=np.float64))
+    lon = np.radians(np.asarray(longitudes, dtype=np.float64))
+    return np.column_stack([np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)])
+
+
+def build_output_area_index(census_df):
+    """Spatial index over the output area centroids (census_coordinates rows).
+    :return: KDTree and the OA21CD code of each tree point
+    """
+    from sklearn.neighbors import KDTree
+
+    if len(census_df) == 0:
+        raise ValueError("No output areas to index, census_df is empty.")
+    tree = KDTree(_unit_vectors(census_df["LAT"], census_df["LONG"]))
+    return tree, census_df["OA21CD"].astype(str).to_numpy()
+
+
+def _assign_chunk(tree, codes, latitudes, longitudes, max_chord):
+    distance, ind = tree.query(_unit_vectors(latitudes, longitudes), k=1)
+    assigned = codes[ind[:, 0]].astype(object)
+    if max_chord is not None:
+        assigned[distance[:, 0] > max_chord] = None
+    return assigned
+
+
+@instrument.instrumented()
+def assign_output_areas(latitudes, longitudes, tree, codes, chunksize=100000, max_workers=None, max_distance_km=None):
+    """OA21CD of the nearest output area centroid for every point.
+    Chunks are queried on a thread pool, the tree query releases the GIL.
+    :param max_distance_km: points further than this from any centroid get None
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    latitudes = np.asarray(latitudes, dtype=np.float64)
+    longitudes = np.asarray(longitudes, dtype=np.float64)
+    if len(latitudes) != len(longitudes):
+        raise ValueError(f"Got {len(latitudes)} latitudes but {len(longitudes)} longitudes.")
+    if len(codes) != np.asarray(tree.data).shape[0]:
+        raise ValueError(f"Got {len(codes)} codes for a tree of {np.asarray(tree.data).shape[0]} output areas.")
+    instrument.rows_in(len(latitudes))
+    max_chord = None
+    if max_distance_km is not None:
+        max_chord = 2 * np.sin(max_distance_km / earth_radius_km / 2)
+
+    starts = range(0, len(latitudes), chunksize)
+    with ThreadPoolExecutor(max_workers=max_workers or os.cpu_count()) as executor:
+        chunks = executor.map(
+            lambda start: _assign_chunk(
+                tree,
+                codes,
+                latitudes[start:start + chunksize],
+                longitudes[start:start + chunksize],
+                max_chord,
+            ),
+            starts,
+        )
+        return np.concatenate(list(chunks)) if len(latitudes) else np.array([], dtype=object)
+
+
+@instrument.instrumented()
+def assign_output_areas_csv(in_path, out_path, tree, codes, latitude_col="latitude", longitude_col="longitude", chunksize=1000000, **read_csv_kwargs):
+    """Stream a CSV of points and write it back out with an OA21CD column added."""
+    header = True
+    for chunk in pd.read_csv(in_path, chunksize=chunksize, **read_csv_kwargs):
+        chunk["OA21CD"] = assign_output_areas(chunk[latitude_col], chunk[longitude_col], tree, codes)
+        chunk.to_csv(out_path, mode="w" if header else "a", header=header, index=False)
+        header = False
+        instrument.rows_out(len(chunk))
+
+
+@instrument.instrumented()
+def assign_output_areas_table(conn, tree, codes, table_name="prices_coordinates_data", reassign=False):
+    """Assign output areas to a table's latitude/longitude pairs, stored in
+    coordinate_output_areas rather than as a column of the table itself.
+    Transactions share their postcode's coordinates, so only the distinct pairs
+    not assigned yet are queried, e.g. the new ones after loading another year.
+    :param reassign: drop the earlier assignments first, e.g. for a new census index
+    :return: number of coordinate pairs assigned
+    """
+    curr = conn.cursor()
+    if reassign:
+        access.initialize_coordinate_output_areas_db(conn)
+    else:
+        access._create_coordinate_output_areas(curr)
+        conn.commit()
+    # exact decimals rather than read_frame's floats, they are joined on when reading
+    curr.execute(
+        f"""
+        SELECT DISTINCT t.latitude, t.longitude FROM `{table_name}` AS t
+        LEFT JOIN `coordinate_output_areas` AS m
+          ON t.latitude = m.latitude AND t.longitude = m.longitude
+        WHERE m.latitude IS NULL;
+        """
+    )
+    pairs = [tuple(row.values()) if isinstance(row, dict) else tuple(row) for row in curr.fetchall()]
+    instrument.rows_in(len(pairs))
+    if pairs:
+        latitudes = np.array([float(lat) for lat, _ in pairs])
+        longitudes = np.array([float(lon) for _, lon in pairs])
+        assigned = assign_output_areas(latitudes, longitudes, tree, codes)
+        access.load_frames_into_db(
+            conn,
+            pd.DataFrame(
+                {
+                    "latitude": [str(lat) for lat, _ in pairs],
+                    "longitude": [str(lon) for _, lon in pairs],
+                    "OA21CD": assigned,
+                }
+            ),
+            "coordinate_output_areas",
+        )
+    instrument.rows_out(len(pairs))
+    return len(pairs)
+
+
+def output_areas_query(table_name="prices_coordinates_data"):
+    """SELECT of the table's rows with an OA21CD column from assign_output_areas_table
+    (NULL for coordinates not assigned yet), e.g. for access.read_frame(conn, query=...)."""
+    return (
+        f"SELECT t.*, m.`OA21CD` FROM `{table_name}` AS t "
+        "LEFT JOIN `coordinate_output_areas` AS m "
+        "ON t.latitude = m.latitude AND t.longitude = m.longitude;"
+    )
+
+
+"""
+---------------------------------------DENSITY CLUSTERING---------------------------------------
+"""
+
+# DBSCAN over great circle distance, for POI hotspots (campuses, high streets) that
+# k_means can't find. Neighbourhoods use the same unit vector KDTree as the output
+# area assignment: a chord of 2 sin(eps / 2R) between unit vectors bounds exactly the
+# points within eps_km along the earth's surface, so radius queries give haversine
+# neighbourhoods without evaluating haversine per pair.
+#
+# Neighbour queries run chunk by chunk on a thread pool. Core points within eps of
+# each other are merged into clusters one chunk of edges at a time, so memory stays
+# at one chunk's edges rather than every neighbour pair.
+
+
+def _chunk_results(fn, num_items, chunksize, max_workers):
+    # (start, fn(start, end)) in order, with only a few chunks in flight at once
+    from concurrent.futures import ThreadPoolExecutor
+
+    max_workers = max_workers or os.cpu_count()
+    starts = list(range(0, num_items, chunksize))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        in_flight = []
+        for start in starts:
+            in_flight.append((start, executor.submit(fn, start, min(start + chunksize, num_items))))
+            if len(in_flight) > 2 * max_workers:
+                start, future = in_flight.pop(0)
+                yield start, future.result()
+        for start, future in in_flight:
+            yield start, future.result()
+
+
+def _merge_components(components, rows, cols):
+    # union of the clusters found so far (each point linked to its representative
+    # point) with the new edges, collapsed back to one link per point
+    from scipy.sparse import coo_matrix
+    from scipy.sparse.csgraph import connected_components
+
+    num_points = len(components)
+    graph = coo_matrix(
+        (
+            np.ones(num_points + len(rows), dtype=np.int8),
+            (np.concatenate([np.arange(num_points), rows]), np.concatenate([components, cols])),
+        ),
+        shape=(num_points, num_points),
+    )
+    component_labels = connected_components(graph, directed=False)[1]
+    # the lowest numbered point of each cluster represents it
+    _, first = np.unique(component_labels, return_index=True)
+    return first[component_labels]
+
+
+@instrument.instrumented()
+def density_clusters(df, eps_km=0.2, min_samples=10, lat_col="LAT", lon_col="LONG", chunksize=20000, max_workers=None):
+    """DBSCAN with the haversine distance over the rows of df (POIs, output areas, ...).
+    A point with at least min_samples points (itself included) within eps_km is a core
+    point; core points within eps_km of each other share a cluster and other points
+    join the cluster of their nearest core point within eps_km.
+    :return: Series of cluster labels aligned with df's index, -1 for noise, clusters
+        numbered by size (0 is the largest)
+    """
+    from sklearn.neighbors import KDTree
+
+    instrument.rows_in(len(df))
+    labels = np.full(len(df), -1, dtype=np.int64)
+    latitudes = df[lat_col].to_numpy(dtype=np.float64)
+    longitudes = df[lon_col].to_numpy(dtype=np.float64)
+    located = np.flatnonzero(np.isfinite(latitudes) & np.isfinite(longitudes))
+    if len(located) == 0:
+        return pd.Series(labels, index=df.index, name="cluster")
+
+    points = _unit_vectors(latitudes[located], longitudes[located])
+    radius = 2 * np.sin(eps_km / earth_radius_km / 2)
+    tree = KDTree(points)
+
+    counts = np.empty(len(points), dtype=np.int64)
+    for start, chunk_counts in _chunk_results(
+        lambda start, end: tree.query_radius(points[start:end], radius, count_only=True),
+        len(points),
+        chunksize,
+        max_workers,
+    ):
+        counts[start:start + len(chunk_counts)] = chunk_counts
+    core = np.flatnonzero(counts >= min_samples)
+
+    if len(core):
+        core_points = points[core]
+        core_tree = KDTree(core_points)
+        components = np.arange(len(core))
+        for start, neighbours in _chunk_results(
+            lambda start, end: core_tree.query_radius(core_points[start:end], radius),
+            len(core),
+            chunksize,
+            max_workers,
+        ):
+            sizes = np.fromiter((len(ind) for ind in neighbours), np.int64, len(neighbours))
+            rows = np.repeat(np.arange(start, start + len(neighbours)), sizes)
+            cols = np.concatenate(neighbours) if len(neighbours) else np.array([], dtype=np.int64)
+            components = _merge_components(components, rows, cols)
+
+        # biggest cluster first
+        _, components, sizes = np.unique(components, return_inverse=True, return_counts=True)
+        rank = np.empty(len(sizes), dtype=np.int64)
+        rank[np.argsort(-sizes, kind="stable")] = np.arange(len(sizes))
+        core_labels = rank[components]
+
+        # border points: the nearest core point within eps
+        point_labels = np.full(len(points), -1, dtype=np.int64)
+        point_labels[core] = core_labels
+        border = np.flatnonzero((counts < min_samples) & (counts > 1))
+        for start, (distance, ind) in _chunk_results(
+            lambda start, end: core_tree.query(points[border[start:end]], k=1),
+            len(border),
+            chunksize,
+            max_workers,
+        ):
+            near = distance[:, 0] <= radius
+            point_labels[border[start:start + len(ind)][near]] = core_labels[ind[near, 0]]
+        labels[located] = point_labels
+
+    instrument.rows_out(int((labels >= 0).sum()))
+    return pd.Series(labels, index=df.index, name="cluster")
+
+
+"""
+---------------------------------------MODEL TRAINING---------------------------------------
+"""
+
+model_types = ["random_forest", "hist_gradient_boosting"]
+
+
+def feature_schema_hash(feature_cols=None):
+    # identifies the columns (and their order) a feature matrix / model was built with
+    if feature_cols is None:
+        feature_cols = access.updated_feature_cols
+    schema = json.dumps({"feature_cols": list(feature_cols), "dtype": "float32"})
+    return hashlib.sha256(schema.encode()).hexdigest()[:16]
+
+
+def build_feature_matrix(df, feature_cols=None):
+    """Materialise the model features once as a C-contiguous float32 array."""
+    if feature_cols is None:
+        feature_cols = access.updated_feature_cols
+    return np.ascontiguousarray(df[feature_cols].to_numpy(dtype=np.float32))
+
+
+def save_feature_matrix(feature_matrix, path, feature_cols=None):
+    if not path.endswith(".npy"):
+        path = f"{path}.npy"
+    np.save(path, feature_matrix)
+    with open(f"{path}.json", "w") as file:
+        json.dump(
+            {"schema_hash": feature_schema_hash(feature_cols), "shape": feature_matrix.shape},
+            file,
+        )
+
+
+def load_feature_matrix(path, feature_cols=None, mmap_mode="r"):
+    if not path.endswith(".npy"):
+        path = f"{path}.npy"
+    with open(f"{path}.json") as file:
+        meta = json.load(file)
+    if meta["schema_hash"] != feature_schema_hash(feature_cols):
+        raise ValueError(f"Feature matrix at {path} was built with a different feature schema.")
+    return np.load(path, mmap_mode=mmap_mode)
+
+
+def make_model(model_type="random_forest", random_state=42, **params):
+    from sklearn.ensemble import HistGradientBoostingRegressor, RandomForestRegressor
+
+    if model_type == "random_forest":
+        # all cores for both fitting and predicting, unless n_jobs says otherwise
+        return RandomForestRegressor(**{"n_jobs": -1, "random_state": random_state, **params})
+    if model_type == "hist_gradient_boosting":
+        # bins features into histograms, much faster to fit/predict on large tables
+        return HistGradientBoostingRegressor(random_state=random_state, **params)
+    raise ValueError(f"Unknown model type {model_type}, expected one of {model_types}.")
+
+
+@instrument.instrumented()
+def train_model(feature_matrix, y, model_type="random_forest", test_size=0.2, random_state=42, **params):
+    from sklearn.metrics import r2_score
+    from sklearn.model_selection import train_test_split
+
+    X_train, X_test, y_train, y_test = train_test_split(
+        feature_matrix, np.asarray(y, dtype=np.float32), test_size=test_size, random_state=random_state
+    )
+    model = make_model(model_type, random_state=random_state, **params)
+    instrument.rows_in(len(X_train))
+    model.fit(X_train, y_train)
+    return model, r2_score(y_test, model.predict(X_test))
+
+
+def training_spec(model_type="random_forest", target_col="STUDENT_POP", **params):
+    # what a saved model was trained for, compared as JSON so tuples and lists match
+    spec = {"model_type": model_type, "target_col": target_col, "params": params}
+    return json.loads(json.dumps(spec, sort_keys=True, default=repr))
+
+
+def save_model(model, path, feature_cols=None, training=None):
+    """:param training: training_spec of the model, checked by load_model"""
+    joblib.dump(
+        {
+            "model": model,
+            "feature_cols": list(feature_cols or access.updated_feature_cols),
+            "schema_hash": feature_schema_hash(feature_cols),
+            "training": training,
+        },
+        path,
+    )
+
+
+def load_model(path, feature_cols=None, training=None):
+    """:param training: training_spec the model must have been saved with, not checked if None"""
+    saved = joblib.load(path)
+    if saved["schema_hash"] != feature_schema_hash(feature_cols):
+        raise ValueError(
+            f"Model at {path} was trained on {saved['feature_cols']}, not the requested feature columns."
+        )
+    if training is not None and saved.get("training") != training:
+        raise ValueError(f"Model at {path} was trained as {saved.get('training')}, not {training}.")
+    return saved["model"]
+
+
+@instrument.instrumented()
+def train_or_load_model(df, path, target_col="STUDENT_POP", model_type="random_forest", feature_cols=None, retrain=False, **params):
+    """Load a persisted model if its feature schema, model type, target and params all
+    still match, otherwise train and save one.
+    :return: model and the feature matrix built from df (reuse it for predict)
+    """
+    feature_matrix = build_feature_matrix(df, feature_cols)
+    training = training_spec(model_type, target_col, **params)
+    if not retrain and os.path.exists(path):
+        try:
+            return load_model(path, feature_cols, training), feature_matrix
+        except ValueError as e:
+            print(f"Retraining: {e}")
+
+    model, score = train_model(feature_matrix, df[target_col], model_type=model_type, **params)
+    print(f"Trained {model_type}, held out R-squared: {score}")
+    save_model(model, path, feature_cols, training)
+    return model, feature_matrix
@@ -1,35 +1,161 @@
 from .config import *
+from .lazy import lazy_import
 
-from . import access, address
+from . import access, address, instrument
 
-import matplotlib.pyplot as plt
-import osmnx as ox
-import numpy as np
-import pandas as pd
-import seaborn as sns
-from sklearn.linear_model import Ridge, Lasso
-from sklearn.model_selection import cross_val_score
 from statistics import mean
-from sklearn.linear_model import LinearRegression
-from sklearn.metrics import r2_score
-from scipy.stats import pearsonr
-import statsmodels.api as sm
-
-
-def plot_buildings(pois, latitude, longitude, bbox_side):
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+from functools import reduce
+
+# heavy dependencies only load when a function first uses them,
+# sklearn/scipy are imported inside the functions that need them
+plt = lazy_import("matplotlib.pyplot")
+np = lazy_import("numpy")
+pd = lazy_import("pandas")
+sns = lazy_import("seaborn")
+sm = lazy_import("statsmodels.api")
+
+
+# above these counts plots stop drawing every item, so render time depends on the
+# output resolution rather than the number of points/geometries
+max_scatter_points = 50000
+max_vector_geometries = 5000
+max_simplified_geometries = 50000
+
+
+def _axes_pixel_shape(ax):
+    # number of screen pixels covered by the axes, used as the raster resolution
+    bbox = ax.get_window_extent()
+    return max(int(bbox.width), 1), max(int(bbox.height), 1)
+
+
+def density_raster(x, y, extent=None, bins=(400, 400), weights=None):
+    """Bin points into a 2d count grid.
+    :param extent: (xmin, xmax, ymin, ymax), defaults to the data range
+    :param bins: (nx, ny) number of pixels
+    :return: counts with shape (ny, nx) ready for imshow and the extent used
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    finite = np.isfinite(x) & np.isfinite(y)
+    x, y = x[finite], y[finite]
+    if weights is not None:
+        weights = np.asarray(weights, dtype=float)[finite]
+    if extent is None:
+        extent = (x.min(), x.max(), y.min(), y.max())
+
+    counts, _, _ = np.histogram2d(
+        x,
+        y,
+        bins=bins,
+        range=[[extent[0], extent[1]], [extent[2], extent[3]]],
+        weights=weights,
+    )
+    return counts.T, extent
+
+
+def plot_density(ax, x, y, extent=None, bins=None, color="blue", label=None, alpha=0.8):
+    from matplotlib.colors import LinearSegmentedColormap, LogNorm
+
+    if bins is None:
+        bins = _axes_pixel_shape(ax)
+    counts, extent = density_raster(x, y, extent=extent, bins=bins)
+
+    cmap = LinearSegmentedColormap.from_list(f"density_{color}", ["white", color])
+    image = ax.imshow(
+        np.ma.masked_equal(counts, 0),
+        origin="lower",
+        extent=extent,
+        aspect="auto",
+        cmap=cmap,
+        norm=LogNorm(vmin=1, vmax=max(counts.max(), 1)),
+        alpha=alpha,
+        interpolation="nearest",
+    )
+    if label is not None:
+        # imshow has no legend handle, so add an empty one
+        ax.scatter([], [], color=color, label=label)
+    return image
+
+
+def scatter_or_density(ax, x, y, max_points=None, **kwargs):
+    if max_points is None:
+        max_points = max_scatter_points
+    if len(x) <= max_points:
+        return ax.scatter(x, y, **kwargs)
+    return plot_density(ax, x, y, color=kwargs.get("color", "blue"), label=kwargs.get("label"))
+
+
+render_modes = ["auto", "vector", "simplified", "aggregate"]
+
+
+def plot_geometries(ax, gdf, extent, color, label=None, linewidth=None, render="auto"):
+    """Draw a GeoDataFrame, aggregating it once there are too many geometries.
+    :param extent: (west, east, south, north) of the plot
+    :param render: "vector" draws everything, "aggregate" always rasterises,
+        "auto" draws, simplifies to pixel size, or rasterises depending on the count
+    """
+    if render not in render_modes:
+        raise ValueError(f"Unknown render mode {render}, expected one of {render_modes}.")
+    count = len(gdf)
+    if count == 0:
+        return
+    if render == "auto":
+        if count <= max_vector_geometries:
+            render = "vector"
+        elif count <= max_simplified_geometries:
+            render = "simplified"
+        else:
+            render = "aggregate"
+
+    if render == "vector":
+        gdf.plot(ax=ax, color=color, label=label, linewidth=linewidth)
+        return
+
+    if render == "simplified":
+        width_px, height_px = _axes_pixel_shape(ax)
+        tolerance = min(
+            (extent[1] - extent[0]) / width_px, (extent[3] - extent[2]) / height_px
+        )
+        simplified = gdf.geometry.simplify(tolerance, preserve_topology=False)
+        # anything smaller than a pixel collapses, draw those as single pixel markers instead
+        collapsed = simplified.is_empty.values
+        if not collapsed.all():
+            simplified[~collapsed].plot(ax=ax, color=color, label=label, linewidth=linewidth)
+            label = None
+        if collapsed.any():
+            points = gdf.geometry[collapsed].representative_point()
+            ax.scatter(points.x, points.y, s=1, marker="s", linewidths=0, color=color, label=label)
+        return
+
+    points = gdf.geometry.representative_point()
+    plot_density(ax, points.x.values, points.y.values, extent=extent, color=color, label=label)
+
+
+@instrument.instrumented()
+def plot_buildings(pois, latitude, longitude, bbox_side, render="auto"):
     north, south, east, west = access.get_bbox(latitude, longitude, bbox_side)
+    extent = (west, east, south, north)
 
-    graph  = ox.graph_from_bbox(north, south, east, west)
-    nodes, edges = ox.graph_to_gdfs(graph)
+    # served from the street graph cache, only the first call for an area hits overpass
+    edges = access.get_street_edges(north, south, east, west)
 
     buildings_with_address = pois[pois["has_address"]]
     buildings_without_address = pois[~pois["has_address"]]
 
     fig, ax = plt.subplots(figsize=(12, 10))
+    # fix the limits first so rasters and simplification know the pixel size
+    ax.set_xlim(west, east)
+    ax.set_ylim(south, north)
 
-    edges.plot(ax=ax, color="dimgray", linewidth=1)
-    buildings_with_address.plot(ax=ax, color="blue", label="With Address")
-    buildings_without_address.plot(ax=ax, color="red", label="Without Address")
+    # roads are only ever simplified, a density raster of them isn't readable
+    edges_render = "simplified"
+    if render == "vector" or len(edges) <= max_vector_geometries:
+        edges_render = "vector"
+    plot_geometries(ax, edges, extent, color="dimgray", linewidth=1, render=edges_render)
+    plot_geometries(ax, buildings_with_address, extent, color="blue", label="With Address", render=render)
+    plot_geometries(ax, buildings_without_address, extent, color="red", label="Without Address", render=render)
 
     # getting issues if I use a []
     ax.set_xlim(west, east)
@@ -58,8 +184,13 @@ def plot_label_model(ages, population, results, label = "UK", model_type = "Line
     plt.title("Age Distribution and Model Fits")
     plt.show()
 
+@instrument.instrumented()
 def plot_for_features(norm_age_df, columns_to_drop, column_names):
-    access.download_census_data('TS062')
+    from scipy.stats import pearsonr
+    from sklearn.linear_model import LinearRegression
+    from sklearn.metrics import r2_score
+
+    access.download_census_data('TS062', levels=[])
     # print(norm_age_df.shape)
     student_df = access.load_census_data('TS062', "ltla")
     # keep geography + L15 (full time students) + total residents
@@ -83,7 +214,7 @@ def plot_for_features(norm_age_df, columns_to_drop, column_names):
     y_pred = model.predict(X)
 
     plt.figure(figsize=(8, 6))
-    plt.scatter(y, y_pred)
+    scatter_or_density(plt.gca(), y, y_pred)
     plt.xlabel('Actual Percentage of 21-year-olds')
     plt.ylabel('Predicted Percentage of 21-year-olds')
     plt.title('Correlation between Actual and Predicted Percentage of 21-year-olds')
@@ -102,7 +233,7 @@ def plot_for_features(norm_age_df, columns_to_drop, column_names):
     y_pred_linear = results.get_prediction(X).summary_frame(alpha=0.05)
 
     plt.figure(figsize=(8, 6))
-    plt.scatter(y, y_pred_linear["mean"])
+    scatter_or_density(plt.gca(), y, y_pred_linear["mean"].values)
     plt.xlabel('Actual Percentage of 21-year-olds')
     plt.ylabel('Predicted Percentage of 21-year-olds')
     plt.title('Correlation between Actual and Predicted Percentage of 21-year-olds')
@@ -136,16 +267,163 @@ def plot_comparison(predicted_profile, actual_profile, city_name):
 
 def plot_predicted_student(y, y_pred):
     plt.figure(figsize=(8, 6))
-    plt.scatter(y, y_pred)
+    # one point per output area, so this switches to a density raster at full resolution
+    scatter_or_density(plt.gca(), y, y_pred)
     plt.xlabel('Actual Percentage of Student Population')
     plt.ylabel('Predicted Percentage of Student Population')
     plt.title('Correlation between Actual and Predicted Percentage of Student Population Proportion')
     plt.show()
 
+"""
+---------------------------------------STREAMING CORRELATION---------------------------------------
+"""
+
+# correlations are built from sufficient statistics so a table never has to be in memory at once.
+# every statistic is kept per pair of columns ([i, j] only counts rows where both are present),
+# which gives the same pairwise handling of missing values as DataFrame.corr()
+
+
+def init_correlation_stats(columns):
+    num_columns = len(columns)
+    return {
+        "columns": list(columns),
+        "shift": None,
+        "count": np.zeros((num_columns, num_columns)),
+        "sum": np.zeros((num_columns, num_columns)),
+        "sum_sq": np.zeros((num_columns, num_columns)),
+        "cross": np.zeros((num_columns, num_columns)),
+    }
+
+
+def update_correlation_stats(stats, chunk):
+    values = chunk[stats["columns"]].to_numpy(dtype=np.float64)
+    present = np.isfinite(values)
+
+    if stats["shift"] is None:
+        # centre on the first chunk's means to avoid cancellation in sum_sq / cross
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", RuntimeWarning)
+            stats["shift"] = np.nan_to_num(np.nanmean(values, axis=0))
+
+    centred = np.where(present, values - stats["shift"], 0.0)
+    mask = present.astype(np.float64)
+
+    stats["count"] += mask.T @ mask
+    stats["sum"] += centred.T @ mask
+    stats["sum_sq"] += (centred * centred).T @ mask
+    stats["cross"] += centred.T @ centred
+    return stats
+
+
+def _reshift_correlation_stats(stats, shift):
+    # re-express the sums around a different centre: x - shift = (x - old_shift) + delta
+    delta = stats["shift"] - shift
+    delta_i, delta_j = delta[:, np.newaxis], delta[np.newaxis, :]
+    count, sums = stats["count"], stats["sum"]
+    return {
+        "columns": stats["columns"],
+        "shift": shift,
+        "count": count,
+        "sum": sums + delta_i * count,
+        "sum_sq": stats["sum_sq"] + 2 * delta_i * sums + delta_i**2 * count,
+        "cross": stats["cross"] + delta_j * sums + delta_i * sums.T + delta_i * delta_j * count,
+    }
+
+
+def merge_correlation_stats(stats_a, stats_b):
+    """Combine partial statistics, e.g. computed over different chunks in parallel."""
+    if stats_a["columns"] != stats_b["columns"]:
+        raise ValueError("Can only merge correlation stats over the same columns.")
+    if stats_a["shift"] is None:
+        return stats_b
+    if stats_b["shift"] is None:
+        return stats_a
+
+    stats_b = _reshift_correlation_stats(stats_b, stats_a["shift"])
+    return {
+        "columns": stats_a["columns"],
+        "shift": stats_a["shift"],
+        "count": stats_a["count"] + stats_b["count"],
+        "sum": stats_a["sum"] + stats_b["sum"],
+        "sum_sq": stats_a["sum_sq"] + stats_b["sum_sq"],
+        "cross": stats_a["cross"] + stats_b["cross"],
+    }
+
+
+def covariance_from_stats(stats, min_periods=2):
+    count = stats["count"]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean_i = stats["sum"] / count
+        cov = (stats["cross"] - count * mean_i * mean_i.T) / (count - 1)
+    cov[count < max(min_periods, 2)] = np.nan
+    return pd.DataFrame(cov, index=stats["columns"], columns=stats["columns"])
+
+
+def correlation_from_stats(stats, min_periods=1):
+    count = stats["count"]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean_i = stats["sum"] / count
+        cov = stats["cross"] / count - mean_i * mean_i.T
+        var_i = stats["sum_sq"] / count - mean_i**2
+        corr = cov / np.sqrt(var_i * var_i.T)
+    corr = np.clip(corr, -1, 1)
+    corr[count < min_periods] = np.nan
+    return pd.DataFrame(corr, index=stats["columns"], columns=stats["columns"])
+
+
+@instrument.instrumented()
+def streaming_correlation_stats(chunks, columns):
+    """Accumulate correlation statistics over an iterable of DataFrames,
+    e.g. access.read_data_in_chunks(...) or pd.read_csv(..., chunksize=...).
+    """
+    stats = init_correlation_stats(columns)
+    for chunk in chunks:
+        instrument.rows_in(len(chunk))
+        update_correlation_stats(stats, chunk)
+    return stats
+
+
+def csv_correlation_stats(csv_file_name, columns, chunksize=100000):
+    return streaming_correlation_stats(
+        pd.read_csv(csv_file_name, usecols=columns, chunksize=chunksize), columns
+    )
+
+
+@instrument.instrumented()
+def parallel_correlation_stats(csv_file_names, columns, max_workers=None, chunksize=100000):
+    # one worker per file, partial results are merged at the end
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        partial_stats = executor.map(
+            csv_correlation_stats,
+            csv_file_names,
+            [columns] * len(csv_file_names),
+            [chunksize] * len(csv_file_names),
+        )
+        return reduce(merge_correlation_stats, partial_stats, init_correlation_stats(columns))
+
+
+@instrument.instrumented()
+def sampled_correlation(conn, table_name, columns, n=100000, method="server", seed=0):
+    """Correlations estimated from a uniform access.read_sample of the table, for tables
+    too big for streaming_correlation_stats to be quick. A stratified sample would
+    over-weight small strata, so this one isn't stratified."""
+    sample_df = access.read_sample(conn, table_name, n=n, method=method, seed=seed)
+    instrument.rows_in(len(sample_df))
+    return sample_df[columns].astype(float).corr()
+
+
+@instrument.instrumented()
 def look_at_correlation_between_features_and_result(proficiency_merged):
-    correlation_results = proficiency_merged[access.feature_cols + ['STUDENT_POP', 'non_main_language_pop']] \
-    .corr()['STUDENT_POP'] \
-    .drop('STUDENT_POP')
+    # proficiency_merged can be a DataFrame, an iterable of chunks or already accumulated stats
+    columns = access.feature_cols + ['STUDENT_POP', 'non_main_language_pop']
+    if isinstance(proficiency_merged, pd.DataFrame):
+        correlation_matrix = proficiency_merged[columns].corr()
+    else:
+        stats = proficiency_merged
+        if not isinstance(stats, dict):
+            stats = streaming_correlation_stats(proficiency_merged, columns)
+        correlation_matrix = correlation_from_stats(stats)
+    correlation_results = correlation_matrix['STUDENT_POP'].drop('STUDENT_POP')
 
     sorted_correlations = correlation_results.abs().sort_values(ascending=False)
 
@@ -0,0 +1,192 @@
+import re
+
+from . import instrument
+
+# Embedded DuckDB backend for the read heavy queries. DuckDB stores tables by
+# column and runs scans, aggregates and joins vectorised in process, so no rows
+# cross a socket and only the referenced columns are read.
+#
+# The connection wraps duckdb behind the pymysql interface access.py uses
+# (conn.cursor(), curr.execute(query, args), fetch*, conn.commit()) and translates
+# the MariaDB dialect the access functions send, so they work unchanged with
+#   conn = access.create_duckdb_connection("fynesse.duckdb")
+
+_load_data = re.compile(
+    r"LOAD DATA LOCAL INFILE\s+'(?P<path>[^']+)'\s+INTO TABLE\s+\"?(?P<table>\w+)\"?"
+    r"(?P<options>.*?)(IGNORE\s+(?P<ignore>\d+)\s+LINES)?\s*;?\s*$",
+    re.IGNORECASE | re.DOTALL,
+)
+_show_columns = re.compile(r"^\s*SHOW COLUMNS FROM\s+\"?(?P<table>\w+)\"?", re.IGNORECASE)
+# session settings, AUTO_INCREMENT/partition changes and secondary indexes have no
+# DuckDB equivalent worth keeping: min/max zonemaps already prune scans, and ART
+# indexes would only slow the bulk loads down. ALTER TABLE ... ADD COLUMN still runs.
+_skipped = re.compile(
+    r"^\s*(SET|USE|ALTER TABLE(?!\s+\S+\s+ADD COLUMN)|CREATE INDEX|CREATE UNIQUE INDEX)\b",
+    re.IGNORECASE,
+)
+
+_insert_values = re.compile(
+    r"^\s*INSERT INTO\s+\"?(?P<table>\w+)\"?\s+VALUES\s*\((\s*\?\s*,)*\s*\?\s*\)\s*;?\s*$",
+    re.IGNORECASE,
+)
+
+_escapes = {"n": "\n", "t": "\t", "r": "\r", "0": "\0"}
+
+
+def _requote(query):
+    # MariaDB quotes identifiers with backticks and accepts strings in double quotes,
+    # DuckDB uses double quotes for identifiers and only single quotes for strings.
+    # %s placeholders outside strings become ?.
+    out = []
+    i = 0
+    while i < len(query):
+        char = query[i]
+        if char in "'\"":
+            end = i + 1
+            value = []
+            while end < len(query):
+                if query[end] == "\\" and end + 1 < len(query):
+                    value.append(_escapes.get(query[end + 1], query[end + 1]))
+                    end += 2
+                    continue
+                if query[end] == char:
+                    if end + 1 < len(query) and query[end + 1] == char:
+                        value.append(char)
+                        end += 2
+                        continue
+                    break
+                value.append(query[end])
+                end += 1
+            out.append("'" + "".join(value).replace("'", "''") + "'")
+            i = end + 1
+        elif char == "`":
+            end = query.index("`", i + 1)
+            out.append('"' + query[i + 1:end] + '"')
+            i = end + 1
+        elif query.startswith("%s", i):
+            out.append("?")
+            i += 2
+        else:
+            out.append(char)
+            i += 1
+    return "".join(out)
+
+
+def translate(query):
+    """Rewrite a MariaDB statement from access.py into DuckDB SQL."""
+    query = _requote(query)
+    query = re.sub(r"\s+COLLATE\s*=?\s*\w+", "", query, flags=re.IGNORECASE)
+    query = re.sub(r"\)\s*(DEFAULT\s+)?CHARSET\s*=.*$", ");", query, flags=re.IGNORECASE | re.DOTALL)
+    query = re.sub(r"\bbigint\(\d+\)\s+unsigned\b", "UBIGINT", query, flags=re.IGNORECASE)
+    query = re.sub(r"\bint\(\d+\)\s+unsigned\b", "UINTEGER", query, flags=re.IGNORECASE)
+    query = re.sub(r"\b(bigint|int|tinyint|smallint)\(\d+\)", r"\1", query, flags=re.IGNORECASE)
+    query = re.sub(r"\bAUTO_INCREMENT\b(=\d+)?", "", query, flags=re.IGNORECASE)
+    # every cursor is its own duckdb connection with its own temp schema, so temporary
+    # tables have to be ordinary tables to be seen by the cursor that queries them
+    query = re.sub(r"\b(CREATE|DROP) TEMPORARY TABLE\b", r"\1 TABLE", query, flags=re.IGNORECASE)
+    return query
+
+
+class DuckDBCursor:
+    def __init__(self, conn):
+        self.cursor = conn.cursor()
+        self.description = None
+        self.rowcount = -1
+
+    def execute(self, query, args=None):
+        query = translate(query)
+        if _skipped.match(query):
+            return 0
+
+        match = _show_columns.match(query)
+        if match:
+            query = (
+                "SELECT column_name, data_type FROM information_schema.columns "
+                f"WHERE table_name = '{match['table']}' ORDER BY ordinal_position"
+            )
+            args = None
+
+        match = _load_data.match(query.strip())
+        if match:
+            return self._load_data(match)
+
+        self.cursor.execute(query, args)
+        self.description = self.cursor.description
+        self.rowcount = self.cursor.rowcount
+        return self.rowcount
+
+    def executemany(self, query, args):
+        query = translate(query)
+        match = _insert_values.match(query)
+        if match:
+            # one vectorised insert from a frame rather than a statement per row
+            import pandas as pd
+
+            self.insert_frame(match["table"], pd.DataFrame.from_records(list(args)))
+        else:
+            self.cursor.executemany(query, [list(row) for row in args])
+            self.rowcount = -1
+        self.description = None
+        return self.rowcount
+
+    def insert_frame(self, table_name, frame):
+        """Append a DataFrame whose columns are in table order, scanned in place by duckdb."""
+        self.cursor.register("inserted_frame", frame)
+        try:
+            self.cursor.execute(f'INSERT INTO "{table_name}" SELECT * FROM inserted_frame')
+        finally:
+            self.cursor.unregister("inserted_frame")
+        self.rowcount = len(frame)
+        self.description = None
+        return self.rowcount
+
+    def _load_data(self, match):
+        # LOAD DATA LOCAL INFILE becomes a vectorised read_csv insert
+        skip = int(match["ignore"] or 0)
+        self.cursor.execute(
+            f"""INSERT INTO "{match['table']}" SELECT * FROM read_csv(?,
+            delim=',', quote='"', escape='"', header=false, skip={skip}, all_varchar=true)""",
+            [match["path"]],
+        )
+        self.rowcount = self.cursor.fetchone()[0]
+        self.description = None
+        return self.rowcount
+
+    def fetchone(self):
+        return self.cursor.fetchone()
+
+    def fetchmany(self, size=1):
+        return self.cursor.fetchmany(size)
+
+    def fetchall(self):
+        return self.cursor.fetchall()
+
+    def fetch_df(self):
+        """The pending result as a DataFrame, built column-wise without python tuples."""
+        return self.cursor.df()
+
+    def close(self):
+        self.cursor.close()
+
+
+class DuckDBConnection:
+    def __init__(self, database=":memory:", read_only=False):
+        import duckdb
+
+        self.database = database
+        self.conn = duckdb.connect(database, read_only=read_only)
+
+    def cursor(self, cursorclass=None):
+        # the pymysql cursor class is irrelevant here, duckdb always streams
+        return instrument.instrumented_cursor_class(DuckDBCursor)(self.conn)
+
+    def commit(self):
+        # duckdb autocommits each statement
+        pass
+
+    def close(self):
+        self.conn.close()
+
+
+def is_duckdb(conn):
+    return isinstance(conn, DuckDBConnection)
@@ -1,35 +1,103 @@
 import os
-import yaml
 
 default_file = os.path.join(os.path.dirname(__file__), "defaults.yml")
 local_file = os.path.abspath(os.path.join(os.path.dirname(__file__), "machine.yml"))
 user_file = '_config.yml'
 
-config = {}
-
-if os.path.exists(default_file):
-    with open(default_file) as file:
-        config.update(yaml.load(file, Loader=yaml.FullLoader))
-
-if os.path.exists(local_file):
-    with open(local_file) as file:
-        config.update(yaml.load(file, Loader=yaml.FullLoader))
-
-if os.path.exists(user_file):
-    with open(user_file) as file:
-        config.update(yaml.load(file, Loader=yaml.FullLoader))
-
-if config=={}:
-    raise ValueError(
-        "No configuration file found at either "
-        + user_file
-        + " or "
-        + local_file
-        + " or "
-        + default_file
-        + "."
-    )
-
-for key, item in config.items():
-    if item is str:
-        config[key] = os.path.expandvars(item)
+
+def load_config():
+    import yaml
+
+    config = {}
+
+    if os.path.exists(default_file):
+        with open(default_file) as file:
+            config.update(yaml.load(file, Loader=yaml.FullLoader))
+
+    if os.path.exists(local_file):
+        with open(local_file) as file:
+            config.update(yaml.load(file, Loader=yaml.FullLoader))
+
+    if os.path.exists(user_file):
+        with open(user_file) as file:
+            config.update(yaml.load(file, Loader=yaml.FullLoader))
+
+    if config=={}:
+        raise ValueError(
+            "No configuration file found at either "
+            + user_file
+            + " or "
+            + local_file
+            + " or "
+            + default_file
+            + "."
+        )
+
+    for key, item in config.items():
+        if item is str:
+            config[key] = os.path.expandvars(item)
+    return config
+
+
+class LazyConfig(dict):
+    """The config dict, filled from the yaml files the first time it is used
+    rather than when fynesse is imported."""
+
+    _loaded = False
+
+    def _load(self):
+        if not self._loaded:
+            self._loaded = True
+            dict.update(self, load_config())
+        return self
+
+    def __getitem__(self, key):
+        return dict.__getitem__(self._load(), key)
+
+    def __setitem__(self, key, value):
+        dict.__setitem__(self._load(), key, value)
+
+    def __delitem__(self, key):
+        dict.__delitem__(self._load(), key)
+
+    def __contains__(self, key):
+        return dict.__contains__(self._load(), key)
+
+    def __iter__(self):
+        return dict.__iter__(self._load())
+
+    def __len__(self):
+        return dict.__len__(self._load())
+
+    def __eq__(self, other):
+        return dict.__eq__(self._load(), other)
+
+    def __repr__(self):
+        return dict.__repr__(self._load())
+
+    def get(self, key, default=None):
+        return dict.get(self._load(), key, default)
+
+    def keys(self):
+        return dict.keys(self._load())
+
+    def items(self):
+        return dict.items(self._load())
+
+    def values(self):
+        return dict.values(self._load())
+
+    def update(self, *args, **kwargs):
+        dict.update(self._load(), *args, **kwargs)
+
+    def setdefault(self, key, default=None):
+        return dict.setdefault(self._load(), key, default)
+
+    def pop(self, key, *args):
+        return dict.pop(self._load(), key, *args)
+
+    def copy(self):
+        return dict(self.items())
+
+
+config = LazyConfig()
@@ -0,0 +1,208 @@
+import hashlib
+import json
+import os
+import shutil
+import time
+
+from .config import *
+from .lazy import lazy_import
+from . import access, instrument
+
+np = lazy_import("numpy")
+pd = lazy_import("pandas")
+
+# The OA level feature matrix (osm_data joined to census_student_coordinates_join
+# and proficiency) materialised once as one .npy file per column plus a sorted
+# OA21CD index, all opened with mmap so readers only touch the pages they use and
+# concurrent processes share them through the page cache.
+#
+#   store = feature_store.open_feature_store(conn)
+#   X = store.matrix(access.updated_feature_cols)
+#
+# Each build lives in its own directory named after the source table versions
+# (access.get_table_versions) and the columns, and CURRENT names the latest one.
+# Opening with a connection rebuilds when a source table has been reloaded since,
+# opening without one (or with rebuild=False) only reads the files.
+
+source_tables = ["osm_data", "census_student_coordinates_join", "proficiency"]
+
+# the tables each non osm_data column comes from
+_census_columns = ["TOTAL_POP", "STUDENT_POP", "TOTAL_RAW_POP"]
+_proficiency_columns = ["non_main_language_pop"]
+
+# the modelling targets are stored alongside the features
+default_columns = access.feature_cols + ["STUDENT_POP", "non_main_language_pop"]
+
+index_column = "OA21CD"
+
+
+def _store_dir(store_dir=None):
+    if store_dir is None:
+        store_dir = config.get("feature_store_dir", "feature_store")
+    os.makedirs(store_dir, exist_ok=True)
+    return store_dir
+
+
+def _version_name(versions, columns):
+    stamp = json.dumps({"versions": versions, "columns": list(columns)}, sort_keys=True)
+    return hashlib.sha256(stamp.encode()).hexdigest()[:16]
+
+
+def _qualified(column):
+    if column in _census_columns:
+        return f"c.`{column}`"
+    if column in _proficiency_columns:
+        return f"p.`{column}`"
+    return f"o.`{column}`"
+
+
+def _feature_query(columns):
+    selected = ", ".join(_qualified(column) for column in columns)
+    return f"""
+        SELECT c.`{index_column}`, {selected}
+        FROM `osm_data` AS o
+        INNER JOIN `census_student_coordinates_join` AS c ON o.`FID` = c.`FID`
+        LEFT JOIN `proficiency` AS p ON p.`local_authorities_code` = c.`{index_column}`
+        ORDER BY c.`{index_column}`;
+    """
+
+
+def _write_store(path, df, columns, versions):
+    os.makedirs(path)
+    codes = df[index_column].astype(str).to_numpy()
+    np.save(os.path.join(path, f"{index_column}.npy"), codes.astype("S"))
+    for column in columns:
+        np.save(
+            os.path.join(path, f"{column}.npy"),
+            df[column].to_numpy(dtype=np.float32, na_value=np.nan),
+        )
+    with open(os.path.join(path, "manifest.json"), "w") as file:
+        json.dump(
+            {
+                "columns": list(columns),
+                "rows": len(df),
+                "source_versions": versions,
+                "built": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            },
+            file,
+        )
+
+
+def _set_current(store_dir, name):
+    # write then rename so readers never see a half written pointer
+    current_path = os.path.join(store_dir, "CURRENT")
+    with open(current_path + ".tmp", "w") as file:
+        file.write(name)
+    os.replace(current_path + ".tmp", current_path)
+
+
+def _remove_old_versions(store_dir, keep):
+    # readers that still have an old version mapped keep their pages until they close it
+    builds = [
+        os.path.join(store_dir, name)
+        for name in os.listdir(store_dir)
+        if os.path.exists(os.path.join(store_dir, name, "manifest.json"))
+    ]
+    builds.sort(key=os.path.getmtime, reverse=True)
+    for path in builds[keep:]:
+        shutil.rmtree(path, ignore_errors=True)
+
+
+@instrument.instrumented()
+def build_feature_store(conn, store_dir=None, columns=None, versions=None, keep_versions=2):
+    """Join the source tables once and write the result as memory mappable column files.
+    :return: path of the new build
+    """
+    store_dir = _store_dir(store_dir)
+    columns = list(columns or default_columns)
+    if versions is None:
+        versions = access.get_table_versions(conn, source_tables)
+    name = _version_name(versions, columns)
+    path = os.path.join(store_dir, name)
+
+    if not os.path.exists(path):
+        df = access.read_frame(conn, query=_feature_query(columns))
+        instrument.rows_out(len(df))
+        # build beside the store and rename into place, so a concurrent reader or
+        # builder only ever sees complete builds
+        tmp_path = os.path.join(store_dir, f".{name}.{os.getpid()}.tmp")
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        _write_store(tmp_path, df, columns, versions)
+        try:
+            os.rename(tmp_path, path)
+        except OSError:
+            # another process finished the same build first
+            shutil.rmtree(tmp_path, ignore_errors=True)
+
+    _set_current(store_dir, name)
+    _remove_old_versions(store_dir, keep_versions)
+    return path
+
+
+class FeatureStore:
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, "manifest.json")) as file:
+            self.manifest = json.load(file)
+        self.index = np.load(os.path.join(path, f"{index_column}.npy"), mmap_mode="r")
+        self.columns = {
+            column: np.load(os.path.join(path, f"{column}.npy"), mmap_mode="r")
+            for column in self.manifest["columns"]
+        }
+
+    def __len__(self):
+        return self.manifest["rows"]
+
+    def __getitem__(self, column):
+        return self.columns[column]
+
+    def positions(self, codes):
+        """Row positions of the given OA21CD codes, -1 where a code isn't in the store."""
+        codes = np.asarray(codes, dtype=self.index.dtype)
+        if len(self.index) == 0:
+            return np.full(codes.shape, -1, dtype=np.int64)
+        positions = np.searchsorted(self.index, codes)
+        positions = np.minimum(positions, len(self.index) - 1)
+        return np.where(self.index[positions] == codes, positions, -1)
+
+    def matrix(self, columns=None, rows=None):
+        """C-contiguous float32 (rows x columns) array, ready for the models in address."""
+        columns = list(columns or self.manifest["columns"])
+        matrix = np.empty((len(self) if rows is None else len(rows), len(columns)), dtype=np.float32)
+        for i, column in enumerate(columns):
+            matrix[:, i] = self.columns[column] if rows is None else self.columns[column][rows]
+        return matrix
+
+    def frame(self, columns=None):
+        columns = list(columns or self.manifest["columns"])
+        index = pd.Index(np.char.decode(self.index), name=index_column)
+        return pd.DataFrame({column: self.columns[column] for column in columns}, index=index)
+
+
+@instrument.instrumented()
+def open_feature_store(conn=None, store_dir=None, columns=None, rebuild=True):
+    """Open the current feature store build.
+    With a connection and rebuild=True the source table versions are checked first
+    and the store is rebuilt if it is stale. Otherwise the current build is opened
+    straight from disk, without querying the database.
+    """
+    store_dir = _store_dir(store_dir)
+    current_path = os.path.join(store_dir, "CURRENT")
+
+    if conn is None or not rebuild:
+        if not os.path.exists(current_path):
+            raise FileNotFoundError(f"No feature store has been built in {store_dir} yet.")
+        with open(current_path) as file:
+            store = FeatureStore(os.path.join(store_dir, file.read().strip()))
+        missing = [column for column in columns or [] if column not in store.columns]
+        if missing:
+            raise ValueError(f"The current feature store in {store_dir} has no columns {missing}.")
+        return store
+
+    columns = list(columns or default_columns)
+    versions = access.get_table_versions(conn, source_tables)
+    path = os.path.join(store_dir, _version_name(versions, columns))
+    if not os.path.exists(path):
+        print("Building the feature store for the current source tables")
+        path = build_feature_store(conn, store_dir, columns, versions)
+    return FeatureStore(path)
@@ -0,0 +1,259 @@
+import contextlib
+import contextvars
+import functools
+import json
+import threading
+import time
+import tracemalloc
+
+# Per stage metrics for the access/assess/address pipeline. Nothing is recorded
+# until a sink is enabled, so the decorators cost one check when switched off.
+#
+#   instrument.enable(instrument.JsonLinesSink("metrics.jsonl"))
+#   access.create_osm_data(conn)
+#   instrument.disable()
+#
+# Each finished stage emits one record: wall/cpu time, time spent waiting on SQL vs
+# in the client, rows in/out, traced memory, and HTTP requests/bytes (overpass
+# included, as osmnx goes through requests). Stages nest, and a parent's SQL and
+# HTTP totals include those of its children.
+
+_sinks = []
+_trace_memory = False
+_current_stage = contextvars.ContextVar("fynesse_stage", default=None)
+_lock = threading.Lock()
+
+
+class MemorySink:
+    def __init__(self):
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+    def to_frame(self):
+        import pandas as pd
+
+        return pd.DataFrame(self.records)
+
+
+class JsonLinesSink:
+    def __init__(self, path):
+        self.path = path
+
+    def emit(self, record):
+        with _lock, open(self.path, "a") as file:
+            file.write(json.dumps(record, default=str) + "\n")
+
+
+def enable(*sinks, trace_memory=True):
+    """Start recording stages into the given sinks.
+    :param trace_memory: track peak memory with tracemalloc (slows allocation heavy code)
+    """
+    global _trace_memory
+    _sinks.extend(sinks)
+    _trace_memory = trace_memory
+    if trace_memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+    _track_http()
+
+
+def disable():
+    global _trace_memory
+    _sinks.clear()
+    if _trace_memory and tracemalloc.is_tracing():
+        tracemalloc.stop()
+    _trace_memory = False
+
+
+def is_enabled():
+    return bool(_sinks)
+
+
+class Stage:
+    def __init__(self, name, parent):
+        self.name = name
+        self.parent = parent
+        self.rows_in = None
+        self.rows_out = None
+        self.sql_s = 0.0
+        self.http_requests = 0
+        self.http_bytes = 0
+        self.memory_start = None
+        self.memory_peak = None
+
+    def record(self, wall_s, cpu_s, start, error):
+        return {
+            "stage": self.name,
+            "parent": self.parent.name if self.parent is not None else None,
+            "start": start,
+            "wall_s": wall_s,
+            "cpu_s": cpu_s,
+            "sql_s": self.sql_s,
+            "client_s": max(wall_s - self.sql_s, 0.0),
+            "rows_in": self.rows_in,
+            "rows_out": self.rows_out,
+            "memory_start_bytes": self.memory_start,
+            "memory_peak_bytes": self.memory_peak,
+            "http_requests": self.http_requests,
+            "http_bytes": self.http_bytes,
+            "error": error,
+        }
+
+
+@contextlib.contextmanager
+def stage(name):
+    """Time one pipeline stage, a no-op (yielding None) unless enable() was called."""
+    if not _sinks:
+        yield None
+        return
+
+    parent = _current_stage.get()
+    current_stage = Stage(name, parent)
+    if _trace_memory and tracemalloc.is_tracing():
+        current, peak = tracemalloc.get_traced_memory()
+        # keep the parent's peak so far before resetting it for this stage
+        if parent is not None:
+            parent.memory_peak = max(parent.memory_peak or 0, peak)
+        tracemalloc.reset_peak()
+        current_stage.memory_start = current
+
+    token = _current_stage.set(current_stage)
+    start = time.time()
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
+    error = None
+    try:
+        yield current_stage
+    except BaseException as e:
+        error = type(e).__name__
+        raise
+    finally:
+        wall_s = time.perf_counter() - wall_start
+        cpu_s = time.process_time() - cpu_start
+        _current_stage.reset(token)
+
+        if current_stage.memory_start is not None and tracemalloc.is_tracing():
+            peak = tracemalloc.get_traced_memory()[1]
+            current_stage.memory_peak = max(current_stage.memory_peak or 0, peak)
+            if parent is not None:
+                parent.memory_peak = max(parent.memory_peak or 0, current_stage.memory_peak)
+        if parent is not None:
+            parent.sql_s += current_stage.sql_s
+            parent.http_requests += current_stage.http_requests
+            parent.http_bytes += current_stage.http_bytes
+
+        record = current_stage.record(wall_s, cpu_s, start, error)
+        for sink in list(_sinks):
+            sink.emit(record)
+
+
+def instrumented(name=None):
+    """Decorator running the function inside a stage named after it."""
+
+    def decorator(func):
+        stage_name = name or f"{func.__module__.split('.')[-1]}.{func.__name__}"
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _sinks:
+                return func(*args, **kwargs)
+            with stage(stage_name):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def rows_in(count):
+    current_stage = _current_stage.get()
+    if current_stage is not None:
+        current_stage.rows_in = (current_stage.rows_in or 0) + int(count)
+
+
+def rows_out(count):
+    current_stage = _current_stage.get()
+    if current_stage is not None:
+        current_stage.rows_out = (current_stage.rows_out or 0) + int(count)
+
+
+def add_sql_time(seconds):
+    current_stage = _current_stage.get()
+    if current_stage is not None:
+        current_stage.sql_s += seconds
+
+
+def add_http_request(num_bytes):
+    current_stage = _current_stage.get()
+    if current_stage is not None:
+        current_stage.http_requests += 1
+        current_stage.http_bytes += num_bytes
+
+
+"""
+---------------------------------------SQL---------------------------------------
+"""
+
+_cursor_classes = {}
+
+
+def instrumented_cursor_class(base):
+    """Subclass of a pymysql cursor class that charges execute/fetch time to the current stage."""
+    if base in _cursor_classes:
+        return _cursor_classes[base]
+
+    def timed(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            if _current_stage.get() is None:
+                return method(self, *args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return method(self, *args, **kwargs)
+            finally:
+                add_sql_time(time.perf_counter() - start)
+
+        return wrapper
+
+    methods = {
+        method: timed(getattr(base, method))
+        # executemany goes through execute, so it is not timed separately
+        for method in ["execute", "fetchone", "fetchmany", "fetchall"]
+    }
+    _cursor_classes[base] = type(f"Instrumented{base.__name__}", (base,), methods)
+    return _cursor_classes[base]
+
+
+"""
+---------------------------------------HTTP---------------------------------------
+"""
+
+_http_tracked = False
+
+
+def _track_http():
+    # every requests call (ours and osmnx's) goes through HTTPAdapter.send
+    global _http_tracked
+    if _http_tracked:
+        return
+    try:
+        from requests.adapters import HTTPAdapter
+    except ImportError:
+        return
+
+    send = HTTPAdapter.send
+
+    @functools.wraps(send)
+    def counting_send(self, request, stream=False, *args, **kwargs):
+        response = send(self, request, stream, *args, **kwargs)
+        if _current_stage.get() is not None:
+            if stream:
+                num_bytes = int(response.headers.get("Content-Length", 0))
+            else:
+                num_bytes = len(response.content)
+            add_http_request(num_bytes)
+        return response
+
+    HTTPAdapter.send = counting_send
+    _http_tracked = True
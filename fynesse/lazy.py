@@ -0,0 +1,36 @@
+import importlib
+
+
+class LazyModule:
+    """Stands in for a module and only imports it on first attribute access.
+
+    Used for the heavy dependencies (pandas, osmnx, matplotlib, ...) so that
+    importing fynesse, or calling a function that doesn't need them, doesn't
+    pay their import time.
+    """
+
+    def __init__(self, name):
+        self.__dict__["_name"] = name
+        self.__dict__["_module"] = None
+
+    def _load(self):
+        if self._module is None:
+            self.__dict__["_module"] = importlib.import_module(self._name)
+        return self._module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __setattr__(self, attr, value):
+        setattr(self._load(), attr, value)
+
+    def __dir__(self):
+        return dir(self._load())
+
+    def __repr__(self):
+        state = "loaded" if self._module is not None else "not loaded"
+        return f"<lazy module '{self._name}' ({state})>"
+
+
+def lazy_import(name):
+    return LazyModule(name)
@@ -0,0 +1,336 @@
+import argparse
+import hashlib
+import inspect
+import json
+import os
+import sys
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from .config import *
+from . import access, instrument
+
+# The CSV -> table rebuild as a DAG. Each step declares the files and tables it
+# reads and writes; the edges follow from those, so independent branches (the
+# income/health/education loads and the census -> OSM chain) run side by side.
+#
+# A step is skipped when its key, the hash of its code and of every input, is the
+# one recorded the last time it ran and its outputs are still the ones it wrote.
+# Files are hashed by content (rehashed only when their size or mtime changes) and
+# tables by their access.get_table_versions counter and row count, so regenerating
+# an identical CSV doesn't reload its table.
+#
+#   $ fynesse-pipeline --jobs 4 --dry-run
+#   $ fynesse-pipeline osm_data_db --mysql user:password@host:3306/database
+#
+#   pipeline.run_pipeline(lambda: access.create_duckdb_connection("fynesse.duckdb"), jobs=4)
+
+
+def table(name):
+    """A table dependency of a step, the other dependencies are file paths."""
+    return f"table:{name}"
+
+
+def _table_name(dependency):
+    return dependency[len("table:"):] if dependency.startswith("table:") else None
+
+
+class Step:
+    def __init__(self, name, func, inputs=(), outputs=(), uses_conn=True):
+        self.name = name
+        self.func = func
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.uses_conn = uses_conn
+
+    def run(self, conn):
+        return self.func(conn) if self.uses_conn else self.func()
+
+    def code_hash(self):
+        try:
+            source = inspect.getsource(self.func)
+        except (OSError, TypeError):
+            source = f"{self.func.__module__}.{self.func.__qualname__}"
+        return hashlib.sha256(source.encode()).hexdigest()
+
+    def __repr__(self):
+        return f"Step({self.name!r})"
+
+
+steps = [
+    Step("census_coordinates_db", access.initialize_census_coordinates_db,
+         ["census_data.csv"], [table("census_coordinates")]),
+    Step("census_student_pop", access.create_census_student_pop,
+         [], ["student_data.csv"], uses_conn=False),
+    Step("census_student_pop_db", access.initialize_census_student_pop_db,
+         ["student_data.csv"], [table("census_student_pop")]),
+    Step("student_coordinates_join", access.create_student_coordinates_join,
+         [table("census_coordinates"), table("census_student_pop")], ["census_student_coordinates_join.csv"]),
+    Step("census_student_coordinates_join_db", access.initialize_census_student_coordinates_join_db,
+         ["census_student_coordinates_join.csv"], [table("census_student_coordinates_join")]),
+    Step("proficiency", access.create_proficiency,
+         ["proficiency_in_english.csv"], ["proficiency.csv"]),
+    Step("proficiency_db", access.initialize_proficiency_db,
+         ["proficiency.csv"], [table("proficiency")]),
+    Step("osm_data", access.create_osm_data,
+         [table("census_student_coordinates_join")], ["osm_data.csv"]),
+    Step("osm_data_db", access.initialize_osm_data_db,
+         ["osm_data.csv"], [table("osm_data")]),
+    Step("income_db", access.initialize_income_db,
+         ["income_statistics_removed.csv"], [table("income")]),
+    Step("general_health_db", access.initialize_general_health_db,
+         ["general_health.csv"], [table("general_health")]),
+    Step("health_2011_db", access.initialize_health_db_2011,
+         ["health_2011.csv"], [table("health_2011")]),
+    Step("education_db", access.initialize_education_db,
+         ["level_of_education.csv"], [table("education")]),
+    Step("education_2011", access.create_education_2011,
+         ["level_of_education_2011_district.csv"], ["education_2011.csv"], uses_conn=False),
+    Step("education_2011_db", access.initialize_education_2011,
+         ["education_2011.csv"], [table("education_2011")]),
+]
+
+
+def _state_file(state_file=None):
+    if state_file is None:
+        state_file = config.get("pipeline_state", ".fynesse_pipeline.json")
+    return state_file
+
+
+def _load_state(state_file):
+    if os.path.exists(state_file):
+        with open(state_file) as file:
+            return json.load(file)
+    return {"steps": {}, "files": {}}
+
+
+def _save_state(state_file, state):
+    tmp_file = state_file + ".tmp"
+    with open(tmp_file, "w") as file:
+        json.dump(state, file, indent=1, sort_keys=True)
+    os.replace(tmp_file, state_file)
+
+
+def _file_hash(path, file_hashes):
+    if not os.path.exists(path):
+        return None
+    stat = os.stat(path)
+    cached = file_hashes.get(path)
+    if cached and cached["size"] == stat.st_size and cached["mtime_ns"] == stat.st_mtime_ns:
+        return cached["sha256"]
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(1 << 20), b""):
+            digest.update(block)
+    file_hashes[path] = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha256": digest.hexdigest()}
+    return digest.hexdigest()
+
+
+def _table_hash(conn, table_name, create=True):
+    try:
+        versions = access.get_table_versions(conn, [table_name], create=create)[table_name]
+    except Exception:
+        # the table doesn't exist (yet)
+        return None
+    return f"v{versions['version']}:{versions['rows']}"
+
+
+def _dependency_hash(conn, dependency, file_hashes, create=True):
+    table_name = _table_name(dependency)
+    if table_name is not None:
+        return _table_hash(conn, table_name, create)
+    return _file_hash(dependency, file_hashes)
+
+
+def _step_key(step, input_hashes):
+    stamp = json.dumps({"step": step.name, "code": step.code_hash(), "inputs": input_hashes}, sort_keys=True)
+    return hashlib.sha256(stamp.encode()).hexdigest()
+
+
+def upstream(pipeline_steps):
+    """{step name: names of the steps producing its inputs}"""
+    producers = {}
+    for step in pipeline_steps:
+        for output in step.outputs:
+            if output in producers:
+                raise ValueError(f"{output} is written by both {producers[output]} and {step.name}.")
+            producers[output] = step.name
+    return {
+        step.name: sorted({producers[dependency] for dependency in step.inputs if dependency in producers})
+        for step in pipeline_steps
+    }
+
+
+def select_steps(pipeline_steps, targets=None):
+    """The target steps and everything they depend on, in declaration order."""
+    if not targets:
+        return list(pipeline_steps)
+    names = {step.name for step in pipeline_steps}
+    unknown = [target for target in targets if target not in names]
+    if unknown:
+        raise ValueError(f"Unknown steps {unknown}, expected some of {sorted(names)}.")
+    edges = upstream(pipeline_steps)
+    selected, todo = set(), list(targets)
+    while todo:
+        name = todo.pop()
+        if name not in selected:
+            selected.add(name)
+            todo += edges[name]
+    return [step for step in pipeline_steps if step.name in selected]
+
+
+@instrument.instrumented()
+def run_pipeline(connect, targets=None, jobs=1, dry_run=False, force=False, pipeline_steps=None, state_file=None):
+    """Run the steps that are out of date, up to jobs at a time, in dependency order.
+    :param connect: callable returning a new database connection, each worker thread opens its own
+    :param targets: step names to bring up to date (with their upstream steps), all by default
+    :param dry_run: only report what would run, without writing to the database or state file
+    :param force: run every selected step regardless of its key
+    :return: {step name: "ran", "up to date", "would run", "failed" or "skipped"}
+    """
+    pipeline_steps = select_steps(steps if pipeline_steps is None else pipeline_steps, targets)
+    edges = upstream(pipeline_steps)
+    state_file = _state_file(state_file)
+    state = _load_state(state_file)
+    state_lock = threading.Lock()
+
+    local = threading.local()
+    connections = []
+
+    def worker_conn():
+        if not hasattr(local, "conn"):
+            local.conn = connect()
+            connections.append(local.conn)
+        return local.conn
+
+    conn = worker_conn()
+    if not dry_run:
+        # create table_versions before parallel loads bump it
+        access.get_table_versions(conn, [])
+
+    def run_step(step):
+        step.run(worker_conn() if step.uses_conn else None)
+
+    status = {}
+    pending = {step.name: step for step in pipeline_steps}
+    running = {}
+    try:
+        with ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+            while pending or running:
+                ready = len(pending)
+                for name, step in list(pending.items()):
+                    if any(dependency in pending or dependency in running for dependency in edges[name]):
+                        continue
+                    del pending[name]
+                    if any(status[dependency] in ("failed", "skipped") for dependency in edges[name]):
+                        status[name] = "skipped"
+                        print(f"skip    {name} (upstream failed)")
+                        continue
+                    if dry_run and any(status[dependency] == "would run" for dependency in edges[name]):
+                        # its inputs are about to change, so it can't be keyed yet
+                        status[name] = "would run"
+                        print(f"run     {name} (after upstream)")
+                        continue
+
+                    with state_lock:
+                        input_hashes = {
+                            d: _dependency_hash(conn, d, state["files"], create=not dry_run) for d in step.inputs
+                        }
+                    missing = [d for d, digest in input_hashes.items() if digest is None]
+                    key = _step_key(step, input_hashes)
+                    recorded = state["steps"].get(name, {})
+                    if not force and not missing and recorded.get("key") == key and all(
+                        _dependency_hash(conn, output, state["files"], create=not dry_run) == digest
+                        for output, digest in recorded.get("outputs", {}).items()
+                    ):
+                        status[name] = "up to date"
+                        print(f"ok      {name}")
+                    elif dry_run:
+                        status[name] = "would run"
+                        print(f"run     {name}" + (f" (missing {', '.join(missing)})" if missing else ""))
+                    elif missing:
+                        status[name] = "failed"
+                        print(f"FAILED  {name}: missing {', '.join(missing)}")
+                    else:
+                        print(f"start   {name}")
+                        running[name] = (executor.submit(run_step, step), key)
+
+                if not running:
+                    if pending and len(pending) == ready:
+                        raise ValueError(f"Steps {sorted(pending)} depend on each other.")
+                    continue
+                done, _ = wait([future for future, _ in running.values()], return_when=FIRST_COMPLETED)
+                for name, (future, key) in list(running.items()):
+                    if future not in done:
+                        continue
+                    del running[name]
+                    step = next(step for step in pipeline_steps if step.name == name)
+                    error = future.exception()
+                    if error is not None:
+                        status[name] = "failed"
+                        print(f"FAILED  {name}: {type(error).__name__}: {error}")
+                        continue
+                    with state_lock:
+                        state["steps"][name] = {
+                            "key": key,
+                            "outputs": {d: _dependency_hash(conn, d, state["files"]) for d in step.outputs},
+                        }
+                        _save_state(state_file, state)
+                    status[name] = "ran"
+                    print(f"done    {name}")
+    finally:
+        for opened in connections:
+            opened.close()
+        if not dry_run:
+            _save_state(state_file, state)
+    return status
+
+
+def _connector(args):
+    if args.mysql:
+        credentials, location = args.mysql.rsplit("@", 1)
+        user, password = credentials.split(":", 1)
+        host_port, database = location.split("/", 1)
+        host, port = (host_port.split(":") + ["3306"])[:2]
+        return lambda: access.create_connection(user, password, host, database, int(port))
+    if args.dry_run:
+        # nothing is written on a dry run, and a database that doesn't exist yet has no tables
+        if os.path.exists(args.duckdb):
+            return lambda: access.create_duckdb_connection(args.duckdb, read_only=True)
+        return lambda: access.create_duckdb_connection(":memory:")
+    return lambda: access.create_duckdb_connection(args.duckdb)
+
+
+def cli(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="fynesse-pipeline", description="Rebuild the fynesse tables, skipping steps whose inputs haven't changed."
+    )
+    parser.add_argument("targets", nargs="*", help="steps to bring up to date, all by default")
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="steps to run at once")
+    parser.add_argument("-n", "--dry-run", action="store_true", help="list the steps that would run")
+    parser.add_argument("--force", action="store_true", help="rerun the selected steps even if up to date")
+    parser.add_argument("--list", action="store_true", help="list the steps and their inputs")
+    parser.add_argument("--duckdb", default="fynesse.duckdb", help="DuckDB database file (the default backend)")
+    parser.add_argument("--mysql", help="user:password@host:port/database of a MariaDB to use instead")
+    parser.add_argument("--state", help="state file, config pipeline_state by default")
+    args = parser.parse_args(argv)
+
+    if args.list:
+        edges = upstream(steps)
+        for step in steps:
+            after = f"  (after {', '.join(edges[step.name])})" if edges[step.name] else ""
+            print(f"{step.name}: {', '.join(step.inputs) or '-'} -> {', '.join(step.outputs)}{after}")
+        return 0
+
+    status = run_pipeline(
+        _connector(args), args.targets, jobs=args.jobs, dry_run=args.dry_run, force=args.force, state_file=args.state
+    )
+    counts = {}
+    for result in status.values():
+        counts[result] = counts.get(result, 0) + 1
+    print(", ".join(f"{count} {result}" for result, count in sorted(counts.items())))
+    return 1 if "failed" in counts or "skipped" in counts else 0
+
+
+if __name__ == "__main__":
+    sys.exit(cli())
@@ -0,0 +1,167 @@
+import json
+
+from .lazy import lazy_import
+from . import access, instrument
+
+np = lazy_import("numpy")
+pd = lazy_import("pandas")
+
+# POI counts for any axis aligned bbox in constant time. The POIs of a region are
+# fetched once and binned per tag into a grid, stored as its summed-area table
+# (2-D cumulative sum with a zero first row/column), so the count inside cells
+# [i0, i1) x [j0, j1) is S[i1, j1] - S[i0, j1] - S[i1, j0] + S[i0, j0].
+#
+# Cells are square in degrees like access.get_bbox's boxes (1 km = 1/111 degree on
+# both axes). Several resolutions are kept: fine grids give exact-ish counts for
+# small boxes, coarse ones keep wide regions small in memory.
+#
+#   pois = poi_grid.fetch_poi_points(north, south, east, west, access.tags)
+#   grids = poi_grid.build_poi_grids(pois)
+#   sweep = poi_grid.bbox_side_sweep(grids, census_df, [0.5, 1, 2, 5])
+
+default_resolutions_km = [0.1, 0.25, 1.0]
+
+km_per_degree = 111
+
+
+def fetch_poi_points(north, south, east, west, tags):
+    """One overpass query for the whole region, reduced to a LAT/LONG point per POI
+    (polygon centroids) plus the tag columns."""
+    import warnings
+
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        pois = access.ox.geometries_from_bbox(north, south, east, west, tags)
+    points = pd.DataFrame(pois.drop(columns="geometry"))
+    with warnings.catch_warnings():
+        # centroids in degrees are fine at POI scale
+        warnings.simplefilter("ignore")
+        centroids = pois.geometry.centroid
+    points["LAT"] = centroids.y.to_numpy()
+    points["LONG"] = centroids.x.to_numpy()
+    return points.reset_index(drop=True)
+
+
+class PoiGrids:
+    def __init__(self, south, west, north, east, tables):
+        """:param tables: {resolution_km: {tag: summed-area table}}"""
+        self.south, self.west, self.north, self.east = south, west, north, east
+        self.tables = tables
+        self.resolutions_km = sorted(tables)
+        self.tags = list(next(iter(tables.values()))) if tables else []
+
+    def _resolution(self, bbox_side, min_cells):
+        # the coarsest grid that still puts min_cells cells across the box
+        side = np.min(bbox_side)
+        fitting = [res for res in self.resolutions_km if res * min_cells <= side]
+        return fitting[-1] if fitting else self.resolutions_km[0]
+
+    def _edge(self, values, origin, step, size):
+        # nearest cell edge, so a box takes the cells whose centres it contains
+        return np.clip(np.rint((np.asarray(values, dtype=np.float64) - origin) / step), 0, size).astype(np.int64)
+
+    def count(self, tag, north, south, east, west, resolution_km=None):
+        """POIs with the tag inside each bbox, vectorised over arrays of bboxes.
+        Box edges are snapped to the nearest cell edge, so counts are off by at most
+        the POIs in half a cell along each side."""
+        if resolution_km is None:
+            resolution_km = self.resolutions_km[0]
+        table = self.tables[resolution_km][tag]
+        step = resolution_km / km_per_degree
+        rows, cols = table.shape[0] - 1, table.shape[1] - 1
+        i0 = self._edge(south, self.south, step, rows)
+        i1 = np.maximum(self._edge(north, self.south, step, rows), i0)
+        j0 = self._edge(west, self.west, step, cols)
+        j1 = np.maximum(self._edge(east, self.west, step, cols), j0)
+        return table[i1, j1] - table[i0, j1] - table[i1, j0] + table[i0, j0]
+
+    def count_near(self, tag, latitude, longitude, bbox_side=1.0, resolution_km=None, min_cells=10):
+        """count() for get_bbox(latitude, longitude, bbox_side) boxes."""
+        if resolution_km is None:
+            resolution_km = self._resolution(bbox_side, min_cells)
+        half = np.asarray(bbox_side, dtype=np.float64) / km_per_degree / 2
+        latitude = np.asarray(latitude, dtype=np.float64)
+        longitude = np.asarray(longitude, dtype=np.float64)
+        return self.count(
+            tag, latitude + half, latitude - half, longitude + half, longitude - half, resolution_km
+        )
+
+    def save(self, path):
+        arrays = {
+            f"{resolution_km}/{tag}": table
+            for resolution_km, tables in self.tables.items()
+            for tag, table in tables.items()
+        }
+        meta = {"bounds": [self.south, self.west, self.north, self.east]}
+        np.savez(path, meta=np.array(json.dumps(meta)), **arrays)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as saved:
+            meta = json.loads(str(saved["meta"]))
+            tables = {}
+            for key in saved.files:
+                if key == "meta":
+                    continue
+                resolution_km, tag = key.split("/", 1)
+                tables.setdefault(float(resolution_km), {})[tag] = saved[key]
+        return cls(*meta["bounds"], tables)
+
+
+@instrument.instrumented()
+def build_poi_grids(pois_df, tags=None, resolutions_km=None, bounds=None):
+    """Summed-area tables of POI counts per tag, at each resolution.
+    :param pois_df: LAT/LONG per POI and a column per tag, null where the POI doesn't have it
+    :param bounds: (south, west, north, east), the POIs' extent by default
+    """
+    if tags is None:
+        tags = [tag for tag in access.tags_to_keep if tag in pois_df.columns]
+    if resolutions_km is None:
+        resolutions_km = default_resolutions_km
+    lat = pois_df["LAT"].to_numpy(dtype=np.float64)
+    lon = pois_df["LONG"].to_numpy(dtype=np.float64)
+    if bounds is None:
+        bounds = (lat.min(), lon.min(), lat.max(), lon.max())
+    south, west, north, east = bounds
+    instrument.rows_in(len(pois_df))
+
+    inside = (lat >= south) & (lat <= north) & (lon >= west) & (lon <= east)
+    tables = {}
+    for resolution_km in resolutions_km:
+        step = resolution_km / km_per_degree
+        rows = max(int(np.ceil((north - south) / step)), 1)
+        cols = max(int(np.ceil((east - west) / step)), 1)
+        cell_row = np.minimum(((lat - south) / step).astype(np.int64), rows - 1)
+        cell_col = np.minimum(((lon - west) / step).astype(np.int64), cols - 1)
+        cell = cell_row * cols + cell_col
+        tables[resolution_km] = {}
+        for tag in tags:
+            has_tag = inside & pois_df[tag].notnull().to_numpy()
+            counts = np.bincount(cell[has_tag], minlength=rows * cols).astype(np.int32)
+            table = np.zeros((rows + 1, cols + 1), dtype=np.int32)
+            table[1:, 1:] = counts.reshape(rows, cols)
+            np.cumsum(table, axis=0, out=table)
+            np.cumsum(table, axis=1, out=table)
+            tables[resolution_km][tag] = table
+    return PoiGrids(south, west, north, east, tables)
+
+
+@instrument.instrumented()
+def bbox_side_sweep(grids, areas_df, bbox_sides, tags=None):
+    """POI counts around every output area for each bbox side, like the osm_data
+    {tag}_count columns but without refetching per side.
+    :return: long frame with FID, LAT, LONG, bbox_side and a {tag}_count column per tag
+    """
+    if tags is None:
+        tags = grids.tags
+    instrument.rows_in(len(areas_df))
+    frames = []
+    for bbox_side in bbox_sides:
+        frame = areas_df[["FID", "LAT", "LONG"]].copy()
+        frame["bbox_side"] = bbox_side
+        for tag in tags:
+            frame[f"{tag}_count"] = grids.count_near(tag, frame["LAT"], frame["LONG"], bbox_side)
+        frames.append(frame)
+    sweep = pd.concat(frames, ignore_index=True)
+    instrument.rows_out(len(sweep))
+    return sweep
@@ -0,0 +1,168 @@
+import glob
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from .config import *
+from .lazy import lazy_import
+from . import instrument, schema
+
+pd = lazy_import("pandas")
+
+# Columnar copy of the price paid CSVs download_price_paid_data leaves on disk.
+# Each pp-<year>-part<n>.csv is parsed in its own process with explicit dtypes and
+# written as Parquet partitioned by year (and optionally postcode area), e.g.
+#   price_paid_parquet/year=2021/postcode_area=CB/pp-2021-part1-0.parquet
+# so a year or region query only opens the matching partitions, and the date filter
+# is pushed down to the row group statistics inside them.
+#
+#   price_paid.ingest_price_paid()
+#   df = price_paid.read_price_paid(date_from="2021-01-01", date_to="2021-12-31", postcode_areas=["CB"])
+
+# column order of the land registry files and of pp_data
+pp_columns = schema.table_columns["pp_data"]
+
+pp_dtypes = {
+    "transaction_unique_identifier": "string",
+    "price": "int64",
+    "postcode": "string",
+    "property_type": "category",
+    "new_build_flag": "category",
+    "tenure_type": "category",
+    "primary_addressable_object_name": "string",
+    "secondary_addressable_object_name": "string",
+    "street": "string",
+    "locality": "string",
+    "town_city": "category",
+    "district": "category",
+    "county": "category",
+    "ppd_category_type": "category",
+    "record_status": "category",
+}
+
+def _dataset_dir(dataset_dir=None):
+    if dataset_dir is None:
+        dataset_dir = config.get("price_paid_dir", "price_paid_parquet")
+    return dataset_dir
+
+
+def postcode_area(postcodes):
+    """The leading letters of each postcode ("CB2 1TN" -> "CB"), missing if there are none."""
+    return postcodes.str.extract(r"^([A-Z]{1,2})", expand=False)
+
+
+def read_price_paid_csv(path):
+    """Parse one land registry price paid file into typed columns plus year and postcode_area."""
+    df = pd.read_csv(
+        path,
+        header=None,
+        names=pp_columns,
+        dtype=pp_dtypes,
+        # "NA" is a real house name, only empty fields are missing
+        keep_default_na=False,
+        na_values=[""],
+    )
+    df["date_of_transfer"] = pd.to_datetime(df["date_of_transfer"], format="%Y-%m-%d %H:%M")
+    df["year"] = df["date_of_transfer"].dt.year.astype("int16")
+    df["postcode_area"] = postcode_area(df["postcode"])
+    return df
+
+
+def _ingest_file(path, dataset_dir, partition_cols):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    df = read_price_paid_csv(path)
+    stem = os.path.splitext(os.path.basename(path))[0]
+    # fragments are named after their source file, so ingesting a file again replaces them
+    pq.write_to_dataset(
+        pa.Table.from_pandas(df, preserve_index=False),
+        dataset_dir,
+        partition_cols=partition_cols,
+        basename_template=f"{stem}-{{i}}.parquet",
+        existing_data_behavior="overwrite_or_ignore",
+    )
+    return len(df)
+
+
+@instrument.instrumented()
+def ingest_price_paid(paths=None, dataset_dir=None, by_postcode_area=False, max_workers=None):
+    """Convert price paid CSVs (by default every pp-*-part*.csv in the working
+    directory) into the partitioned Parquet dataset, one file per process.
+    :return: number of rows written
+    """
+    if paths is None:
+        paths = sorted(glob.glob("pp-*-part*.csv"))
+    dataset_dir = _dataset_dir(dataset_dir)
+    partition_cols = ["year", "postcode_area"] if by_postcode_area else ["year"]
+
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        counts = list(
+            executor.map(
+                _ingest_file,
+                paths,
+                [dataset_dir] * len(paths),
+                [partition_cols] * len(paths),
+            )
+        )
+    instrument.rows_out(sum(counts))
+    return sum(counts)
+
+
+def price_paid_filter(date_from=None, date_to=None, postcode_areas=None):
+    """pyarrow filter expression for a date range (inclusive) and postcode areas.
+    The year bounds prune partitions, the date bounds are checked against row group statistics."""
+    import pyarrow.dataset as ds
+
+    conditions = []
+    if date_from is not None:
+        date_from = pd.Timestamp(date_from)
+        conditions += [
+            ds.field("year") >= date_from.year,
+            ds.field("date_of_transfer") >= date_from.to_pydatetime(),
+        ]
+    if date_to is not None:
+        date_to = pd.Timestamp(date_to)
+        conditions += [
+            ds.field("year") <= date_to.year,
+            ds.field("date_of_transfer") < (date_to + pd.Timedelta(days=1)).to_pydatetime(),
+        ]
+    if postcode_areas is not None:
+        conditions.append(ds.field("postcode_area").isin(list(postcode_areas)))
+    if not conditions:
+        return None
+    expression = conditions[0]
+    for condition in conditions[1:]:
+        expression = expression & condition
+    return expression
+
+
+@instrument.instrumented()
+def read_price_paid(dataset_dir=None, date_from=None, date_to=None, postcode_areas=None, columns=None):
+    """Read the transactions in a date range and/or postcode areas from the Parquet dataset."""
+    import pyarrow.dataset as ds
+
+    dataset = ds.dataset(_dataset_dir(dataset_dir), format="parquet", partitioning="hive")
+    table = dataset.to_table(
+        columns=columns, filter=price_paid_filter(date_from, date_to, postcode_areas)
+    )
+    instrument.rows_out(table.num_rows)
+    return schema.compact_frame(table.to_pandas())
+
+
+@instrument.instrumented()
+def housing_join_year(year, postcode_df, dataset_dir=None):
+    """The per-year join of access.housing_upload_join_data, reading one year partition
+    of the Parquet dataset instead of scanning pp_data.
+    :param postcode_df: postcode_data rows (postcode, country, latitude, longitude)
+    :return: rows in the prices_coordinates_data column order
+    """
+    prices = read_price_paid(
+        dataset_dir,
+        date_from=f"{year}-01-01",
+        date_to=f"{year}-12-31",
+        columns=[column for column in schema.table_columns["prices_coordinates_data"] if column in pp_columns],
+    )
+    postcodes = postcode_df[["postcode", "country", "latitude", "longitude"]]
+    merged = prices.merge(postcodes.astype({"postcode": prices["postcode"].dtype}), on="postcode")
+    instrument.rows_out(len(merged))
+    return merged[schema.table_columns["prices_coordinates_data"]]
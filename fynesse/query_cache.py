@@ -0,0 +1,194 @@
+import collections
+import hashlib
+import json
+import os
+import re
+import threading
+
+from .config import *
+from .lazy import lazy_import
+
+pd = lazy_import("pandas")
+
+# Result cache for the exploration reads in access (read_all_data, get_first_row,
+# calculate_number_of_rows, get_null_counts). Results are kept in memory (LRU by
+# size) and as Parquet files on disk, keyed on the normalised SQL, its parameters,
+# the database (with the random id it keeps in table_versions) and the
+# table_versions counter of every table the query reads. In-memory databases are
+# only cached in memory.
+# Loading a table bumps its counter (access.bump_table_version), so the next read
+# misses and the old entries age out through eviction; nothing is invalidated
+# explicitly. Writes that bypass the loaders must bump the counter themselves.
+#
+# Off unless enabled:
+#   query_cache.enable()
+#   access.get_null_counts(conn, "prices_coordinates_data")  # scans once
+#   query_cache.stats()
+
+_tables = re.compile(r"\b(?:FROM|JOIN)\s+[`\"]?(\w+)[`\"]?", re.IGNORECASE)
+
+_active = None
+
+# bumped when the way access stores results changes, so old entries are never read back
+_format = 2
+
+
+def normalise_sql(query):
+    """Collapse whitespace and drop the trailing semicolon, so reformatted queries share entries."""
+    return re.sub(r"\s+", " ", query).strip().rstrip(";").strip()
+
+
+def referenced_tables(query):
+    return sorted(set(_tables.findall(query)))
+
+
+class QueryCache:
+    def __init__(self, cache_dir=None, memory_mb=None, disk_mb=None):
+        if cache_dir is None:
+            cache_dir = config.get("query_cache_dir", "query_cache")
+        if memory_mb is None:
+            memory_mb = config.get("query_cache_memory_mb", 256)
+        if disk_mb is None:
+            disk_mb = config.get("query_cache_disk_mb", 1024)
+        self.cache_dir = cache_dir
+        self.max_memory_bytes = memory_mb * 1024 * 1024
+        self.max_disk_bytes = disk_mb * 1024 * 1024
+        os.makedirs(cache_dir, exist_ok=True)
+
+        # key -> (value, nbytes), least recently used first
+        self._memory = collections.OrderedDict()
+        self._memory_bytes = 0
+        self._lock = threading.Lock()
+        self._stats = collections.Counter()
+
+    def key(self, database, query, args, versions):
+        stamp = json.dumps(
+            {
+                "format": _format,
+                "database": database,
+                "query": normalise_sql(query),
+                "args": repr(args),
+                "versions": versions,
+            },
+            sort_keys=True,
+        )
+        return hashlib.sha256(stamp.encode()).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.parquet")
+
+    def _remember(self, key, value, nbytes):
+        with self._lock:
+            if key in self._memory:
+                self._memory_bytes -= self._memory.pop(key)[1]
+            self._memory[key] = (value, nbytes)
+            self._memory_bytes += nbytes
+            while self._memory_bytes > self.max_memory_bytes and len(self._memory) > 1:
+                _, (_, evicted_bytes) = self._memory.popitem(last=False)
+                self._memory_bytes -= evicted_bytes
+                self._stats["memory_evictions"] += 1
+
+    def _write(self, key, frame):
+        path = self._path(key)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        try:
+            frame.to_parquet(tmp_path, index=False)
+        except Exception:
+            # columns pyarrow can't store only live in memory
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return
+        os.replace(tmp_path, path)
+        self._evict_disk()
+
+    def _evict_disk(self):
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith(".parquet"):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        # oldest use first, hits touch their file
+        for _, size, path in sorted(entries):
+            if total <= self.max_disk_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                continue
+            total -= size
+            self._stats["disk_evictions"] += 1
+
+    def get_or_compute(self, key, compute, from_frame, persist=True):
+        """The cached value for key, else compute() it.
+        :param compute: returns (value, DataFrame of the value) for the disk copy
+        :param from_frame: rebuilds the value from the DataFrame read back from disk
+        :param persist: also keep a disk copy, False keeps the entry in memory only
+        """
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                self._stats["memory_hits"] += 1
+                return self._memory[key][0]
+
+        path = self._path(key)
+        if persist and os.path.exists(path):
+            try:
+                frame = pd.read_parquet(path)
+                os.utime(path)
+            except (OSError, ValueError):
+                frame = None
+            if frame is not None:
+                value = from_frame(frame)
+                self._stats["disk_hits"] += 1
+                self._remember(key, value, int(frame.memory_usage(deep=True).sum()))
+                return value
+
+        value, frame = compute()
+        self._stats["misses"] += 1
+        self._remember(key, value, int(frame.memory_usage(deep=True).sum()))
+        if persist:
+            self._write(key, frame)
+        return value
+
+    def stats(self):
+        hits = self._stats["memory_hits"] + self._stats["disk_hits"]
+        lookups = hits + self._stats["misses"]
+        return {
+            "memory_hits": self._stats["memory_hits"],
+            "disk_hits": self._stats["disk_hits"],
+            "misses": self._stats["misses"],
+            "hit_rate": hits / lookups if lookups else 0.0,
+            "memory_entries": len(self._memory),
+            "memory_bytes": self._memory_bytes,
+            "memory_evictions": self._stats["memory_evictions"],
+            "disk_evictions": self._stats["disk_evictions"],
+        }
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+            self._memory_bytes = 0
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith(".parquet"):
+                os.remove(entry.path)
+
+
+def enable(cache_dir=None, memory_mb=None, disk_mb=None):
+    """Serve the access exploration reads from a QueryCache from now on."""
+    global _active
+    _active = QueryCache(cache_dir, memory_mb, disk_mb)
+    return _active
+
+
+def disable():
+    global _active
+    _active = None
+
+
+def active():
+    return _active
+
+
+def stats():
+    return _active.stats() if _active is not None else {}
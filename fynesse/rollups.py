@@ -0,0 +1,375 @@
+import json
+import math
+
+from .lazy import lazy_import
+from . import access, instrument
+
+np = lazy_import("numpy")
+pd = lazy_import("pandas")
+
+# Price rollups over prices_coordinates_data: one row per postcode sector x month x
+# property_type holding the count, the sum of prices and a quantile sketch. Districts
+# and postcode areas, and whole years, are answered by merging those rows, so
+# medians/counts per area and period don't have to rescan the raw transactions.
+#
+# The sketch is a log-bucketed histogram (as in DDSketch): a price p falls in bucket
+# ceil(log(p) / log(gamma)), so any quantile read back from it is within
+# sketch_relative_accuracy of the true value, and two sketches merge by adding counts.
+#
+# price_rollup_years records the prices_coordinates_data version (see
+# access.bump_table_version) each year was built from. access.housing_upload_join_data
+# refreshes the year it loads and carries the other years forward; after any other
+# load price_summary rebuilds the years that are behind before answering.
+#   rollups.price_summary(conn, level="district", areas=["CB1", "CB2"], freq="year")
+
+sketch_relative_accuracy = 0.01
+_gamma = (1 + sketch_relative_accuracy) / (1 - sketch_relative_accuracy)
+
+# finest first, each level's code is a prefix of the one before
+levels = ["postcode", "sector", "district", "area"]
+frequencies = ["month", "year"]
+
+
+@instrument.instrumented()
+def initialize_price_rollups_db(conn):
+    curr = conn.cursor()
+
+    curr.execute("""DROP TABLE IF EXISTS `price_rollups`;""")
+    curr.execute(
+        """
+        CREATE TABLE IF NOT EXISTS `price_rollups` (
+        `sector` VARCHAR(8) NOT NULL,
+        `district` VARCHAR(5) NOT NULL,
+        `month` DATE NOT NULL,
+        `property_type` VARCHAR(1) NOT NULL,
+        `count` INT NOT NULL,
+        `sum_price` BIGINT NOT NULL,
+        `sketch` TEXT NOT NULL,
+        PRIMARY KEY (`sector`, `month`, `property_type`)
+        ) DEFAULT CHARSET=utf8 COLLATE=utf8_bin;
+    """.replace(
+            "\n", " "
+        )
+    )
+
+    curr.execute("""CREATE INDEX rollup_district_month ON `price_rollups` (`district`, `month`);""")
+    curr.execute("""DROP TABLE IF EXISTS `price_rollup_years`;""")
+    _create_price_rollup_years(curr)
+    conn.commit()
+    access.bump_table_version(conn, "price_rollups")
+
+
+# year 0 holds the version every year was last checked against
+_all_years = 0
+
+
+def _create_price_rollup_years(curr):
+    curr.execute(
+        """
+        CREATE TABLE IF NOT EXISTS `price_rollup_years` (
+        `year` INT NOT NULL,
+        `source_version` BIGINT NOT NULL,
+        PRIMARY KEY (`year`)
+        ) DEFAULT CHARSET=utf8 COLLATE=utf8_bin;
+    """.replace(
+            "\n", " "
+        )
+    )
+
+
+def _has_price_rollups(conn):
+    curr = conn.cursor()
+    try:
+        curr.execute("SELECT 1 FROM `price_rollups` LIMIT 1;")
+        curr.fetchall()
+        return True
+    except Exception:
+        return False
+
+
+def postcode_level(postcodes, level):
+    """The sector ("CB2 1"), district ("CB2") or area ("CB") of each postcode."""
+    postcodes = postcodes.astype(str).str.strip()
+    if level == "postcode":
+        return postcodes
+    if level == "sector":
+        # the inward code is always a digit and two letters
+        return postcodes.str[:-2]
+    if level == "district":
+        return postcodes.str[:-3].str.strip()
+    if level == "area":
+        return postcodes.str.extract(r"^([A-Z]{1,2})", expand=False)
+    raise ValueError(f"Unknown level {level}, expected one of {levels}.")
+
+
+def _bucket(prices):
+    return np.ceil(np.log(np.maximum(prices, 1)) / math.log(_gamma)).astype(np.int32)
+
+
+def _bucket_value(bucket):
+    # midpoint of the bucket (gamma^(i-1), gamma^i] in relative terms
+    return 2 * _gamma**bucket / (_gamma + 1)
+
+
+def merge_sketches(sketches):
+    merged = {}
+    for sketch in sketches:
+        for bucket, count in sketch.items():
+            merged[bucket] = merged.get(bucket, 0) + count
+    return merged
+
+
+def sketch_quantile(sketch, q):
+    """Estimate the q-th quantile of the prices a sketch was built from."""
+    buckets = sorted((int(bucket), count) for bucket, count in sketch.items())
+    total = sum(count for _, count in buckets)
+    if total == 0:
+        return math.nan
+    rank = q * (total - 1)
+    seen = 0
+    for bucket, count in buckets:
+        seen += count
+        if seen > rank:
+            break
+    return _bucket_value(bucket)
+
+
+def _year_rollup(conn, year):
+    parts = []
+    keys = ["sector", "month", "property_type", "bucket"]
+    for chunk in access.read_data_in_chunks(
+        conn,
+        query="""
+        SELECT price, date_of_transfer, postcode, property_type FROM prices_coordinates_data
+        WHERE date_of_transfer BETWEEN %s AND %s;
+        """,
+        args=(f"{year}-01-01", f"{year}-12-31"),
+    ):
+        price = chunk["price"].to_numpy(dtype=np.int64)
+        part = pd.DataFrame(
+            {
+                "sector": postcode_level(chunk["postcode"], "sector"),
+                "month": pd.to_datetime(chunk["date_of_transfer"]).dt.to_period("M").dt.to_timestamp(),
+                "property_type": chunk["property_type"].astype(str),
+                "bucket": _bucket(price),
+                "count": 1,
+                "sum_price": price,
+            }
+        )
+        # partial aggregate per chunk so only the distinct keys are kept around
+        parts.append(part.groupby(keys, as_index=False).sum())
+    if not parts:
+        return []
+
+    # sorted by group then bucket, so each group's buckets are one contiguous run
+    buckets = pd.concat(parts).groupby(keys, as_index=False, dropna=False).sum()
+    groups = buckets.groupby(keys[:-1], sort=False, dropna=False)
+    totals = groups[["count", "sum_price"]].sum()
+    sizes = groups.size().to_numpy()
+    ends = np.cumsum(sizes)
+    # json.dumps of the {bucket: count} dict, built from one vectorised string column
+    pairs = ('"' + buckets["bucket"].astype(str) + '": ' + buckets["count"].astype(str)).tolist()
+    sketches = ["{" + ", ".join(pairs[end - size:end]) + "}" for size, end in zip(sizes, ends)]
+
+    sector = totals.index.get_level_values("sector").to_series()
+    return list(
+        zip(
+            sector.tolist(),
+            sector.str[:-1].str.strip().tolist(),
+            [month.date() for month in totals.index.get_level_values("month")],
+            totals.index.get_level_values("property_type").tolist(),
+            totals["count"].astype(int).tolist(),
+            totals["sum_price"].astype(int).tolist(),
+            sketches,
+        )
+    )
+
+
+def _built_versions(conn):
+    """{year: prices_coordinates_data version it was built from}, creating the tables if missing."""
+    if not _has_price_rollups(conn):
+        initialize_price_rollups_db(conn)
+    curr = conn.cursor()
+    _create_price_rollup_years(curr)
+    curr.execute("SELECT `year`, `source_version` FROM `price_rollup_years`;")
+    rows = curr.fetchall()
+    return {
+        int(year): int(version)
+        for year, version in (row.values() if isinstance(row, dict) else row for row in rows)
+    }
+
+
+def _record_versions(conn, versions):
+    curr = conn.cursor()
+    curr.executemany("DELETE FROM `price_rollup_years` WHERE `year` = %s;", [(year,) for year in versions])
+    curr.executemany(
+        "INSERT INTO `price_rollup_years` VALUES (%s, %s);", [(year, version) for year, version in versions.items()]
+    )
+    conn.commit()
+
+
+@instrument.instrumented()
+def update_price_rollups(conn, year, previous_version=None):
+    """Recompute the rollup rows of one year from prices_coordinates_data.
+    Only that year's transactions are read, so loading a year costs that year.
+    :param previous_version: prices_coordinates_data's version before a load that only
+        added rows of this year, so the years built from it are still current
+    """
+    rows = _year_rollup(conn, year)
+    built = _built_versions(conn)
+    version = access.table_version(conn, "prices_coordinates_data")
+    curr = conn.cursor()
+    curr.execute(
+        "DELETE FROM `price_rollups` WHERE `month` BETWEEN %s AND %s;",
+        (f"{year}-01-01", f"{year}-12-31"),
+    )
+    if rows:
+        curr.executemany(
+            "INSERT INTO `price_rollups` VALUES (%s, %s, %s, %s, %s, %s, %s);", rows
+        )
+    conn.commit()
+    recorded = {year: version}
+    if previous_version is not None:
+        recorded.update(
+            {built_year: version for built_year, built_version in built.items() if built_version == previous_version}
+        )
+    _record_versions(conn, recorded)
+    access.bump_table_version(conn, "price_rollups")
+    instrument.rows_out(len(rows))
+    return len(rows)
+
+
+@instrument.instrumented()
+def refresh_price_rollups(conn):
+    """Rebuild the years of price_rollups that are behind prices_coordinates_data,
+    e.g. after housing_upload_join_data(..., update_rollups=False) or another load.
+    :return: the years rebuilt
+    """
+    version = access.table_version(conn, "prices_coordinates_data")
+    built = _built_versions(conn)
+    if built.get(_all_years) == version:
+        return []
+    curr = conn.cursor()
+    curr.execute("SELECT DISTINCT YEAR(`date_of_transfer`) FROM `prices_coordinates_data`;")
+    years = {int(list(row.values())[0] if isinstance(row, dict) else row[0]) for row in curr.fetchall()}
+    # years that are gone are rebuilt too, which clears their rows
+    stale = sorted(year for year in years | (set(built) - {_all_years}) if built.get(year) != version)
+    for year in stale:
+        update_price_rollups(conn, year)
+    _record_versions(conn, {_all_years: version})
+    instrument.rows_out(len(stale))
+    return stale
+
+
+def _month_aligned(date_from, date_to):
+    return (date_from is None or pd.Timestamp(date_from).day == 1) and (
+        date_to is None or pd.Timestamp(date_to).is_month_end
+    )
+
+
+def _date_conditions(column, date_from, date_to):
+    conditions, args = [], []
+    if date_from is not None:
+        conditions.append(f"{column} >= %s")
+        args.append(str(pd.Timestamp(date_from).date()))
+    if date_to is not None:
+        conditions.append(f"{column} <= %s")
+        args.append(str(pd.Timestamp(date_to).date()))
+    return conditions, args
+
+
+def _filter_frame(df, level, areas, property_types):
+    if areas is not None:
+        df = df[df[level].isin(list(areas))]
+    if property_types is not None:
+        df = df[df["property_type"].isin(list(property_types))]
+    return df
+
+
+def _summary_from_rollups(conn, level, areas, date_from, date_to, property_types, freq, quantiles):
+    conditions, args = _date_conditions("`month`", date_from, date_to)
+    if level == "district" and areas is not None:
+        # the district index narrows the read to the requested districts
+        conditions.append(f"`district` IN ({', '.join(['%s'] * len(areas))})")
+        args += list(areas)
+    where = f" WHERE {' AND '.join(conditions)}" if conditions else ""
+    rollup_df = access.read_frame(conn, query=f"SELECT * FROM `price_rollups`{where};", args=args or None)
+    rollup_df["sector"] = rollup_df["sector"].astype(str)
+    rollup_df["property_type"] = rollup_df["property_type"].astype(str)
+    if level == "area":
+        rollup_df["area"] = postcode_level(rollup_df["sector"], "area")
+    rollup_df = _filter_frame(rollup_df, level, areas, property_types)
+
+    month = pd.to_datetime(rollup_df["month"])
+    rollup_df["period"] = month.dt.year if freq == "year" else month
+    rollup_df[level] = rollup_df[level].astype(str)
+
+    keys = [level, "period", "property_type"]
+    summary = rollup_df.groupby(keys, as_index=False)[["count", "sum_price"]].sum()
+    summary["mean_price"] = summary["sum_price"] / summary["count"]
+
+    # merge the sketches of each group as one long (group, bucket, count) frame
+    group = rollup_df.groupby(keys).ngroup().to_numpy()
+    sketches = rollup_df["sketch"].map(json.loads)
+    sizes = sketches.map(len).to_numpy()
+    buckets = pd.DataFrame(
+        {
+            "group": np.repeat(group, sizes),
+            "bucket": np.fromiter((int(b) for sketch in sketches for b in sketch), np.int64, sizes.sum()),
+            "count": np.fromiter((c for sketch in sketches for c in sketch.values()), np.int64, sizes.sum()),
+        }
+    )
+    buckets = buckets[buckets["group"] >= 0].groupby(["group", "bucket"], as_index=False)["count"].sum()
+    cumulative = buckets.groupby("group")["count"].cumsum().to_numpy()
+    total = summary["count"].to_numpy()[buckets["group"].to_numpy()]
+    for q in quantiles:
+        # the first bucket of each group whose cumulative count passes the rank
+        first = buckets[cumulative > q * (total - 1)].groupby("group")["bucket"].first()
+        summary[f"q{q:g}"] = _bucket_value(first.reindex(range(len(summary))).to_numpy())
+    return summary
+
+
+def _summary_from_raw(conn, level, areas, date_from, date_to, property_types, freq, quantiles):
+    conditions, args = _date_conditions("date_of_transfer", date_from, date_to)
+    where = f" WHERE {' AND '.join(conditions)}" if conditions else ""
+    raw_df = access.read_frame(
+        conn,
+        query=f"SELECT price, date_of_transfer, postcode, property_type FROM prices_coordinates_data{where};",
+        args=args or None,
+    )
+    raw_df[level] = postcode_level(raw_df["postcode"], level)
+    raw_df["property_type"] = raw_df["property_type"].astype(str)
+    raw_df = _filter_frame(raw_df, level, areas, property_types)
+
+    date = pd.to_datetime(raw_df["date_of_transfer"])
+    raw_df["period"] = date.dt.year if freq == "year" else date.dt.to_period("M").dt.to_timestamp()
+    grouped = raw_df.groupby([level, "period", "property_type"])["price"]
+    summary = grouped.agg(count="count", mean_price="mean").reset_index()
+    for q in quantiles:
+        summary[f"q{q:g}"] = grouped.quantile(q).to_numpy()
+    return summary
+
+
+@instrument.instrumented()
+def price_summary(conn, level="district", areas=None, date_from=None, date_to=None, property_types=None, freq="month", quantiles=(0.5,)):
+    """Transaction count, mean price and price quantiles per area x period x property_type.
+    Answered from price_rollups when the level is sector or coarser and the date range
+    covers whole months (quantiles are then within sketch_relative_accuracy), after
+    rebuilding the years that are behind, otherwise computed exactly from
+    prices_coordinates_data.
+    :param level: one of levels
+    :param freq: "month" or "year"
+    """
+    if level not in levels:
+        raise ValueError(f"Unknown level {level}, expected one of {levels}.")
+    if freq not in frequencies:
+        raise ValueError(f"Unknown frequency {freq}, expected one of {frequencies}.")
+
+    if level != "postcode" and _month_aligned(date_from, date_to):
+        refresh_price_rollups(conn)
+        summary = _summary_from_rollups(conn, level, areas, date_from, date_to, property_types, freq, quantiles)
+    else:
+        summary = _summary_from_raw(conn, level, areas, date_from, date_to, property_types, freq, quantiles)
+    columns = [level, "period", "property_type", "count", "mean_price"] + [f"q{q:g}" for q in quantiles]
+    instrument.rows_out(len(summary))
+    return summary[columns]
@@ -0,0 +1,426 @@
+import json
+
+from .lazy import lazy_import
+
+np = lazy_import("numpy")
+pd = lazy_import("pandas")
+
+# Compact in-memory types for the columns the feature tables share. Applied by
+# column name, so the same column keeps the same type in every frame and merges
+# don't fall back to object/float64.
+
+_tag_columns = [
+    "amenity",
+    "bicycle_rental",
+    "bicycle_parking",
+    "capacity",
+    "cuisine",
+    "takeaway",
+    "building",
+    "brand",
+]
+
+column_dtypes = {
+    # codes and names repeat a lot, categoricals store them once
+    "OA21CD": "category",
+    "LSOA21NM": "category",
+    "LSOA21NMW": "category",
+    "local_authorities_code": "category",
+    "local_authority": "category",
+    "local_authorities": "category",
+    "property_type": "category",
+    "new_build_flag": "category",
+    "tenure_type": "category",
+    "town_city": "category",
+    "district": "category",
+    "county": "category",
+    "country": "category",
+    # coordinates are compared and joined on, float32's ~7 significant digits
+    # would move them by up to a metre
+    "LAT": "float64",
+    "LONG": "float64",
+    "latitude": "float64",
+    "longitude": "float64",
+    "TOTAL_POP": "float32",
+    "STUDENT_POP": "float32",
+    "non_main_language_pop": "float32",
+    "proportion": "float32",
+    "FID": "int32",
+    "db_id": "int32",
+    "TOTAL_RAW_POP": "int32",
+    "observation": "int32",
+    "price": "int32",
+}
+# POI counts in a 1km box, widened automatically if a value doesn't fit
+for tag in _tag_columns:
+    column_dtypes[tag] = "int16"
+    column_dtypes[f"{tag}_count"] = "int16"
+
+_wider_int = {"int8": "int16", "int16": "int32", "int32": "int64"}
+
+
+def fixed_dtypes(dtypes=None):
+    """dtypes (column_dtypes by default) with every type settled in advance rather than
+    from the values, for frames read in chunks that have to agree with each other.
+    Categoricals become arrow backed strings, since each chunk would get its own
+    categories, and integers nullable Int32, which holds any INT column.
+    """
+    if dtypes is None:
+        dtypes = column_dtypes
+    fixed = {}
+    for column, dtype in dtypes.items():
+        if dtype == "category":
+            fixed[column] = "string"
+        elif dtype in ("int8", "int16", "int32"):
+            fixed[column] = "Int32"
+        else:
+            fixed[column] = dtype
+    return fixed
+
+
+def _to_integer(series, dtype):
+    values = pd.to_numeric(series)
+    present = values.dropna()
+    if (present % 1 != 0).any():
+        # not whole numbers after all, keep them as floats
+        return values.astype("float32")
+    if len(present):
+        low, high = present.min(), present.max()
+        while dtype in _wider_int and (low < np.iinfo(dtype).min or high > np.iinfo(dtype).max):
+            dtype = _wider_int[dtype]
+    if len(present) < len(values):
+        # nullable integer keeps the missing values
+        return values.astype(dtype.capitalize())
+    return values.astype(dtype)
+
+
+def _to_string(series):
+    try:
+        return series.astype("string[pyarrow]")
+    except ImportError:
+        return series
+
+
+def _convert(series, dtype):
+    if dtype == "string":
+        return _to_string(series)
+    if dtype == "category":
+        if isinstance(series.dtype, (pd.CategoricalDtype, pd.StringDtype)):
+            return series
+        if len(series) and series.nunique() > len(series) // 2:
+            # mostly unique (e.g. one row per output area), a category dictionary
+            # would cost more than it saves so use arrow backed strings instead
+            return _to_string(series)
+        return series.astype("category")
+    if dtype.startswith("int"):
+        return _to_integer(series, dtype)
+    # Decimal objects from pymysql go through float first
+    return pd.to_numeric(series).astype(dtype)
+
+
+def compact_frame(df, dtypes=None):
+    """Convert the columns (and index) named in dtypes, column_dtypes by default, to their compact types."""
+    if dtypes is None:
+        dtypes = column_dtypes
+    df = df.copy(deep=False)
+    for column in df.columns:
+        if column in dtypes:
+            df[column] = _convert(df[column], dtypes[column])
+    if df.index.name in dtypes:
+        df.index = pd.Index(_convert(df.index.to_series(), dtypes[df.index.name]), name=df.index.name)
+    return df
+
+
+def merge_compact(left, right, **kwargs):
+    """pd.merge that keeps categorical keys categorical.
+    Merging categoricals with different categories gives object columns, so both
+    sides are moved onto the union of categories first.
+    """
+    on = kwargs.get("on")
+    keys = [on] if isinstance(on, str) else list(on or left.columns.intersection(right.columns))
+    left, right = left.copy(deep=False), right.copy(deep=False)
+    for key in keys:
+        if key not in left.columns or key not in right.columns:
+            continue
+        if not (
+            isinstance(left[key].dtype, pd.CategoricalDtype)
+            or isinstance(right[key].dtype, pd.CategoricalDtype)
+        ):
+            continue
+        categories = pd.api.types.union_categoricals(
+            [left[key].astype("category"), right[key].astype("category")]
+        ).categories
+        left[key] = left[key].astype(pd.CategoricalDtype(categories))
+        right[key] = right[key].astype(pd.CategoricalDtype(categories))
+    return compact_frame(pd.merge(left, right, **kwargs))
+
+
+def memory_report(before, after):
+    """Bytes per column before and after compacting, with a total row."""
+    report = pd.DataFrame(
+        {
+            "dtype_before": before.dtypes.astype(str),
+            "bytes_before": before.memory_usage(deep=True, index=False),
+            "dtype_after": after.dtypes.astype(str),
+            "bytes_after": after.memory_usage(deep=True, index=False),
+        }
+    )
+    report.loc["total"] = [
+        "",
+        report["bytes_before"].sum(),
+        "",
+        report["bytes_after"].sum(),
+    ]
+    report["saving"] = 1 - report["bytes_after"] / report["bytes_before"]
+    return report
+
+
+"""
+---------------------------------------VALIDATION---------------------------------------
+"""
+
+# Checks on the rows going into each table, run vectorised on every chunk as the
+# CSVs are written (write_csv) or read for loading, so overflowing decimals, NaN
+# proportions and missing coordinates are counted before LOAD DATA silently turns
+# them into 0s or truncated values. Rules name the table's columns; CSV columns are
+# matched by position, as LOAD DATA does.
+
+
+class Rule:
+    def __init__(self, name, column, bad):
+        """:param bad: Series -> boolean mask of the offending values"""
+        self.name = name
+        self.column = column
+        self.bad = bad
+
+    def __repr__(self):
+        return f"Rule({self.name!r})"
+
+
+def _numeric(series):
+    return pd.to_numeric(series, errors="coerce")
+
+
+def not_null(column):
+    # LOAD DATA reads an empty field as 0 (numbers) or "" (strings), not NULL
+    return Rule(f"{column} is missing", column, lambda series: series.isna() | (series.astype(str) == ""))
+
+
+def numeric(column):
+    return Rule(f"{column} is not a number", column, lambda series: series.notna() & _numeric(series).isna())
+
+
+def finite(column):
+    # NaN is missing, see not_null
+    return Rule(f"{column} is infinite", column, lambda series: np.isinf(_numeric(series).astype(np.float64)))
+
+
+def decimal(column, precision, scale):
+    limit = 10 ** (precision - scale)
+    return Rule(
+        f"{column} overflows DECIMAL({precision},{scale})",
+        column,
+        # infinities are counted by finite
+        lambda series: (_numeric(series).abs().round(scale) >= limit) & ~np.isinf(_numeric(series).astype(np.float64)),
+    )
+
+
+def in_range(column, low, high):
+    return Rule(
+        f"{column} outside [{low}, {high}]",
+        column,
+        lambda series: (_numeric(series) < low) | (_numeric(series) > high),
+    )
+
+
+def max_length(column, length):
+    return Rule(
+        f"{column} longer than {length} characters",
+        column,
+        lambda series: series.astype(str).str.len() > length,
+    )
+
+
+_osm_count_columns = [f"{tag}_count" for tag in _tag_columns]
+
+# column order of the tables, as LOAD DATA fills them
+table_columns = {
+    "census_coordinates": ["FID", "OA21CD", "LSOA21NM", "LSOA21NMW", "LAT", "LONG"],
+    "census_student_pop": ["OA21CD", "TOTAL_POP", "STUDENT_POP", "TOTAL_RAW_POP"],
+    "census_student_coordinates_join": [
+        "FID", "OA21CD", "LSOA21NM", "LSOA21NMW", "LAT", "LONG", "TOTAL_POP", "STUDENT_POP", "TOTAL_RAW_POP",
+    ],
+    "proficiency": ["db_id", "local_authorities_code", "local_authority", "non_main_language_pop"],
+    "osm_data": ["FID", "LAT", "LONG"] + _osm_count_columns,
+    "income": [
+        "db_id", "local_authorities_code", "region", "local_authority",
+        "tenth_percentile", "fiftieth_percentile", "ninetieth_percentile",
+    ],
+    "general_health": [
+        "db_id", "local_authorities_code", "local_authorities", "general_health_code", "general_health", "observation",
+    ],
+    "health_2011": [
+        "db_id", "local_authorities_code", "local_authorities", "general_health_code", "general_health", "observation",
+    ],
+    "education": [
+        "db_id", "local_authorities_code", "local_authorities", "level_of_education_code", "level_of_education", "observation",
+    ],
+    "education_2011": [
+        "db_id", "local_authorities_code", "local_authorities", "level_of_education_code", "level_of_education", "observation",
+    ],
+    "pp_data": [
+        "transaction_unique_identifier", "price", "date_of_transfer", "postcode", "property_type",
+        "new_build_flag", "tenure_type", "primary_addressable_object_name", "secondary_addressable_object_name",
+        "street", "locality", "town_city", "district", "county", "ppd_category_type", "record_status",
+    ],
+    "prices_coordinates_data": [
+        "price", "date_of_transfer", "postcode", "property_type", "new_build_flag", "tenure_type", "locality",
+        "town_city", "district", "county", "country", "latitude", "longitude",
+        "primary_addressable_object_name", "secondary_addressable_object_name",
+    ],
+    "coordinate_output_areas": ["latitude", "longitude", "OA21CD"],
+}
+
+
+def _coordinates(latitude, longitude):
+    return [
+        not_null(latitude),
+        not_null(longitude),
+        in_range(latitude, -90, 90),
+        in_range(longitude, -180, 180),
+    ]
+
+
+def _local_authority_observations():
+    return [
+        not_null("local_authorities_code"),
+        max_length("local_authorities_code", 10),
+        not_null("observation"),
+        in_range("observation", 0, 2**31 - 1),
+    ]
+
+
+table_rules = {
+    "census_coordinates": [not_null("FID"), not_null("OA21CD"), max_length("OA21CD", 10), not_null("LSOA21NM")]
+    + _coordinates("LAT", "LONG"),
+    "census_student_pop": [
+        not_null("OA21CD"),
+        max_length("OA21CD", 10),
+        # nullable, but an empty field loads as 0 rather than NULL
+        not_null("TOTAL_POP"),
+        finite("TOTAL_POP"),
+        decimal("TOTAL_POP", 3, 2),
+        not_null("STUDENT_POP"),
+        finite("STUDENT_POP"),
+        decimal("STUDENT_POP", 3, 2),
+    ],
+    "census_student_coordinates_join": [not_null("FID"), not_null("OA21CD"), not_null("LSOA21NM")]
+    + _coordinates("LAT", "LONG")
+    + [decimal("TOTAL_POP", 3, 2), decimal("STUDENT_POP", 3, 2)],
+    "proficiency": [
+        not_null("local_authorities_code"),
+        max_length("local_authorities_code", 10),
+        not_null("non_main_language_pop"),
+        finite("non_main_language_pop"),
+        decimal("non_main_language_pop", 4, 4),
+    ],
+    "osm_data": [not_null("FID")]
+    + _coordinates("LAT", "LONG")
+    + [in_range(column, 0, 2**31 - 1) for column in _osm_count_columns],
+    "income": [
+        not_null("local_authorities_code"),
+        max_length("local_authorities_code", 10),
+        numeric("tenth_percentile"),
+        numeric("fiftieth_percentile"),
+        numeric("ninetieth_percentile"),
+    ],
+    "general_health": _local_authority_observations(),
+    "health_2011": _local_authority_observations(),
+    "education": _local_authority_observations(),
+    "education_2011": _local_authority_observations(),
+    "prices_coordinates_data": [
+        not_null("price"),
+        in_range("price", 1, 2**31 - 1),
+        not_null("date_of_transfer"),
+        not_null("postcode"),
+        max_length("postcode", 8),
+    ]
+    + _coordinates("latitude", "longitude"),
+    "coordinate_output_areas": _coordinates("latitude", "longitude") + [max_length("OA21CD", 10)],
+}
+
+
+class ValidationReport:
+    """Offending row counts (and a few sample rows) per rule, accumulated over chunks."""
+
+    def __init__(self, table_name, max_samples=5):
+        self.table_name = table_name
+        self.max_samples = max_samples
+        self.rows = 0
+        self.counts = {}
+        self.samples = {}
+        # MySQL SHOW WARNINGS rows from the load, (level, code, message)
+        self.load_warnings = []
+        self.load_warning_count = 0
+
+    def check(self, chunk, positional=True):
+        """Apply the table's rules to a chunk of rows.
+        :param positional: the chunk's columns are in table order under other names (e.g. a raw CSV)
+        """
+        if positional:
+            names = table_columns.get(self.table_name)
+            if names is not None:
+                chunk = chunk.set_axis(list(names[: len(chunk.columns)]) + list(chunk.columns[len(names):]), axis=1)
+        self.rows += len(chunk)
+        for rule in table_rules.get(self.table_name, []):
+            if rule.column not in chunk.columns:
+                continue
+            bad = np.asarray(rule.bad(chunk[rule.column]), dtype=bool)
+            count = int(bad.sum())
+            if count == 0:
+                continue
+            self.counts[rule.name] = self.counts.get(rule.name, 0) + count
+            samples = self.samples.setdefault(rule.name, [])
+            if len(samples) < self.max_samples:
+                offending = chunk.loc[bad].head(self.max_samples - len(samples))
+                samples += json.loads(offending.to_json(orient="records", default_handler=str))
+        return self
+
+    @property
+    def ok(self):
+        return not self.counts and not self.load_warning_count
+
+    def to_dict(self):
+        return {
+            "table_name": self.table_name,
+            "rows": self.rows,
+            "counts": self.counts,
+            "samples": self.samples,
+            "load_warning_count": self.load_warning_count,
+            "load_warnings": [list(warning) for warning in self.load_warnings],
+        }
+
+    @classmethod
+    def from_dict(cls, saved):
+        report = cls(saved["table_name"])
+        report.rows = saved["rows"]
+        report.counts = saved["counts"]
+        report.samples = saved["samples"]
+        report.load_warning_count = saved.get("load_warning_count", 0)
+        report.load_warnings = [tuple(warning) for warning in saved.get("load_warnings", [])]
+        return report
+
+    def to_frame(self):
+        return pd.DataFrame(
+            [(rule, count, self.samples.get(rule, [])[:1]) for rule, count in self.counts.items()],
+            columns=["rule", "rows", "example"],
+        )
+
+    def summary(self):
+        lines = [f"{self.table_name}: {self.rows} rows checked"]
+        for rule, count in self.counts.items():
+            lines.append(f"  {count} rows: {rule}, e.g. {self.samples[rule][0]}")
+        if self.load_warning_count:
+            lines.append(f"  {self.load_warning_count} load warnings, e.g.")
+            lines += [f"    {level} {code}: {message}" for level, code, message in self.load_warnings]
+        return "\n".join(lines)
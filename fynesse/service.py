@@ -0,0 +1,314 @@
+import argparse
+import asyncio
+import collections
+import json
+import math
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from .lazy import lazy_import
+from . import access, address
+
+np = lazy_import("numpy")
+
+# Student population predictions over HTTP. The BallTree, feature matrix and model
+# are loaded once; concurrent requests are queued and answered together by one
+# address.predict_batch call (one tree query and one model call per batch), which
+# runs off the event loop so the next batch fills while the current one predicts.
+#
+#   POST /predict  {"lat": 52.2, "lon": 0.12}              -> {"student_pop": 0.31}
+#                  {"points": [[52.2, 0.12], [51.5, -0.1]]} -> {"student_pop": [0.31, 0.08]}
+#   GET  /metrics  latency, queue wait and batch size histograms
+#   GET  /health
+#
+#   $ fynesse-serve --model student_model.joblib --port 8080 --max-wait-ms 2
+#   $ python benchmarks/bench_serve.py   # load generator
+
+# histogram bucket upper bounds, the last bucket is open
+latency_buckets_ms = [0.25, 0.5, 1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000]
+batch_size_buckets = [1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024, 4096]
+
+
+class Histogram:
+    def __init__(self, bounds):
+        self.bounds = list(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        i = 0
+        while i < len(self.bounds) and value > self.bounds[i]:
+            i += 1
+        self.counts[i] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the q-th quantile (the max for the open bucket)."""
+        if self.count == 0:
+            return math.nan
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.bounds + [self.max], self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "mean": self.sum / self.count if self.count else math.nan,
+            "p50": self.quantile(0.5),
+            "p90": self.quantile(0.9),
+            "p99": self.quantile(0.99),
+            "max": self.max,
+            "buckets": {f"le_{bound:g}": count for bound, count in zip(self.bounds, self.counts)}
+            | {"inf": self.counts[-1]},
+        }
+
+
+class Predictor:
+    """What address.predict needs, loaded once."""
+
+    def __init__(self, model, tree, feature_matrix):
+        self.model = model
+        self.tree = tree
+        self.feature_matrix = feature_matrix
+
+    @classmethod
+    def from_frame(cls, model, osm_merged_df, feature_cols=None):
+        return cls(
+            model,
+            address.get_coordinates_and_ball_tree(osm_merged_df),
+            address.build_feature_matrix(osm_merged_df, feature_cols),
+        )
+
+    @classmethod
+    def from_feature_store(cls, model_path, store_dir=None, feature_cols=None):
+        from .feature_store import open_feature_store
+
+        feature_cols = list(feature_cols or access.updated_feature_cols)
+        store = open_feature_store(store_dir=store_dir)
+        return cls.from_frame(
+            address.load_model(model_path, feature_cols), store.frame(["LAT", "LONG"] + feature_cols), feature_cols
+        )
+
+    def predict(self, latitudes, longitudes):
+        return address.predict_batch(latitudes, longitudes, self.model, self.tree, self.feature_matrix)
+
+
+class MicroBatcher:
+    """Coalesces concurrent predict calls into batches of up to max_batch_size points.
+    A batch is sent once it is full or its oldest request has waited max_wait_ms."""
+
+    def __init__(self, predict, max_batch_size=256, max_wait_ms=2.0):
+        self.predict_fn = predict
+        self.max_batch_size = max_batch_size
+        self.max_wait_s = max_wait_ms / 1000
+        self.batch_sizes = Histogram(batch_size_buckets)
+        self.queue_wait_ms = Histogram(latency_buckets_ms)
+        self.predict_ms = Histogram(latency_buckets_ms)
+        # (latitudes, longitudes, future, enqueue time)
+        self._pending = collections.deque()
+        self._pending_points = 0
+        self._wakeup = None
+        self._task = None
+        # one batch at a time, the model uses the cores itself
+        self._executor = ThreadPoolExecutor(max_workers=1)
+
+    def start(self):
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._executor.shutdown()
+
+    async def predict(self, latitudes, longitudes):
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((latitudes, longitudes, future, time.perf_counter()))
+        self._pending_points += len(latitudes)
+        self._wakeup.set()
+        return await future
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            if not self._pending:
+                continue
+            # let the batch fill until it is full or the oldest request is due
+            while self._pending_points < self.max_batch_size:
+                remaining = self._pending[0][3] + self.max_wait_s - time.perf_counter()
+                if remaining <= 0:
+                    break
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), remaining)
+                except asyncio.TimeoutError:
+                    break
+                self._wakeup.clear()
+
+            batch, size = [], 0
+            while self._pending and (not batch or size + len(self._pending[0][0]) <= self.max_batch_size):
+                item = self._pending.popleft()
+                batch.append(item)
+                size += len(item[0])
+            self._pending_points -= size
+            if self._pending:
+                # whatever didn't fit goes out next without waiting again
+                self._wakeup.set()
+
+            now = time.perf_counter()
+            for _, _, _, enqueued in batch:
+                self.queue_wait_ms.observe((now - enqueued) * 1000)
+            self.batch_sizes.observe(size)
+
+            latitudes = np.concatenate([item[0] for item in batch])
+            longitudes = np.concatenate([item[1] for item in batch])
+            try:
+                predictions = await loop.run_in_executor(self._executor, self.predict_fn, latitudes, longitudes)
+            except Exception as e:
+                for _, _, future, _ in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            self.predict_ms.observe((time.perf_counter() - now) * 1000)
+
+            start = 0
+            for item_latitudes, _, future, _ in batch:
+                end = start + len(item_latitudes)
+                if not future.done():
+                    future.set_result(predictions[start:end])
+                start = end
+
+
+class PredictionService:
+    def __init__(self, predictor, max_batch_size=256, max_wait_ms=2.0):
+        self.predictor = predictor
+        self.batcher = MicroBatcher(predictor.predict, max_batch_size, max_wait_ms)
+        self.request_ms = Histogram(latency_buckets_ms)
+        self.errors = 0
+        self.server = None
+
+    async def start(self, host="127.0.0.1", port=8080):
+        self.batcher.start()
+        self.server = await asyncio.start_server(self._handle_connection, host, port)
+        return self.server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+        await self.batcher.stop()
+
+    def metrics(self):
+        return {
+            "request_latency_ms": self.request_ms.to_dict(),
+            "queue_wait_ms": self.batcher.queue_wait_ms.to_dict(),
+            "predict_ms": self.batcher.predict_ms.to_dict(),
+            "batch_size": self.batcher.batch_sizes.to_dict(),
+            "errors": self.errors,
+        }
+
+    async def _predict(self, body):
+        request = json.loads(body)
+        if "points" in request:
+            points = np.asarray(request["points"], dtype=np.float64).reshape(-1, 2)
+            predictions = await self.batcher.predict(points[:, 0], points[:, 1])
+            return {"student_pop": predictions.tolist()}
+        predictions = await self.batcher.predict(
+            np.array([float(request["lat"])]), np.array([float(request["lon"])])
+        )
+        return {"student_pop": float(predictions[0])}
+
+    async def _respond(self, method, path, body):
+        if method == "POST" and path == "/predict":
+            start = time.perf_counter()
+            try:
+                result = await self._predict(body)
+            except (ValueError, KeyError, TypeError) as e:
+                self.errors += 1
+                return 400, {"error": f"{type(e).__name__}: {e}"}
+            except Exception as e:
+                # e.g. the model failing, the client still gets an answer
+                self.errors += 1
+                return 500, {"error": f"{type(e).__name__}: {e}"}
+            self.request_ms.observe((time.perf_counter() - start) * 1000)
+            return 200, result
+        if method == "GET" and path == "/metrics":
+            return 200, self.metrics()
+        if method == "GET" and path == "/health":
+            return 200, {"status": "ok"}
+        return 404, {"error": f"No route for {method} {path}"}
+
+    async def _handle_connection(self, reader, writer):
+        # HTTP/1.1 with keep-alive, enough for JSON clients and load generators
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, path, _ = request_line.decode("latin-1").split(" ", 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+
+                status, result = await self._respond(method, path, body)
+                payload = json.dumps(result).encode()
+                reason = {200: "OK", 400: "Bad Request", 404: "Not Found", 500: "Internal Server Error"}[status]
+                writer.write(
+                    f"HTTP/1.1 {status} {reason}\r\nContent-Type: application/json\r\n"
+                    f"Content-Length: {len(payload)}\r\n\r\n".encode()
+                    + payload
+                )
+                await writer.drain()
+                if headers.get("connection", "").lower() == "close":
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+
+async def _serve_forever(service, host, port):
+    port = await service.start(host, port)
+    print(f"Serving predictions on http://{host}:{port}")
+    async with service.server:
+        await service.server.serve_forever()
+
+
+def cli(argv=None):
+    parser = argparse.ArgumentParser(prog="fynesse-serve", description="Serve student population predictions over HTTP.")
+    parser.add_argument("--model", required=True, help="model saved by address.save_model")
+    parser.add_argument("--store-dir", help="feature store directory, config feature_store_dir by default")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--max-batch-size", type=int, default=256)
+    parser.add_argument("--max-wait-ms", type=float, default=2.0)
+    args = parser.parse_args(argv)
+
+    predictor = Predictor.from_feature_store(args.model, args.store_dir)
+    service = PredictionService(predictor, args.max_batch_size, args.max_wait_ms)
+    try:
+        asyncio.run(_serve_forever(service, args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(cli())
@@ -0,0 +1,126 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from fynesse import access, address, schema
+
+
+def haversine_km(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = map(np.radians, (lat1, lon1, lat2, lon2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * address.earth_radius_km * np.arcsin(np.sqrt(a))
+
+
+def census():
+    rng = np.random.default_rng(0)
+    size = 500
+    return pd.DataFrame({
+        "OA21CD": [f"E00{i:06d}" for i in range(size)],
+        "LAT": rng.uniform(50.5, 54.0, size),
+        "LONG": rng.uniform(-3.0, 1.0, size),
+    })
+
+
+def test_assignment_matches_brute_force_nearest_centroid():
+    centroids = census()
+    rng = np.random.default_rng(1)
+    latitudes = rng.uniform(50.5, 54.0, 2000)
+    longitudes = rng.uniform(-3.0, 1.0, 2000)
+    tree, codes = address.build_output_area_index(centroids)
+
+    # small chunks so several go through the pool
+    assigned = address.assign_output_areas(latitudes, longitudes, tree, codes, chunksize=300, max_workers=3)
+
+    distances = haversine_km(latitudes[:, None], longitudes[:, None], centroids["LAT"].to_numpy(), centroids["LONG"].to_numpy())
+    expected = centroids["OA21CD"].to_numpy()[distances.argmin(axis=1)]
+    assert list(assigned) == list(expected)
+
+
+def test_max_distance_leaves_far_points_unassigned():
+    centroids = census()
+    tree, codes = address.build_output_area_index(centroids)
+    latitudes = np.array([centroids["LAT"][0] + 0.001, 40.0])
+    longitudes = np.array([centroids["LONG"][0], -3.0])
+
+    assigned = address.assign_output_areas(latitudes, longitudes, tree, codes, max_distance_km=1.0)
+    assert list(assigned) == [centroids["OA21CD"][0], None]
+
+
+def test_csv_assignment_keeps_rows_in_order(tmp_path):
+    centroids = census()
+    tree, codes = address.build_output_area_index(centroids)
+    points = centroids.sample(frac=1, random_state=0)[["LAT", "LONG"]].rename(columns={"LAT": "latitude", "LONG": "longitude"})
+    points.to_csv(tmp_path / "in.csv", index=False)
+
+    address.assign_output_areas_csv(tmp_path / "in.csv", tmp_path / "out.csv", tree, codes, chunksize=128)
+    written = pd.read_csv(tmp_path / "out.csv")
+    assert len(written) == len(points)
+    # every centroid is its own nearest centroid
+    assert written["OA21CD"].tolist() == centroids.loc[points.index, "OA21CD"].tolist()
+
+
+def price_tables():
+    rng = np.random.default_rng(2)
+    postcodes = pd.DataFrame({
+        "postcode": [f"CB{i} 1AA" for i in range(40)],
+        "country": "England",
+        "latitude": np.round(rng.uniform(50.5, 54.0, 40), 8),
+        "longitude": np.round(rng.uniform(-3.0, 1.0, 40), 8),
+    })
+    rows = 300
+    pp = pd.DataFrame({
+        "transaction_unique_identifier": [f"{{{i:08d}}}" for i in range(rows)],
+        "price": rng.integers(50000, 900000, rows),
+        "date_of_transfer": pd.to_datetime("2020-01-01") + pd.to_timedelta(rng.integers(0, 731, rows), unit="D"),
+    })
+    # 2021 brings postcodes 2020 never saw
+    offset = np.where(pp["date_of_transfer"].dt.year == 2020, 0, 20)
+    pp["postcode"] = [f"CB{i % 20 + extra} 1AA" for i, extra in zip(range(rows), offset)]
+    for column in ["property_type", "new_build_flag", "tenure_type"]:
+        pp[column] = "F"
+    for column in ["primary_addressable_object_name", "secondary_addressable_object_name", "street",
+                   "locality", "town_city", "district", "county", "ppd_category_type", "record_status"]:
+        pp[column] = "x"
+    return pp[schema.table_columns["pp_data"]], postcodes
+
+
+def test_table_assignment_leaves_the_price_table_loadable():
+    centroids = census()
+    tree, codes = address.build_output_area_index(centroids)
+    pp, postcodes = price_tables()
+    conn = access.create_duckdb_connection(":memory:")
+    access.initialize_pp_data_db(conn)
+    access.initialize_postcode_data_db(conn)
+    access.initialize_prices_coordinates_data_db(conn)
+    access.load_frames_into_db(conn, pp, "pp_data", validate=False)
+    access.load_frames_into_db(conn, postcodes, "postcode_data", validate=False)
+
+    access.housing_upload_join_data(conn, 2020, update_rollups=False)
+    assert address.assign_output_areas_table(conn, tree, codes) == 20
+    # the price table keeps its own columns, so the next year still loads
+    access.housing_upload_join_data(conn, 2021, update_rollups=False)
+    assert address.assign_output_areas_table(conn, tree, codes) == 20
+    assert address.assign_output_areas_table(conn, tree, codes) == 0
+
+    joined = access.read_frame(conn, query=address.output_areas_query())
+    assert len(joined) == len(pp)
+    assert list(joined.columns) == schema.table_columns["prices_coordinates_data"] + ["OA21CD"]
+    distances = haversine_km(
+        joined["latitude"].to_numpy(dtype=np.float64)[:, None],
+        joined["longitude"].to_numpy(dtype=np.float64)[:, None],
+        centroids["LAT"].to_numpy(),
+        centroids["LONG"].to_numpy(),
+    )
+    expected = centroids["OA21CD"].to_numpy()[distances.argmin(axis=1)]
+    assert joined["OA21CD"].astype(str).tolist() == list(expected)
+
+
+def test_empty_inputs():
+    tree, codes = address.build_output_area_index(census())
+    assert len(address.assign_output_areas([], [], tree, codes)) == 0
+    with pytest.raises(ValueError, match="codes for a tree"):
+        address.assign_output_areas([52.0], [0.1], tree, codes[:0])
+    with pytest.raises(ValueError, match="longitudes"):
+        address.assign_output_areas([52.0, 52.1], [0.1], tree, codes)
+    with pytest.raises(ValueError, match="No output areas"):
+        address.build_output_area_index(census().iloc[:0])
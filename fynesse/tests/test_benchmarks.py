@@ -0,0 +1,20 @@
+import os
+import sys
+
+import pytest
+
+# the benchmarks drive the access functions through the sqlite stand-in, so they
+# catch MariaDB only statements sent to connections that aren't MariaDB
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "..", "benchmarks"))
+
+import run_benchmarks  # noqa: E402
+import synthetic  # noqa: E402
+
+
+@pytest.mark.parametrize("name", list(run_benchmarks.benchmarks))
+def test_benchmark_runs(name, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    areas = synthetic.output_area_coordinates(200)
+    rows, timing = run_benchmarks.benchmarks[name](areas, 1)
+    assert rows > 0
+    assert timing["min_s"] >= 0
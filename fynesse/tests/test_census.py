@@ -0,0 +1,61 @@
+import os
+import zipfile
+
+import pandas as pd
+import pytest
+
+from fynesse import access
+
+
+def write_archive(base_dir, code="TS062", levels=("oa", "msoa")):
+    path = os.path.join(base_dir, f"census2021-{code.lower()}.zip")
+    with zipfile.ZipFile(path, "w") as archive:
+        for level in levels:
+            frame = pd.DataFrame({"date": [2021], "geography": ["A"], "geography code": ["A"], "total": [3]})
+            archive.writestr(f"census2021-{code.lower()}-{level}.csv", frame.to_csv(index=False))
+    return path
+
+
+@pytest.fixture(autouse=True)
+def no_network(monkeypatch):
+    def refuse(*args, **kwargs):
+        raise AssertionError("tried to download")
+
+    monkeypatch.setattr(access.requests, "get", refuse)
+
+
+def test_existing_extract_is_used_whatever_the_levels(tmp_path):
+    extract_dir = tmp_path / "census2021-ts062"
+    extract_dir.mkdir()
+    (extract_dir / "census2021-ts062-oa.csv").write_text("geography code\nA\n")
+    for levels in ([], (), None, ["oa"]):
+        access.download_census_data("TS062", str(tmp_path), levels=levels)
+    access.download_census_tables(["TS062"], str(tmp_path))
+
+
+def test_only_requested_levels_are_extracted(tmp_path):
+    write_archive(tmp_path)
+    access.download_census_data("TS062", str(tmp_path), levels=["msoa"])
+    assert os.listdir(tmp_path / "census2021-ts062") == ["census2021-ts062-msoa.csv"]
+
+
+def test_unextracted_level_is_read_from_the_archive(tmp_path):
+    write_archive(tmp_path)
+    access.download_census_data("TS062", str(tmp_path), levels=["msoa"])
+    table = access.load_census_data("TS062", "oa", str(tmp_path))
+    assert table["total"].tolist() == [3]
+    assert not (tmp_path / "census2021-ts062" / "census2021-ts062-oa.csv").exists()
+
+
+def test_download_is_instrumented():
+    assert access.download_census_data.__name__ == "download_census_data"
+    assert hasattr(access.download_census_data, "__wrapped__")
+    assert not hasattr(access._census_zip_path, "__wrapped__")
+
+
+def test_census_matrix_rejects_unknown_alignment(tmp_path):
+    write_archive(tmp_path)
+    with pytest.raises(ValueError, match="Unknown alignment"):
+        access.load_census_matrix(["TS062"], base_dir=str(tmp_path), how="left")
+    with pytest.raises(ValueError, match="No census table codes"):
+        access.load_census_matrix([], base_dir=str(tmp_path))
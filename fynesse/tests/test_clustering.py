@@ -0,0 +1,60 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from fynesse import address
+
+
+@pytest.fixture
+def points():
+    rng = np.random.default_rng(0)
+    centres = [(52.2, 0.12), (51.5, -0.12), (53.48, -2.24)]
+    blobs = [
+        np.column_stack([rng.normal(lat, 0.004, size), rng.normal(lon, 0.006, size)])
+        for (lat, lon), size in zip(centres, [400, 250, 120])
+    ]
+    noise = np.column_stack([rng.uniform(50.5, 54, 150), rng.uniform(-3, 1, 150)])
+    coordinates = np.concatenate(blobs + [noise])
+    # a shuffled, non-default index
+    return pd.DataFrame({"LAT": coordinates[:, 0], "LONG": coordinates[:, 1]}, index=rng.permutation(len(coordinates)) + 1000)
+
+
+def reference(df, eps_km, min_samples):
+    from sklearn.cluster import DBSCAN
+
+    model = DBSCAN(eps=eps_km / address.earth_radius_km, min_samples=min_samples, metric="haversine")
+    labels = model.fit_predict(np.radians(df[["LAT", "LONG"]].to_numpy()))
+    core = np.zeros(len(df), dtype=bool)
+    core[model.core_sample_indices_] = True
+    return labels, core
+
+
+def same_partition(a, b):
+    pairs = pd.crosstab(a, b)
+    return ((pairs > 0).sum(axis=0) == 1).all() and ((pairs > 0).sum(axis=1) == 1).all()
+
+
+@pytest.mark.parametrize("chunksize, max_workers", [(20000, None), (37, 3)])
+def test_matches_sklearn_haversine_dbscan(points, chunksize, max_workers):
+    labels = address.density_clusters(points, eps_km=0.5, min_samples=8, chunksize=chunksize, max_workers=max_workers)
+    expected, core = reference(points, 0.5, 8)
+    assert expected.max() >= 2 and (expected == -1).any()
+    assert labels.index.equals(points.index)
+    # core points and noise are well defined, border points may go to either cluster
+    assert same_partition(labels.to_numpy()[core], expected[core])
+    np.testing.assert_array_equal(labels.to_numpy() == -1, expected == -1)
+
+
+def test_clusters_are_numbered_by_size(points):
+    labels = address.density_clusters(points, eps_km=0.5, min_samples=8)
+    sizes = labels[labels >= 0].value_counts().sort_index()
+    assert list(sizes.index) == list(range(len(sizes)))
+    assert sizes.is_monotonic_decreasing
+
+
+def test_missing_coordinates_are_noise(points):
+    points = points.copy()
+    points.iloc[:5, 0] = np.nan
+    labels = address.density_clusters(points, eps_km=0.5, min_samples=8)
+    assert (labels.iloc[:5] == -1).all()
+    assert len(labels) == len(points)
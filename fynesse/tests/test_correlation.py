@@ -0,0 +1,82 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from fynesse import assess
+
+columns = ["a", "b", "c", "d"]
+
+
+@pytest.fixture
+def df():
+    rng = np.random.default_rng(0)
+    a = rng.normal(size=5000)
+    frame = pd.DataFrame(
+        {
+            "a": a,
+            "b": 2 * a + rng.normal(size=len(a)),
+            # a large offset, where naive sums of squares cancel
+            "c": 1e8 + rng.normal(size=len(a)) - a,
+            "d": rng.normal(size=len(a)),
+        }
+    )
+    # missing values differ per column, so pairwise counts differ
+    frame.loc[rng.random(len(frame)) < 0.1, "b"] = np.nan
+    frame.loc[rng.random(len(frame)) < 0.05, "d"] = np.nan
+    return frame
+
+
+def reference(frame, method="corr"):
+    # pandas loses ~1e-9 to the offset itself; removing it first is exact (the values
+    # are close to 1e8) and changes neither correlation nor covariance
+    return getattr(frame[columns].assign(c=frame["c"] - 1e8), method)()
+
+
+def chunks(frame, size):
+    return (frame.iloc[start:start + size] for start in range(0, len(frame), size))
+
+
+@pytest.mark.parametrize("chunksize", [1, 7, 1000, 10000])
+def test_streamed_correlation_matches_pandas(df, chunksize):
+    stats = assess.streaming_correlation_stats(chunks(df, chunksize), columns)
+    np.testing.assert_allclose(assess.correlation_from_stats(stats), reference(df), rtol=1e-9, atol=1e-12)
+    np.testing.assert_allclose(assess.covariance_from_stats(stats), reference(df, "cov"), rtol=1e-9, atol=1e-9)
+
+
+def test_merged_partials_match_one_pass(df):
+    # partials centred on very different first chunks
+    parts = [df.iloc[:10], df.iloc[10:3000], df.iloc[3000:]]
+    partial_stats = [assess.streaming_correlation_stats(chunks(part, 500), columns) for part in parts]
+    merged = assess.init_correlation_stats(columns)
+    for stats in partial_stats:
+        merged = assess.merge_correlation_stats(merged, stats)
+    np.testing.assert_allclose(assess.correlation_from_stats(merged), reference(df), rtol=1e-9, atol=1e-12)
+    np.testing.assert_array_equal(merged["count"], df[columns].notna().astype(int).T @ df[columns].notna().astype(int))
+
+
+def test_csv_stats_match_frame(df, tmp_path):
+    path = tmp_path / "stats.csv"
+    df.to_csv(path, index=False)
+    stats = assess.csv_correlation_stats(str(path), columns, chunksize=999)
+    # read_csv's fast float parser may be an ulp off, compare with what it reads
+    np.testing.assert_allclose(
+        assess.correlation_from_stats(stats), reference(pd.read_csv(path)), rtol=1e-9, atol=1e-12
+    )
+
+
+def test_min_periods_masks_sparse_pairs():
+    frame = pd.DataFrame({"a": [1.0, 2.0, 3.0], "b": [np.nan, np.nan, 1.0]})
+    stats = assess.streaming_correlation_stats([frame], ["a", "b"])
+    corr = assess.correlation_from_stats(stats, min_periods=2)
+    assert np.isnan(corr.loc["a", "b"])
+    assert corr.loc["a", "a"] == pytest.approx(1.0)
+
+
+def test_parallel_files_match_one_pass(df, tmp_path):
+    paths = []
+    for i, part in enumerate([df.iloc[:1234], df.iloc[1234:]]):
+        paths.append(str(tmp_path / f"part{i}.csv"))
+        part.to_csv(paths[-1], index=False)
+    stats = assess.parallel_correlation_stats(paths, columns, max_workers=2, chunksize=500)
+    read_back = pd.concat([pd.read_csv(path) for path in paths])
+    np.testing.assert_allclose(assess.correlation_from_stats(stats), reference(read_back), rtol=1e-9, atol=1e-12)
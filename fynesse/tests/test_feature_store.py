@@ -0,0 +1,50 @@
+import numpy as np
+import pytest
+
+from fynesse import access, feature_store
+
+columns = ["amenity_count", "STUDENT_POP", "non_main_language_pop"]
+
+
+@pytest.fixture
+def conn():
+    conn = access.create_duckdb_connection(":memory:")
+    curr = conn.cursor()
+    curr.execute("CREATE TABLE osm_data AS SELECT i AS FID, i * 2 AS amenity_count FROM range(5) AS r(i);")
+    curr.execute(
+        "CREATE TABLE census_student_coordinates_join AS "
+        "SELECT i AS FID, 'E0' || i AS OA21CD, i / 10 AS STUDENT_POP FROM range(5) AS r(i);"
+    )
+    curr.execute("CREATE TABLE proficiency AS SELECT 'E01' AS local_authorities_code, 0.5 AS non_main_language_pop;")
+    return conn
+
+
+def test_open_without_rebuild_never_queries(conn, tmp_path, monkeypatch):
+    store = feature_store.open_feature_store(conn, str(tmp_path), columns)
+    assert len(store) == 5
+    np.testing.assert_array_equal(store["amenity_count"], [0, 2, 4, 6, 8])
+
+    monkeypatch.setattr(access, "get_table_versions", lambda *args, **kwargs: pytest.fail("queried the database"))
+    reopened = feature_store.open_feature_store(conn, str(tmp_path), columns, rebuild=False)
+    assert reopened.path == store.path
+    with pytest.raises(ValueError, match="no columns"):
+        feature_store.open_feature_store(conn, str(tmp_path), ["brand_count"], rebuild=False)
+
+
+def test_reload_rebuilds(conn, tmp_path):
+    store = feature_store.open_feature_store(conn, str(tmp_path), columns)
+    conn.cursor().execute("INSERT INTO osm_data VALUES (5, 10);")
+    conn.cursor().execute("INSERT INTO census_student_coordinates_join VALUES (5, 'E05', 0.5);")
+    rebuilt = feature_store.open_feature_store(conn, str(tmp_path), columns)
+    assert rebuilt.path != store.path
+    assert len(rebuilt) == 6
+
+
+def test_positions(conn, tmp_path):
+    store = feature_store.open_feature_store(conn, str(tmp_path), columns)
+    assert store.positions(["E03", "E09", "E00"]).tolist() == [3, -1, 0]
+
+    conn.cursor().execute("DELETE FROM osm_data;")
+    empty = feature_store.open_feature_store(conn, str(tmp_path), columns)
+    assert len(empty) == 0
+    assert empty.positions(["E03"]).tolist() == [-1]
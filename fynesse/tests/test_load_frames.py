@@ -0,0 +1,144 @@
+import io
+import re
+import threading
+
+import numpy as np
+import pandas as pd
+import pymysql
+import pytest
+
+from fynesse import access
+
+
+def frame(rows=2500):
+    return pd.DataFrame(
+        {
+            "a": np.arange(rows),
+            "b": np.where(np.arange(rows) % 7 == 0, np.nan, 1.5),
+            "c": ['x,"y"'] * rows,
+        }
+    )
+
+
+class FakeCursor:
+    """Reads LOAD DATA LOCAL INFILE files by name, as pymysql does, unless refused."""
+
+    rowcount = -1
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.result = None
+
+    def execute(self, query, args=None):
+        if "LOAD DATA" in query:
+            if self.conn.refuse is not None:
+                raise self.conn.refuse
+            path = re.search(r"INFILE '([^']+)'", query)[1]
+            with open(path, "rb") as file:
+                data = file.read()
+            self.conn.loaded = pd.read_csv(io.BytesIO(data), header=None, na_values=["NULL"], keep_default_na=False)
+            self.rowcount = len(self.conn.loaded)
+        elif "WARNINGS" in query:
+            self.result = (0,)
+        else:
+            self.result = None
+
+    def executemany(self, query, rows):
+        self.conn.inserted += rows
+
+    def fetchone(self):
+        return self.result
+
+    def fetchall(self):
+        return []
+
+
+class FakeConnection:
+    # taken for a pymysql connection, so "auto" loads go through the pipe
+    __module__ = "pymysql.connections"
+
+    def __init__(self, refuse=None):
+        self.refuse = refuse
+        self.loaded = None
+        self.inserted = []
+        self.rollbacks = 0
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        self.rollbacks += 1
+
+
+def load(conn, frames, **kwargs):
+    # a hung writer thread must fail the test, not hang it
+    result = {}
+    thread = threading.Thread(
+        target=lambda: result.update(report=access.load_frames_into_db(conn, frames, "t", **kwargs)), daemon=True
+    )
+    thread.start()
+    thread.join(30)
+    assert not thread.is_alive(), "load_frames_into_db hung"
+    return result.get("report")
+
+
+def test_duckdb_loads_chunks():
+    conn = access.create_duckdb_connection(":memory:")
+    curr = conn.cursor()
+    curr.execute("CREATE TABLE t (a BIGINT, b DOUBLE, c VARCHAR);")
+    df = frame()
+    report = access.load_frames_into_db(conn, (df.iloc[i:i + 1000] for i in range(0, len(df), 1000)), "t")
+    curr.execute("SELECT COUNT(*), COUNT(b), MIN(c) FROM t;")
+    assert curr.fetchone() == (len(df), df["b"].count(), 'x,"y"')
+    assert report.rows == len(df)
+    assert access.get_table_versions(conn, ["t"])["t"]["version"] == 1
+
+
+def test_pipe_streams_csv_with_nulls():
+    conn = FakeConnection()
+    df = frame()
+    load(conn, df, chunksize=1000)
+    assert len(conn.loaded) == len(df)
+    assert conn.loaded[1].isna().sum() == df["b"].isna().sum()
+    assert (conn.loaded[2] == 'x,"y"').all()
+    assert not conn.inserted
+
+
+@pytest.mark.parametrize(
+    "refusal",
+    [pymysql.err.OperationalError(1148, "not allowed"), RuntimeError("local_infile option is false")],
+)
+def test_refused_pipe_falls_back_to_inserts(refusal):
+    conn = FakeConnection(refuse=refusal)
+    df = frame()
+    report = load(conn, iter([df.iloc[:1000], df.iloc[1000:]]))
+    assert len(conn.inserted) == len(df)
+    assert conn.inserted[0] == (0, None, 'x,"y"')
+    assert report.rows == len(df)
+
+
+def test_refused_pipe_without_fallback_raises():
+    conn = FakeConnection(refuse=RuntimeError("local_infile option is false"))
+    with pytest.raises(ValueError):
+        access.load_frames_into_db(conn, frame(), "t", method="pipe")
+
+
+def test_other_errors_before_the_pipe_opens_release_the_writer():
+    conn = FakeConnection(refuse=KeyError("boom"))
+    with pytest.raises(KeyError):
+        access.load_frames_into_db(conn, frame(), "t")
+    assert not conn.inserted
+
+
+def test_failing_producer_rolls_back():
+    def chunks():
+        yield frame(10)
+        raise RuntimeError("producer failed")
+
+    conn = FakeConnection()
+    with pytest.raises(RuntimeError, match="producer failed"):
+        access.load_frames_into_db(conn, chunks(), "t")
+    assert conn.rollbacks == 1
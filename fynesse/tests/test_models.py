@@ -0,0 +1,59 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from fynesse import access, address
+
+
+@pytest.fixture
+def df():
+    rng = np.random.default_rng(0)
+    frame = pd.DataFrame(rng.random((200, len(access.updated_feature_cols))), columns=access.updated_feature_cols)
+    frame["STUDENT_POP"] = frame["amenity_count"] * 2 + rng.normal(0, 0.01, len(frame))
+    frame["TOTAL_POP"] = frame["building_count"]
+    return frame
+
+
+def test_saved_model_is_reused_only_for_the_same_training(df, tmp_path):
+    path = str(tmp_path / "model.joblib")
+    forest, _ = address.train_or_load_model(df, path, n_estimators=5)
+    again, _ = address.train_or_load_model(df, path, n_estimators=5)
+    assert type(again) is type(forest)
+    assert again.get_params() == forest.get_params()
+
+    boosted, _ = address.train_or_load_model(df, path, model_type="hist_gradient_boosting", max_iter=10)
+    assert type(boosted).__name__ == "HistGradientBoostingRegressor"
+
+    other_target, _ = address.train_or_load_model(
+        df, path, target_col="TOTAL_POP", model_type="hist_gradient_boosting", max_iter=10
+    )
+    assert other_target.predict(address.build_feature_matrix(df[:1])) != pytest.approx(
+        boosted.predict(address.build_feature_matrix(df[:1]))
+    )
+
+    more_iterations, _ = address.train_or_load_model(
+        df, path, target_col="TOTAL_POP", model_type="hist_gradient_boosting", max_iter=20
+    )
+    assert more_iterations.max_iter == 20
+
+
+def test_load_model_rejects_other_training(df, tmp_path):
+    path = str(tmp_path / "model.joblib")
+    address.train_or_load_model(df, path, n_estimators=5)
+    assert address.load_model(path) is not None
+    with pytest.raises(ValueError):
+        address.load_model(path, training=address.training_spec("hist_gradient_boosting"))
+
+
+def test_plot_model_coefficients_needs_importances(df):
+    model = address.make_model("hist_gradient_boosting", max_iter=5)
+    model.fit(address.build_feature_matrix(df), df["STUDENT_POP"])
+    with pytest.raises(ValueError, match="no feature importances"):
+        address.plot_model_coefficients(model)
+
+
+def test_make_model_params_override_defaults():
+    assert address.make_model("random_forest").n_jobs == -1
+    assert address.make_model("random_forest", n_jobs=1).n_jobs == 1
+    with pytest.raises(ValueError):
+        address.make_model("linear")
@@ -0,0 +1,86 @@
+import re
+
+import pytest
+
+from fynesse import access
+
+
+class PartitionedCursor:
+    """Answers the information_schema query from the connection's partition bounds."""
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.result = None
+
+    def execute(self, query, args=None):
+        self.conn.queries.append(" ".join(query.split()))
+        if "information_schema.PARTITIONS" in query:
+            self.result = self.conn.bounds[args[0]]
+        else:
+            self.result = None
+
+    def executemany(self, query, rows):
+        pass
+
+    def fetchone(self):
+        return self.result
+
+    def fetchall(self):
+        return []
+
+
+class PartitionedConnection:
+    # taken for a pymysql connection
+    __module__ = "pymysql.connections"
+
+    def __init__(self, bounds):
+        # table -> (lowest, highest) partition bound, as initialize_*_db(conn, 1995, 2024) leave them
+        self.bounds = bounds
+        self.queries = []
+
+    def cursor(self):
+        return PartitionedCursor(self)
+
+    def commit(self):
+        pass
+
+    def reorganized(self):
+        return [query for query in self.queries if "REORGANIZE" in query]
+
+
+@pytest.fixture
+def conn(monkeypatch):
+    monkeypatch.setattr(access, "load_frames_into_db", lambda *args, **kwargs: None)
+    return PartitionedConnection({"pp_data": (1995, 2025), "prices_coordinates_data": (1995, 2025)})
+
+
+def test_years_in_range_leave_partitions_alone(conn):
+    access.housing_upload_join_data(conn, 2010, update_rollups=False)
+    assert conn.reorganized() == []
+
+
+def test_later_year_gets_its_own_partitions(conn):
+    access.housing_upload_join_data(conn, 2026, update_rollups=False)
+    reorganized = conn.reorganized()
+    assert [re.search(r"ALTER TABLE `(\w+)`", query)[1] for query in reorganized] == ["pp_data", "prices_coordinates_data"]
+    for query in reorganized:
+        assert "REORGANIZE PARTITION p_after INTO (PARTITION p2025 VALUES LESS THAN (2026), " \
+               "PARTITION p2026 VALUES LESS THAN (2027), PARTITION p_after VALUES LESS THAN MAXVALUE)" in query
+    # the partitions are split before the year is selected and loaded
+    join = next(i for i, query in enumerate(conn.queries) if query.startswith("SELECT pp.price"))
+    assert conn.queries.index(reorganized[-1]) < join
+
+
+def test_earlier_year_splits_p_before(conn):
+    access.add_year_partitions(conn, "pp_data", 1993, year_from=1993)
+    assert conn.reorganized() == [
+        "ALTER TABLE `pp_data` REORGANIZE PARTITION p_before INTO (PARTITION p_before VALUES LESS THAN (1993), "
+        "PARTITION p1993 VALUES LESS THAN (1994), PARTITION p1994 VALUES LESS THAN (1995));"
+    ]
+
+
+def test_duckdb_needs_no_partitions():
+    conn = access.create_duckdb_connection(":memory:")
+    access.initialize_prices_coordinates_data_db(conn, 2020, 2021)
+    access.add_year_partitions(conn, "prices_coordinates_data", 2030)
+    assert access.read_all_data(conn, "prices_coordinates_data") == []
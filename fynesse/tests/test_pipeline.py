@@ -0,0 +1,61 @@
+import pytest
+
+from fynesse import access, pipeline
+
+
+def copy_step():
+    with open("in.txt") as source, open("mid.txt", "w") as target:
+        target.write(source.read().upper())
+
+
+def load_step(conn):
+    curr = conn.cursor()
+    curr.execute("DROP TABLE IF EXISTS t;")
+    curr.execute("CREATE TABLE t (line VARCHAR);")
+    with open("mid.txt") as file:
+        curr.executemany("INSERT INTO t VALUES (%s);", [(line,) for line in file.read().split()])
+    access.bump_table_version(conn, "t")
+
+
+@pytest.fixture
+def steps(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "in.txt").write_text("a b c")
+    toy = [
+        pipeline.Step("copy", copy_step, ["in.txt"], ["mid.txt"], uses_conn=False),
+        pipeline.Step("load", load_step, ["mid.txt"], [pipeline.table("t")]),
+    ]
+    monkeypatch.setattr(pipeline, "steps", toy)
+    return toy
+
+
+def run(*args):
+    return pipeline.cli(["--duckdb", "test.duckdb", "--state", "state.json", *args])
+
+
+def test_skips_unchanged_steps(steps, tmp_path, capsys):
+    assert run() == 0
+    assert "done    load" in capsys.readouterr().out
+    assert run() == 0
+    assert "ok      copy" in capsys.readouterr().out
+
+    (tmp_path / "in.txt").write_text("a b c d")
+    status = pipeline.run_pipeline(
+        lambda: access.create_duckdb_connection("test.duckdb"), state_file="state.json"
+    )
+    assert status == {"copy": "ran", "load": "ran"}
+
+
+def test_dry_run_writes_nothing(steps, tmp_path):
+    assert run("--dry-run") == 0
+    assert sorted(path.name for path in tmp_path.iterdir()) == ["in.txt"]
+
+
+def test_dry_run_reads_an_existing_database_read_only(steps, tmp_path, capsys):
+    run()
+    before = (tmp_path / "test.duckdb").stat().st_mtime_ns
+    capsys.readouterr()
+    run("--dry-run")
+    out = capsys.readouterr().out
+    assert "ok      copy" in out and "ok      load" in out
+    assert (tmp_path / "test.duckdb").stat().st_mtime_ns == before
@@ -0,0 +1,83 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from fynesse import poi_grid
+
+
+bounds = (52.0, 0.0, 52.5, 0.5)
+
+
+@pytest.fixture
+def pois():
+    rng = np.random.default_rng(0)
+    size = 3000
+    return pd.DataFrame({
+        "LAT": rng.uniform(52.01, 52.49, size),
+        "LONG": rng.uniform(0.01, 0.49, size),
+        "amenity": np.where(rng.random(size) < 0.6, "cafe", None),
+        "shop": np.where(rng.random(size) < 0.3, "bakery", None),
+    })
+
+
+def brute_force(pois, tag, i0, i1, j0, j1, resolution_km):
+    # POIs whose cell lies in rows i0..i1-1 and columns j0..j1-1
+    step = resolution_km / poi_grid.km_per_degree
+    row = ((pois["LAT"] - bounds[0]) / step).astype(int)
+    col = ((pois["LONG"] - bounds[1]) / step).astype(int)
+    inside = (row >= i0) & (row < i1) & (col >= j0) & (col < j1) & pois[tag].notnull()
+    return int(inside.sum())
+
+
+def test_counts_match_brute_force_for_cell_aligned_boxes(pois):
+    grids = poi_grid.build_poi_grids(pois, tags=["amenity", "shop"], resolutions_km=[1.0, 2.0], bounds=bounds)
+    rng = np.random.default_rng(1)
+    for resolution_km in grids.resolutions_km:
+        step = resolution_km / poi_grid.km_per_degree
+        rows, cols = grids.tables[resolution_km]["amenity"].shape
+        i0, i1 = np.sort(rng.integers(0, rows, (2, 50)), axis=0)
+        j0, j1 = np.sort(rng.integers(0, cols, (2, 50)), axis=0)
+        for tag in ["amenity", "shop"]:
+            counts = grids.count(
+                tag,
+                north=bounds[0] + i1 * step,
+                south=bounds[0] + i0 * step,
+                east=bounds[1] + j1 * step,
+                west=bounds[1] + j0 * step,
+                resolution_km=resolution_km,
+            )
+            expected = [brute_force(pois, tag, *box, resolution_km) for box in zip(i0, i1, j0, j1)]
+            assert counts.tolist() == expected
+
+
+def test_whole_extent_counts_every_tagged_poi(pois):
+    grids = poi_grid.build_poi_grids(pois, tags=["amenity"], resolutions_km=[1.0], bounds=bounds)
+    south, west, north, east = bounds
+    assert grids.count("amenity", north, south, east, west) == pois["amenity"].notnull().sum()
+
+
+def test_count_near_is_close_to_exact_bbox_counts(pois):
+    grids = poi_grid.build_poi_grids(pois, tags=["amenity"], resolutions_km=[0.1, 1.0], bounds=bounds)
+    latitude, longitude, bbox_side = 52.25, 0.25, 20.0
+    half = bbox_side / poi_grid.km_per_degree / 2
+    exact = (
+        pois["LAT"].between(latitude - half, latitude + half)
+        & pois["LONG"].between(longitude - half, longitude + half)
+        & pois["amenity"].notnull()
+    ).sum()
+    # at 0.1km cells the snapped edges move by at most half a cell on each side
+    count = grids.count_near("amenity", latitude, longitude, bbox_side)
+    assert abs(int(count) - exact) <= max(3, 0.05 * exact)
+
+
+def test_save_load_round_trip(pois, tmp_path):
+    grids = poi_grid.build_poi_grids(pois, tags=["amenity", "shop"], resolutions_km=[0.5, 2.0], bounds=bounds)
+    path = tmp_path / "grids.npz"
+    grids.save(path)
+    loaded = poi_grid.PoiGrids.load(path)
+
+    assert loaded.resolutions_km == grids.resolutions_km
+    assert (loaded.south, loaded.west, loaded.north, loaded.east) == bounds
+    for resolution_km, tables in grids.tables.items():
+        for tag, table in tables.items():
+            np.testing.assert_array_equal(loaded.tables[resolution_km][tag], table)
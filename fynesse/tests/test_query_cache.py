@@ -0,0 +1,118 @@
+import datetime
+import decimal
+
+import pandas as pd
+import pytest
+
+from fynesse import access, query_cache
+
+
+@pytest.fixture
+def conn(tmp_path):
+    conn = access.create_duckdb_connection(str(tmp_path / "test.duckdb"))
+    curr = conn.cursor()
+    curr.execute("CREATE TABLE t (a INTEGER, b DECIMAL(6,2), c VARCHAR, d DATE);")
+    curr.execute("INSERT INTO t VALUES (1, 1.5, 'x', '2020-01-01'), (NULL, NULL, NULL, NULL);")
+    yield conn
+    query_cache.disable()
+    conn.close()
+
+
+def fresh_cache(tmp_path):
+    # a new QueryCache over the same directory, as a new process would see it
+    return query_cache.enable(str(tmp_path / "cache"), memory_mb=0)
+
+
+def test_disk_hit_equals_miss(conn, tmp_path):
+    fresh_cache(tmp_path)
+    miss = access.read_all_data(conn, "t")
+    cache = fresh_cache(tmp_path)
+    hit = access.read_all_data(conn, "t")
+    assert cache.stats()["disk_hits"] == 1
+    assert hit == miss == [(1, decimal.Decimal("1.50"), "x", datetime.date(2020, 1, 1)), (None, None, None, None)]
+    assert type(hit) is type(miss)
+    assert [type(value) for value in hit[0]] == [type(value) for value in miss[0]]
+
+
+@pytest.mark.parametrize(
+    "rows",
+    [
+        ((1, "a"), (None, None)),
+        [{"n": 1, "s": "a"}, {"n": None, "s": None}],
+        [],
+    ],
+)
+def test_rows_round_trip_through_parquet(rows, tmp_path):
+    path = tmp_path / "rows.parquet"
+    access._rows_frame((["n", "s"], rows)).to_parquet(path, index=False)
+    columns, read_back = access._frame_rows(pd.read_parquet(path))
+    assert columns == ["n", "s"]
+    assert read_back == rows
+    assert type(read_back) is type(rows)
+
+
+def test_loading_invalidates(conn, tmp_path):
+    fresh_cache(tmp_path)
+    assert access.calculate_number_of_rows(conn, "t") == [(2,)]
+    conn.cursor().execute("INSERT INTO t VALUES (2, 2.5, 'y', '2021-01-01');")
+    # still the cached count until a loader bumps the version
+    assert access.calculate_number_of_rows(conn, "t") == [(2,)]
+    access.bump_table_version(conn, "t")
+    assert access.calculate_number_of_rows(conn, "t") == [(3,)]
+    assert query_cache.stats()["misses"] == 2
+
+
+def test_table_versions_created_once(conn, tmp_path, monkeypatch):
+    fresh_cache(tmp_path)
+    access.get_first_row(conn, "t")
+    created = []
+    monkeypatch.setattr(access, "_create_table_versions", lambda curr: created.append(curr))
+    access.get_first_row(conn, "t")
+    access.calculate_number_of_rows(conn, "t")
+    assert created == []
+
+
+def memory_database(value):
+    conn = access.create_duckdb_connection(":memory:")
+    conn.cursor().execute(f"CREATE TABLE t AS SELECT {value} AS a;")
+    access.bump_table_version(conn, "t")
+    return conn
+
+
+def test_databases_with_equal_counters_stay_apart(tmp_path):
+    cache = query_cache.enable(str(tmp_path / "cache"))
+    try:
+        first, second = memory_database(1), memory_database(2)
+        assert access.read_all_data(first, "t") == [(1,)]
+        assert access.read_all_data(second, "t") == [(2,)]
+        # in-memory databases never leave files behind
+        assert not list((tmp_path / "cache").iterdir())
+        assert cache.stats()["misses"] == 2
+    finally:
+        query_cache.disable()
+
+
+def test_recreated_database_misses(tmp_path):
+    path = tmp_path / "recreated.duckdb"
+    for value in (1, 2):
+        if path.exists():
+            path.unlink()
+        conn = access.create_duckdb_connection(str(path))
+        conn.cursor().execute(f"CREATE TABLE t AS SELECT {value} AS a;")
+        access.bump_table_version(conn, "t")
+        fresh_cache(tmp_path)
+        assert access.read_all_data(conn, "t") == [(value,)]
+        conn.close()
+    query_cache.disable()
+
+
+def test_initializing_a_table_invalidates(tmp_path):
+    conn = access.create_duckdb_connection(str(tmp_path / "prices.duckdb"))
+    access.initialize_postcode_data_db(conn)
+    conn.cursor().execute("INSERT INTO postcode_data VALUES ('CB2 1TN', 'England', 52.2, 0.12);")
+    fresh_cache(tmp_path)
+    assert access.calculate_number_of_rows(conn, "postcode_data") == [(1,)]
+    access.initialize_postcode_data_db(conn)
+    assert access.calculate_number_of_rows(conn, "postcode_data") == [(0,)]
+    query_cache.disable()
+    conn.close()
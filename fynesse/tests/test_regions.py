@@ -0,0 +1,58 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from fynesse import access, schema
+
+
+@pytest.fixture
+def conn():
+    rng = np.random.default_rng(0)
+    rows = 2000
+    columns = schema.table_columns["prices_coordinates_data"]
+    df = pd.DataFrame(
+        {
+            "price": rng.integers(50000, 30000000, rows),
+            "date_of_transfer": pd.to_datetime("2020-01-01") + pd.to_timedelta(rng.integers(0, 365, rows), unit="D"),
+            "postcode": "CB2 1TN",
+            "property_type": "F",
+            "new_build_flag": "N",
+            "tenure_type": "L",
+            "country": "England",
+            # 8 decimal places, as the table stores them
+            "latitude": np.round(rng.uniform(52.1, 52.3, rows), 8),
+            "longitude": np.round(rng.uniform(0.0, 0.2, rows), 8),
+        }
+    )
+    for column in columns:
+        if column not in df:
+            df[column] = "x"
+    conn = access.create_duckdb_connection(":memory:")
+    access.initialize_prices_coordinates_data_db(conn, 2020, 2020)
+    access.load_frames_into_db(conn, df[columns], "prices_coordinates_data")
+    conn.cursor().execute("CREATE TABLE housing_data AS SELECT * FROM prices_coordinates_data;")
+    return conn
+
+
+def test_export_matches_single_region_extracts(conn, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    regions = {"Cambridge": (52.2054, 0.1132), "Grantchester": (52.18, 0.09)}
+    regions_df = access.bounding_extract_regions_data(conn, regions, distance_km=0.05, output_dir="many")
+    assert set(regions_df["region_name"]) == set(regions)
+
+    for name, (latitude, longitude) in regions.items():
+        access.bounding_extract_region_data(conn, name, latitude, longitude, 0.05)
+        single = pd.read_csv(f"{name}_housing_data.csv", header=None)
+        many = pd.read_csv(tmp_path / "many" / f"{name}_housing_data.csv", header=None)
+        assert len(single) > 0
+        key = [11, 12, 0, 1]
+        pd.testing.assert_frame_equal(
+            many.sort_values(key).reset_index(drop=True), single.sort_values(key).reset_index(drop=True)
+        )
+
+
+def test_no_regions(conn):
+    with pytest.raises(ValueError, match="No regions"):
+        access.bounding_extract_regions_data(conn, [])
+    with pytest.raises(ValueError, match="No regions"):
+        access.bounding_extract_regions_data(conn, {}, distance_km=1.0)
@@ -0,0 +1,138 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from fynesse import access, rollups, schema
+
+accuracy = rollups.sketch_relative_accuracy
+
+
+def sketch_of(prices):
+    buckets, counts = np.unique(rollups._bucket(np.asarray(prices)), return_counts=True)
+    return dict(zip(buckets.tolist(), counts.tolist()))
+
+
+@pytest.mark.parametrize("q", [0.01, 0.1, 0.25, 0.5, 0.75, 0.9, 0.99])
+def test_sketch_quantile_within_relative_accuracy(q):
+    rng = np.random.default_rng(1)
+    prices = np.round(rng.lognormal(12.5, 0.8, 20000)).astype(np.int64)
+    # the sketch reads back the order statistic at rank q * (n - 1), rounded down
+    exact = np.quantile(prices, q, method="lower")
+    assert rollups.sketch_quantile(sketch_of(prices), q) == pytest.approx(exact, rel=accuracy)
+
+
+def test_merged_sketches_equal_one_sketch():
+    rng = np.random.default_rng(2)
+    prices = rng.integers(50000, 2000000, 3000)
+    merged = rollups.merge_sketches([sketch_of(prices[:1000]), sketch_of(prices[1000:])])
+    assert merged == sketch_of(prices)
+
+
+def test_postcode_levels():
+    postcodes = pd.Series(["CB2 1TN", "SW1A 1AA", "E1 6AN"])
+    assert rollups.postcode_level(postcodes, "sector").tolist() == ["CB2 1", "SW1A 1", "E1 6"]
+    assert rollups.postcode_level(postcodes, "district").tolist() == ["CB2", "SW1A", "E1"]
+    assert rollups.postcode_level(postcodes, "area").tolist() == ["CB", "SW", "E"]
+
+
+def transactions(rows, start="2020-01-01", days=731, seed=3):
+    rng = np.random.default_rng(seed)
+    columns = schema.table_columns["prices_coordinates_data"]
+    df = pd.DataFrame(
+        {
+            "price": np.round(rng.lognormal(12.5, 0.6, rows)).astype(np.int64),
+            "date_of_transfer": pd.to_datetime(start) + pd.to_timedelta(rng.integers(0, days, rows), unit="D"),
+            "postcode": rng.choice(["CB2 1TN", "CB2 3QZ", "CB1 2AB", "SW1A 1AA"], rows),
+            "property_type": rng.choice(list("DSTF"), rows),
+        }
+    )
+    for column in columns[4:]:
+        df[column] = 0.0 if column in ("latitude", "longitude") else "x"
+    return df[columns]
+
+
+@pytest.fixture
+def conn():
+    conn = access.create_duckdb_connection(":memory:")
+    access.initialize_prices_coordinates_data_db(conn, 2020, 2021)
+    access.load_frames_into_db(conn, transactions(6000), "prices_coordinates_data")
+    for year in (2020, 2021):
+        rollups.update_price_rollups(conn, year)
+    return conn
+
+
+@pytest.mark.parametrize("level, freq", [("sector", "month"), ("district", "year"), ("area", "year")])
+def test_rollup_summary_matches_raw(conn, level, freq):
+    quantiles = (0.1, 0.5, 0.9)
+    from_rollups = rollups._summary_from_rollups(conn, level, None, None, None, None, freq, quantiles)
+    raw = rollups._summary_from_raw(conn, level, None, None, None, None, freq, quantiles)
+    keys = [level, "period", "property_type"]
+    merged = from_rollups.merge(raw, on=keys, suffixes=("", "_raw"))
+    assert len(merged) == len(raw) == len(from_rollups)
+    assert (merged["count"] == merged["count_raw"]).all()
+    np.testing.assert_allclose(merged["mean_price"], merged["mean_price_raw"], rtol=1e-12)
+
+    # the sketch reads back the lower order statistic, where the raw summary interpolates
+    raw_df = access.read_frame(conn, "prices_coordinates_data")
+    raw_df[level] = rollups.postcode_level(raw_df["postcode"], level)
+    date = pd.to_datetime(raw_df["date_of_transfer"])
+    raw_df["period"] = date.dt.year if freq == "year" else date.dt.to_period("M").dt.to_timestamp()
+    raw_df["property_type"] = raw_df["property_type"].astype(str)
+    grouped = raw_df.groupby(keys)["price"]
+    for q in quantiles:
+        lower = grouped.quantile(q, interpolation="lower").rename("lower").reset_index()
+        checked = merged.merge(lower, on=keys)
+        assert len(checked) == len(merged)
+        assert (np.abs(checked[f"q{q:g}"] / checked["lower"] - 1) <= accuracy + 1e-12).all()
+
+
+def test_price_summary_routes_by_alignment(conn, monkeypatch):
+    used = []
+    empty = pd.DataFrame(columns=["district", "postcode", "period", "property_type", "count", "mean_price", "q0.5"])
+    monkeypatch.setattr(rollups, "_summary_from_raw", lambda *args: used.append("raw") or empty)
+    monkeypatch.setattr(rollups, "_summary_from_rollups", lambda *args: used.append("rollups") or empty)
+    rollups.price_summary(conn, "district", date_from="2020-01-01", date_to="2020-06-30")
+    rollups.price_summary(conn, "district", date_from="2020-01-15", date_to="2020-06-30")
+    rollups.price_summary(conn, "postcode", date_from="2020-01-01", date_to="2020-06-30")
+    assert used == ["rollups", "raw", "raw"]
+
+
+def test_reloading_a_year_replaces_its_rollups(conn):
+    curr = conn.cursor()
+    curr.execute("SELECT SUM(count) FROM price_rollups;")
+    before = curr.fetchone()[0]
+    rollups.update_price_rollups(conn, 2020)
+    curr.execute("SELECT SUM(count) FROM price_rollups;")
+    assert curr.fetchone()[0] == before == 6000
+
+
+def yearly_counts(conn):
+    summary = rollups.price_summary(conn, "area", freq="year")
+    return summary.groupby("period")["count"].sum().to_dict()
+
+
+def test_summary_catches_up_with_loads_that_skip_rollups(conn):
+    assert sum(yearly_counts(conn).values()) == 6000
+    # a new year loaded without update_price_rollups
+    access.load_frames_into_db(conn, transactions(500, "2022-01-01", 365, seed=4), "prices_coordinates_data")
+    assert yearly_counts(conn)[2022] == 500
+    assert rollups.refresh_price_rollups(conn) == []
+
+
+def test_summary_builds_missing_rollups():
+    conn = access.create_duckdb_connection(":memory:")
+    access.initialize_prices_coordinates_data_db(conn, 2020, 2021)
+    access.load_frames_into_db(conn, transactions(1000), "prices_coordinates_data")
+    assert sum(yearly_counts(conn).values()) == 1000
+
+
+def test_loading_one_year_keeps_the_others_current(conn, monkeypatch):
+    assert rollups.refresh_price_rollups(conn) == []
+    previous_version = access.table_version(conn, "prices_coordinates_data")
+    access.load_frames_into_db(conn, transactions(500, "2022-01-01", 365, seed=4), "prices_coordinates_data")
+    rollups.update_price_rollups(conn, 2022, previous_version=previous_version)
+
+    rebuilt = []
+    monkeypatch.setattr(rollups, "_year_rollup", lambda conn, year: rebuilt.append(year) or [])
+    yearly_counts(conn)
+    assert rebuilt == []
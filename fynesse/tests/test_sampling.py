@@ -0,0 +1,62 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from fynesse import access
+
+
+@pytest.fixture(scope="module")
+def conn():
+    conn = access.create_duckdb_connection(":memory:")
+    curr = conn.cursor()
+    curr.execute("CREATE TABLE t (id INTEGER, date_of_transfer DATE, kind VARCHAR);")
+    rng = np.random.default_rng(0)
+    rows = 5000
+    df = pd.DataFrame(
+        {
+            "id": np.arange(rows),
+            "date_of_transfer": pd.to_datetime("2018-01-01") + pd.to_timedelta(rng.integers(0, 3 * 365, rows), unit="D"),
+            # one rare kind, smaller than the per-stratum n
+            "kind": np.where(np.arange(rows) % 500 == 0, "rare", np.where(np.arange(rows) % 2 == 0, "even", "odd")),
+        }
+    )
+    access.load_frames_into_db(conn, df, "t", validate=False)
+    yield conn
+    conn.close()
+
+
+@pytest.mark.parametrize("method", access.sample_methods)
+def test_same_seed_same_sample(conn, method):
+    first = access.read_sample(conn, "t", n=200, method=method, seed=1, chunksize=700)
+    again = access.read_sample(conn, "t", n=200, method=method, seed=1, chunksize=700)
+    other = access.read_sample(conn, "t", n=200, method=method, seed=2, chunksize=700)
+    assert len(first) == 200 and first["id"].is_unique
+    assert first["id"].tolist() == again["id"].tolist()
+    assert set(first["id"]) != set(other["id"])
+
+
+@pytest.mark.parametrize("method", access.sample_methods)
+def test_sample_is_not_biased_to_scan_order(conn, method):
+    # over many seeds every part of the table is sampled at the same rate
+    ids = np.concatenate(
+        [access.read_sample(conn, "t", n=100, method=method, seed=seed, chunksize=700)["id"] for seed in range(40)]
+    )
+    per_fifth = np.bincount(ids // 1000, minlength=5)
+    assert per_fifth.min() > 0.8 * len(ids) / 5
+
+
+@pytest.mark.parametrize("method", access.sample_methods)
+@pytest.mark.parametrize("strata", [["kind"], ["year"], ["year", "kind"]])
+def test_stratified_counts_are_exact(conn, method, strata):
+    sample = access.read_sample(conn, "t", n=30, strata=strata, method=method, seed=3, chunksize=700)
+    table = access.read_frame(conn, "t")
+    keys = access._strata_keys(table, strata)
+    expected = keys.value_counts().clip(upper=30).sort_index()
+    got = access._strata_keys(sample, strata).value_counts().sort_index()
+    pd.testing.assert_series_equal(got, expected, check_names=False)
+    assert sample["id"].is_unique
+
+
+def test_unknown_method(conn):
+    with pytest.raises(ValueError):
+        access.read_sample(conn, "t", method="bernoulli")
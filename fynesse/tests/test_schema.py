@@ -0,0 +1,30 @@
+import decimal
+
+import pandas as pd
+
+from fynesse import access, schema
+
+
+def test_coordinates_keep_their_decimals():
+    df = schema.compact_frame(
+        pd.DataFrame({"latitude": [decimal.Decimal("52.12345678")], "LONG": [decimal.Decimal("-1.23456")]})
+    )
+    assert df["latitude"].iloc[0] == 52.12345678
+    assert df["LONG"].iloc[0] == -1.23456
+
+
+def test_chunks_share_their_types():
+    conn = access.create_duckdb_connection(":memory:")
+    curr = conn.cursor()
+    curr.execute("CREATE TABLE t (county VARCHAR, price INTEGER, latitude DECIMAL(11,8));")
+    # the first chunk has unique counties and no missing prices, the second neither
+    curr.execute(
+        "INSERT INTO t SELECT 'county ' || i, i, 52.1 FROM range(4) AS r(i) "
+        "UNION ALL SELECT 'Kent', CASE WHEN i % 2 = 0 THEN NULL ELSE 70000 END, 51.2 FROM range(4) AS r(i);"
+    )
+    chunks = list(access.read_data_in_chunks(conn, query="SELECT * FROM t ORDER BY latitude DESC;", chunksize=4))
+    assert len(chunks) == 2
+    assert chunks[0].dtypes.to_dict() == chunks[1].dtypes.to_dict()
+    combined = pd.concat(chunks, ignore_index=True)
+    assert combined.dtypes.to_dict() == chunks[0].dtypes.to_dict()
+    assert combined["price"].isna().sum() == 2
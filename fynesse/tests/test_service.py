@@ -0,0 +1,119 @@
+import asyncio
+import json
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from fynesse import access, address, service
+
+
+@pytest.fixture(scope="module")
+def predictor():
+    rng = np.random.default_rng(0)
+    df = pd.DataFrame(rng.random((300, len(access.updated_feature_cols))), columns=access.updated_feature_cols)
+    df["LAT"] = rng.uniform(51, 53, len(df))
+    df["LONG"] = rng.uniform(-2, 0.5, len(df))
+    model = address.make_model("random_forest", n_estimators=5, n_jobs=1)
+    model.fit(address.build_feature_matrix(df), df["amenity_count"])
+    return service.Predictor.from_frame(model, df)
+
+
+def points(count, seed=1):
+    rng = np.random.default_rng(seed)
+    return rng.uniform(51, 53, count), rng.uniform(-2, 0.5, count)
+
+
+def test_batched_predictions_equal_one_batch(predictor):
+    latitudes, longitudes = points(200)
+    expected = predictor.predict(latitudes, longitudes)
+
+    async def run():
+        batcher = service.MicroBatcher(predictor.predict, max_batch_size=32, max_wait_ms=5)
+        batcher.start()
+        try:
+            results = await asyncio.gather(
+                *(batcher.predict(latitudes[i:i + 1], longitudes[i:i + 1]) for i in range(len(latitudes)))
+            )
+        finally:
+            await batcher.stop()
+        return np.concatenate(results), batcher
+
+    got, batcher = asyncio.run(run())
+    np.testing.assert_array_equal(got, expected)
+    sizes = batcher.batch_sizes.to_dict()
+    assert sizes["count"] < len(latitudes)
+    assert sizes["max"] <= 32
+
+
+def test_histogram_quantiles():
+    histogram = service.Histogram([1, 2, 4, 8])
+    for value in [0.5, 1.5, 1.5, 3, 100]:
+        histogram.observe(value)
+    summary = histogram.to_dict()
+    assert summary["count"] == 5 and summary["max"] == 100
+    assert summary["p50"] == 2
+    assert summary["p99"] == 100
+    assert summary["buckets"] == {"le_1": 1, "le_2": 2, "le_4": 1, "le_8": 0, "inf": 1}
+
+
+async def request(port, method, path, body=None):
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    payload = json.dumps(body).encode() if body is not None else b""
+    writer.write(
+        f"{method} {path} HTTP/1.1\r\nHost: test\r\nContent-Length: {len(payload)}\r\nConnection: close\r\n\r\n".encode()
+        + payload
+    )
+    await writer.drain()
+    status = int((await reader.readline()).split()[1])
+    response = await reader.read()
+    writer.close()
+    return status, json.loads(response.split(b"\r\n\r\n", 1)[1])
+
+
+def test_http_routes(predictor):
+    latitudes, longitudes = points(3)
+
+    async def run():
+        svc = service.PredictionService(predictor, max_batch_size=16, max_wait_ms=1)
+        port = await svc.start("127.0.0.1", 0)
+        try:
+            return (
+                await request(port, "POST", "/predict", {"lat": latitudes[0], "lon": longitudes[0]}),
+                await request(port, "POST", "/predict", {"points": [[lat, lon] for lat, lon in zip(latitudes, longitudes)]}),
+                await request(port, "POST", "/predict", {"latitude": 1}),
+                await request(port, "GET", "/health"),
+                await request(port, "GET", "/nowhere"),
+                await request(port, "GET", "/metrics"),
+            )
+        finally:
+            await svc.stop()
+
+    single, many, bad, health, missing, metrics = asyncio.run(run())
+    expected = predictor.predict(latitudes, longitudes)
+    assert single == (200, {"student_pop": pytest.approx(float(expected[0]))})
+    assert many[0] == 200 and many[1]["student_pop"] == pytest.approx(expected.tolist())
+    assert bad[0] == 400
+    assert health == (200, {"status": "ok"})
+    assert missing[0] == 404
+    assert metrics[1]["errors"] == 1 and metrics[1]["request_latency_ms"]["count"] == 2
+
+
+class FailingPredictor:
+    def predict(self, latitudes, longitudes):
+        raise RuntimeError("model unavailable")
+
+
+def test_prediction_failure_is_a_500():
+    async def run():
+        svc = service.PredictionService(FailingPredictor(), max_batch_size=16, max_wait_ms=1)
+        port = await svc.start("127.0.0.1", 0)
+        try:
+            return await request(port, "POST", "/predict", {"lat": 52.2, "lon": 0.12}), svc.metrics()
+        finally:
+            await svc.stop()
+
+    (status, body), metrics = asyncio.run(run())
+    assert status == 500
+    assert body == {"error": "RuntimeError: model unavailable"}
+    assert metrics["errors"] == 1
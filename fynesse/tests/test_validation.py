@@ -0,0 +1,86 @@
+import json
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from fynesse import access, schema
+
+
+def check(table_name, rows):
+    frame = pd.DataFrame(rows, columns=schema.table_columns[table_name])
+    return schema.ValidationReport(table_name).check(frame)
+
+
+def test_every_rule_names_a_column_of_its_table():
+    for table_name, rules in schema.table_rules.items():
+        for rule in rules:
+            assert rule.column in schema.table_columns[table_name], (table_name, rule)
+
+
+def test_clean_rows_pass():
+    report = check("census_student_pop", [["E00000001", 0.25, 0.5, 120]])
+    assert report.ok and report.rows == 1
+
+
+@pytest.mark.parametrize(
+    "row, failed",
+    [
+        (["E00000001", np.nan, 0.5, 120], "TOTAL_POP is missing"),
+        (["E00000001", np.inf, 0.5, 120], "TOTAL_POP is infinite"),
+        (["E00000001", 12.5, 0.5, 120], "TOTAL_POP overflows DECIMAL(3,2)"),
+        (["E000000010000", 0.25, 0.5, 120], "OA21CD longer than 10 characters"),
+    ],
+)
+def test_each_failure_is_counted_once(row, failed):
+    report = check("census_student_pop", [row])
+    assert report.counts == {failed: 1}
+
+
+def test_osm_coordinates_are_checked():
+    counts = [0] * len(schema.table_columns["osm_data"][3:])
+    assert check("osm_data", [[1, 52.2, 0.12] + counts]).ok
+    report = check("osm_data", [[1, 152.2, 0.12] + counts])
+    assert report.counts == {"LAT outside [-90, 90]": 1}
+
+
+def test_report_round_trips(tmp_path):
+    report = check("census_student_pop", [["E00000001", np.nan, 0.5, 120]])
+    restored = schema.ValidationReport.from_dict(json.loads(json.dumps(report.to_dict())))
+    assert restored.counts == report.counts and restored.rows == report.rows
+
+
+def test_write_csv_report_is_reused_until_the_file_changes(tmp_path, monkeypatch):
+    path = str(tmp_path / "student.csv")
+    frame = pd.DataFrame([["E00000001", 0.25, 0.5, 120]], columns=schema.table_columns["census_student_pop"])
+    access.write_csv(frame, path, "census_student_pop")
+    assert access._saved_validation(path, "census_student_pop").ok
+    with open(path, "a") as file:
+        file.write("E00000002,,0.5,3\n")
+    assert access._saved_validation(path, "census_student_pop") is None
+    assert access.validate_csv(path, "census_student_pop").counts == {"TOTAL_POP is missing": 1}
+
+
+def test_osm_data_is_written_in_table_order(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    areas = pd.DataFrame({"FID": [7, 8], "LAT": [52.2, 51.5], "LONG": [0.12, -0.1]})
+    monkeypatch.setattr(access, "read_frame", lambda conn, table_name: areas)
+    monkeypatch.setattr(
+        access, "count_pois_near_coordinates", lambda lat, lon, tags: {"amenity": 3, "brand": 1}.items()
+    )
+    access.create_osm_data(None)
+
+    written = pd.read_csv("osm_data.csv")
+    assert list(written.columns) == schema.table_columns["osm_data"]
+    assert written["FID"].tolist() == [7, 8]
+    assert written["LAT"].tolist() == [52.2, 51.5]
+    assert written["amenity_count"].tolist() == [3, 3]
+    assert written["brand_count"].tolist() == [1, 1]
+    assert access._saved_validation("osm_data.csv", "osm_data").ok
+
+    conn = access.create_duckdb_connection(":memory:")
+    access.initialize_osm_data_db(conn)
+    curr = conn.cursor()
+    curr.execute("SELECT FID, LAT, amenity_count FROM osm_data ORDER BY FID;")
+    assert [(fid, float(lat), count) for fid, lat, count in curr.fetchall()] == [(7, 52.2, 3), (8, 51.5, 3)]
@@ -33,6 +33,8 @@ REQUIRED = [
 # What packages are optional?
 EXTRAS = {
     "interactive html plots": ["bokeh",],
+    # embedded backend, the default of fynesse-pipeline
+    "duckdb": ["duckdb",],
 }
 
 PACKAGE_DATA = {"fynesse": ["defaults.yml"]}
@@ -115,9 +117,12 @@ setup(
     # If your package is a single module, use this instead of "packages":
     # py_modules=["mypackage"],
 
-    # entry_points={
-    #     "console_scripts": ["mycli=mymodule:cli"],
-    # },
+    entry_points={
+        "console_scripts": [
+            "fynesse-pipeline=fynesse.pipeline:cli",
+            "fynesse-serve=fynesse.service:cli",
+        ],
+    },
     install_requires=REQUIRED,
     extras_require=EXTRAS,
     include_package_data=True,